@@ -4,7 +4,9 @@ from typing import Dict, Any, Optional, List
 
 from pydantic import BaseModel, Field, ConfigDict
 from dotenv import load_dotenv
-from openai import OpenAI, APIConnectionError, RateLimitError, BadRequestError
+from openai import APIConnectionError, RateLimitError, BadRequestError
+
+from . import openai_client
 
 load_dotenv(override=False)
 
@@ -43,19 +45,8 @@ SALIDA JSON EXACTA:
 
 class QAConfig(BaseModel):
     model_config = ConfigDict(protected_namespaces=())
-    api_key: str = Field(default=os.getenv("OPENAI_API_KEY", ""))
     model: str = Field(default=os.getenv("OPENAI_MODEL", "gpt-4o-mini"))
-
-_client: Optional[OpenAI] = None
-
-def _client_ok() -> Optional[OpenAI]:
-    global _client
-    if _client is None:
-        cfg = QAConfig()
-        if not cfg.api_key:
-            return None
-        _client = OpenAI(api_key=cfg.api_key)
-    return _client
+    timeout: Optional[float] = Field(default=float(os.getenv("QA_TIMEOUT")) if os.getenv("QA_TIMEOUT") else None)  # s; None = OPENAI_TIMEOUT
 
 def _norm(s: str) -> str:
     s = (s or "").strip().lower()
@@ -86,26 +77,77 @@ def _looks_like_answer_to_option(user_text: str, pending_question: str) -> bool:
             return True
     return False
 
-def maybe_answer_felia_question(user_text: str, state: Dict[str, Any]) -> Dict[str, Any]:
+# --- Clasificador local (sin modelo) -------------------------------------------
+# El prompt sólo admite "qa" con "¿?" o un interrogativo explícito: cualquier otro
+# mensaje se puede rotular acá y el modelo queda para lo que parece pregunta real.
+LOCAL_RULES = os.getenv("QA_LOCAL_RULES", "true").lower() in ("1", "true", "yes")
+
+_INTERROG_RE = re.compile(
+    r"\b(que|cual|cuales|como|cuando|donde|por que|para que|cuanto|cuanta|cuantos|cuantas|quien|"
+    r"sirve|sirven|conviene|recomendas|recomendarias|diferencia|diferencias|explica|explicame|"
+    r"es mejor|vale la pena)\b")
+_NEED_RE = re.compile(
+    r"\b(quiero|quisiera|necesito|necesitaria|busco|buscaba|estoy buscando|dame|dam|mostrame|pasame|"
+    r"mandame|pasa|tenes|tienen|hay|me sirve|me gustaria|precisaria|preciso|cotizame|presupuesto)\b")
+_SMALLTALK = {
+    "hola", "holaa", "buenas", "buen", "dia", "dias", "tarde", "tardes", "noche", "noches", "gracias",
+    "muchas", "mil", "ok", "oka", "okey", "dale", "genial", "perfecto", "joya", "barbaro", "listo",
+    "chau", "saludos", "va", "todo", "bien", "jaja", "jajaja", "si", "bueno", "y", "vos",
+}
+
+_STATS = {"local": 0, "llm": 0}
+
+def classify_locally(user_text: str, pending_question: str = "", rules: bool = True) -> Optional[Dict[str, Any]]:
+    """
+    Rótulo determinístico o None si el mensaje parece una pregunta real
+    (lleva "¿"/"?" o un interrogativo) y hay que consultar al modelo. Con
+    `rules=False` sólo se reconoce la respuesta a una opción pendiente.
+    """
+    ut = _norm(user_text)
+    if _looks_like_answer_to_option(user_text, pending_question):
+        return {"kind": "answer_option", "confidence": 0.9}
+    if not rules:
+        return None
+    if not ut:
+        return {"kind": "other", "confidence": 0.5}
+    if "?" in user_text or "¿" in user_text or _INTERROG_RE.search(ut):
+        return None
+    words = re.findall(r"[a-z]+", ut)
+    if words and all(w in _SMALLTALK for w in words) and not re.search(r"\d", ut):
+        return {"kind": "smalltalk", "confidence": 0.85}
+    if _NEED_RE.search(ut):
+        return {"kind": "statement_need", "confidence": 0.85}
+    # afirmación sin marcas de pregunta (p.ej. "perfil c 70", "para la casa"): nunca es "qa"
+    return {"kind": "statement_need", "confidence": 0.6}
+
+def router_stats() -> Dict[str, Any]:
+    total = _STATS["local"] + _STATS["llm"]
+    return {**_STATS, "local_share": round(_STATS["local"] / total, 3) if total else 0.0}
+
+async def maybe_answer_felia_question(user_text: str, state: Dict[str, Any]) -> Dict[str, Any]:
     """
     Devuelve:
       {
         "is_qa": bool,
         "kind": "qa" | "answer_option" | "statement_need" | "smalltalk" | "other",
         "answer": str,
-        "confidence": float
+        "confidence": float,
+        "used_llm": bool      # True si la clasificación vino del modelo
+        "llm_attempted": bool # True si se llamó al modelo (aunque haya fallado)
       }
     """
     s = (user_text or "").strip()
     pending_q = state.get("pending_question") or ""
 
-    # atajo: si coincide con una opción de la pregunta pendiente ⇒ no es Q&A
-    if _looks_like_answer_to_option(s, pending_q):
-        return {"is_qa": False, "kind": "answer_option", "answer": "", "confidence": 0.9}
+    # opción de la pregunta pendiente (siempre) y reglas locales: afirmaciones,
+    # saludos y respuestas no necesitan al modelo
+    local = classify_locally(s, pending_q, rules=LOCAL_RULES)
+    if local is not None:
+        _STATS["local"] += 1
+        return {"is_qa": False, "answer": "", "used_llm": False, **local}
 
-    client = _client_ok()
-    if client is None:
-        return {"is_qa": False, "kind": "other", "answer": "", "confidence": 0.0}
+    if not openai_client.available():
+        return {"is_qa": False, "kind": "other", "answer": "", "confidence": 0.0, "used_llm": False}
 
     payload = {
         "greeted": state.get("greeted", False),
@@ -114,10 +156,13 @@ def maybe_answer_felia_question(user_text: str, state: Dict[str, Any]) -> Dict[s
         "need_history": state.get("need_history") or [],
     }
 
+    _STATS["llm"] += 1
     try:
-        resp = client.chat.completions.create(
-            model=QAConfig().model,
+        cfg = QAConfig()
+        raw = await openai_client.chat_json(
+            model=cfg.model,
             temperature=0.2,
+            timeout=cfg.timeout,
             messages=[
                 {"role": "system", "content": SYSTEM_PROMPT_QA},
                 {
@@ -131,14 +176,15 @@ def maybe_answer_felia_question(user_text: str, state: Dict[str, Any]) -> Dict[s
                 },
             ],
         )
-        raw = resp.choices[0].message.content
         data = json.loads(raw)
     except (APIConnectionError, RateLimitError, BadRequestError, ValueError, json.JSONDecodeError):
-        return {"is_qa": False, "kind": "other", "answer": "", "confidence": 0.0}
+        return {"is_qa": False, "kind": "other", "answer": "", "confidence": 0.0, "used_llm": False,
+                "llm_attempted": True}
 
     # Normalización de salida
     if not isinstance(data, dict):
-        return {"is_qa": False, "kind": "other", "answer": "", "confidence": 0.0}
+        return {"is_qa": False, "kind": "other", "answer": "", "confidence": 0.0, "used_llm": True,
+                "llm_attempted": True}
 
     kind = data.get("kind") or ("qa" if data.get("is_qa") else "other")
     is_qa = bool(kind == "qa")
@@ -146,4 +192,5 @@ def maybe_answer_felia_question(user_text: str, state: Dict[str, Any]) -> Dict[s
     ans = ans.strip() if isinstance(ans, str) else ""
     conf = float(data.get("confidence") or (0.8 if is_qa else 0.6))
 
-    return {"is_qa": is_qa, "kind": kind, "answer": ans, "confidence": conf}
+    return {"is_qa": is_qa, "kind": kind, "answer": ans, "confidence": conf, "used_llm": True,
+            "llm_attempted": True}
@@ -0,0 +1,192 @@
+from __future__ import annotations
+import hashlib, json, logging, mmap, os, struct, sys
+from array import array
+from bisect import bisect_left
+from collections.abc import Sequence
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+try:  # lock entre procesos (POSIX); sin fcntl, el reemplazo atómico alcanza
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+# Snapshot binario del catálogo ya normalizado + índice, para que cada worker
+# no re-parsee el CSV ni re-normalice 50k filas al arrancar.
+#
+# Formato (little/native endian, mismo host que lo generó):
+#   MAGIC(8) | VERSION u32 | len(header) u32 | header JSON | pad | secciones
+# header = {"source": {size, mtime_ns, sha1}, "meta": {...},
+#           "sections": {nombre: [offset, nbytes, typecode]}, "byteorder": ...}
+# Las secciones son bytes crudos de arrays ("I", "d") o blobs utf-8 ("B"),
+# alineados a 8 para poder castearlas directo desde el mmap.
+# Las columnas de texto son blobs separados por "\0" con un array de offsets
+# (inicio de cada string), así se pueden leer de a una sin decodificar todo.
+MAGIC = b"FELIACAT"
+VERSION = 3
+_HEAD = struct.Struct("<8sII")
+_ALIGN = 8
+
+Section = Union[bytes, array]
+
+def file_sha1(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def source_key(csv_path: str, with_hash: bool = True) -> Dict[str, Any]:
+    st = os.stat(csv_path)
+    key: Dict[str, Any] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if with_hash:
+        key["sha1"] = file_sha1(csv_path)
+    return key
+
+def _pad(n: int) -> int:
+    return (-n) % _ALIGN
+
+def write_snapshot(path: str, source: Dict[str, Any], meta: Dict[str, Any],
+                   sections: Dict[str, Section]) -> None:
+    """Escribe el snapshot de forma atómica (tmp + os.replace)."""
+    layout: Dict[str, list] = {}
+    blobs = []
+    off = 0
+    for name, data in sections.items():
+        if isinstance(data, array):
+            typecode, raw = data.typecode, data.tobytes()
+        else:
+            typecode, raw = "B", bytes(data)
+        layout[name] = [off, len(raw), typecode]
+        blobs.append(raw)
+        off += len(raw) + _pad(len(raw))
+
+    header = json.dumps({"source": source, "meta": meta, "sections": layout,
+                         "byteorder": sys.byteorder}).encode("utf-8")
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(_HEAD.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        f.write(b"\0" * _pad(_HEAD.size + len(header)))
+        for raw in blobs:
+            f.write(raw)
+            f.write(b"\0" * _pad(len(raw)))
+    os.replace(tmp, path)
+
+def read_snapshot(path: str, csv_path: str) -> Optional[Tuple[Dict[str, Any], Dict[str, memoryview]]]:
+    """
+    Mapea el snapshot en memoria (sólo lectura) y devuelve (meta, secciones)
+    si corresponde al CSV actual; None si falta, es de otra versión o quedó
+    viejo. Se compara size+mtime y, si difieren, el sha1 del contenido
+    (un `touch` sin cambios no fuerza rebuild).
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, hlen = _HEAD.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            return None
+        if _HEAD.size + hlen > len(mm):
+            raise ValueError("header truncado")
+        header = json.loads(mm[_HEAD.size:_HEAD.size + hlen].decode("utf-8"))
+        layout = header["sections"]
+        base = _HEAD.size + hlen + _pad(_HEAD.size + hlen)
+        # el escritor rellena cada sección a 8: el archivo debe medir exactamente eso
+        end = max((off + nbytes + _pad(nbytes) for off, nbytes, _ in layout.values()), default=0)
+        if base + end != len(mm):
+            raise ValueError(f"tamaño {len(mm)} != {base + end} según el header (¿escritura cortada?)")
+    except (OSError, ValueError, TypeError, KeyError, struct.error) as e:
+        log.warning("[SNAPSHOT] ilegible %s, se reconstruye: %s", path, e)
+        return None
+    if header.get("byteorder") != sys.byteorder:
+        return None
+
+    src = header.get("source") or {}
+    cur = source_key(csv_path, with_hash=False)
+    if (src.get("size"), src.get("mtime_ns")) != (cur["size"], cur["mtime_ns"]):
+        if src.get("sha1") != file_sha1(csv_path):
+            return None
+
+    view = memoryview(mm)
+    sections: Dict[str, memoryview] = {}
+    try:
+        for name, (off, nbytes, typecode) in layout.items():
+            mv = view[base + off: base + off + nbytes]
+            sections[name] = mv if typecode == "B" else mv.cast(typecode)
+    except (TypeError, ValueError) as e:  # sección que no calza con su typecode
+        log.warning("[SNAPSHOT] sección ilegible en %s, se reconstruye: %s", path, e)
+        return None
+    return header.get("meta") or {}, sections
+
+
+@contextmanager
+def build_lock(path: str) -> Iterator[None]:
+    """
+    Lock exclusivo `<path>.lock`: con N workers arrancando a la vez, uno solo
+    reconstruye el snapshot y el resto espera y lo adjunta ya hecho.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", "a+b") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def pack_strings(values: List[str]) -> Tuple[bytes, array]:
+    """Strings → (blob utf-8 separado por "\0", offsets de inicio; off[n] = len+1)."""
+    encoded = [v.encode("utf-8") for v in values]
+    off = array("I", [0])
+    pos = 0
+    for b in encoded:
+        pos += len(b) + 1
+        off.append(pos)
+    return b"\0".join(encoded), off
+
+def unpack_strings(blob: memoryview, n: int) -> List[str]:
+    return str(blob, "utf-8").split("\0") if n else []
+
+class MmapStrings(Sequence):
+    """Columna de texto leída del mmap bajo demanda (nada se copia al worker)."""
+    __slots__ = ("_blob", "_off")
+
+    def __init__(self, blob: memoryview, off: memoryview):
+        self._blob = blob
+        self._off = off
+
+    def __len__(self) -> int:
+        return len(self._off) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return str(self._blob[self._off[i]:self._off[i + 1] - 1], "utf-8")
+
+class MmapPostings:
+    """
+    n-grama → posting list sobre el mmap: grams ordenados + búsqueda binaria,
+    sin dict por worker. Misma interfaz `get()` que el dict en memoria.
+    """
+    __slots__ = ("_grams", "_off", "_ids")
+
+    def __init__(self, grams: MmapStrings, off: memoryview, ids: memoryview):
+        self._grams = grams
+        self._off = off
+        self._ids = ids
+
+    def __len__(self) -> int:
+        return len(self._grams)
+
+    def get(self, gram: str, default: Any = ()) -> Any:
+        k = bisect_left(self._grams, gram)
+        if k < len(self._grams) and self._grams[k] == gram:
+            return self._ids[self._off[k]:self._off[k + 1]]
+        return default
@@ -0,0 +1,71 @@
+from __future__ import annotations
+import json
+from typing import Any, Dict
+
+class TopLevelFields:
+    """
+    Parser incremental de un objeto JSON que llega en pedazos (streaming).
+    No arma el árbol: sólo sigue strings/profundidad y, cada vez que se cierra
+    un miembro del nivel superior (`,` o `}` a profundidad 1), lo decodifica.
+    Así `action` y `question` se pueden usar antes de que termine el resto.
+    """
+    def __init__(self):
+        self.text = ""
+        self.fields: Dict[str, Any] = {}
+        self.done = False
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._start = -1  # inicio del miembro en curso (nivel superior)
+
+    def feed(self, chunk: str) -> Dict[str, Any]:
+        """Agrega texto; devuelve los campos que se completaron con este pedazo."""
+        self.text += chunk or ""
+        new: Dict[str, Any] = {}
+        text = self.text
+        for i in range(self._pos, len(text)):
+            if self.done:
+                break
+            c = text[i]
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == '"':
+                    self._in_str = False
+                continue
+            if c == '"':
+                self._in_str = self._depth > 0
+            elif c in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._start = i + 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._close_member(text[self._start:i], new)
+                    self.done = True
+            elif c == "," and self._depth == 1:
+                self._close_member(text[self._start:i], new)
+                self._start = i + 1
+        self._pos = len(text)
+        self.fields.update(new)
+        return new
+
+    @staticmethod
+    def _close_member(member: str, out: Dict[str, Any]) -> None:
+        if not member.strip():
+            return
+        try:
+            out.update(json.loads("{" + member + "}"))
+        except ValueError:
+            pass  # miembro mal formado: queda para el json.loads final
+
+    def result(self) -> Dict[str, Any]:
+        """El objeto completo (json.loads del texto entero; ValueError si no cierra)."""
+        data = json.loads(self.text)
+        if not isinstance(data, dict):
+            raise ValueError("se esperaba un objeto JSON")
+        return data
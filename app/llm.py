@@ -1,12 +1,18 @@
 from __future__ import annotations
-import os, json, re
-from typing import Dict, Any, List
+import asyncio, os, json, re, hashlib, logging
+from typing import Dict, Any, List, Optional
 
 from pydantic import BaseModel, Field, ConfigDict
 from dotenv import load_dotenv
-from openai import OpenAI, APIConnectionError, RateLimitError, BadRequestError
+from openai import APIConnectionError, RateLimitError, BadRequestError
+
+from . import openai_client
+from .json_stream import TopLevelFields
+from .plan_cache import PLAN_CACHE, plan_key
+from .state_compact import compact_state, encoding_ready, load_encoding, prompt_tokens, state_tokens
 
 load_dotenv(override=False)
+log = logging.getLogger(__name__)
 
 SYSTEM_PROMPT = """Eres FELIA, asistente de Felemax (ferretería).
 Tu trabajo es decidir **TODO**: interpretar la intención, generar hipótesis, confirmar con UNA pregunta
@@ -59,7 +65,11 @@ BÚSQUEDA
 EVITAR BUCLES / PREGUNTAS GENÉRICAS
 - **Nunca** generes preguntas genéricas tipo “¿Qué dato definimos ahora?” o “¿Qué preferís definir?”.
 - **Elegí vos** el **siguiente slot más crítico** y hacé una **pregunta concreta** con 3–5 opciones.
-- No repitas exactamente una pregunta que ya esté en `state.asked_questions`.
+- No repitas exactamente una pregunta que ya esté en `state.asked_questions`; `state.asked_before` resume las
+  más viejas (sin opciones) y `state.need_summary` los pedidos anteriores: tampoco vuelvas sobre esos slots.
+- Además de `question`, devolvé en `alt_questions` 2–3 preguntas **alternativas** concretas (con opciones) para
+  otros slots críticos, ordenadas por prioridad — también cuando `action` sea `search`. Si `question` ya se hizo
+  o falta evidencia para buscar, el orquestador usa la primera de esas que no esté en `state.asked_questions`.
 
 FLAG DEL ORQUESTADOR
 - Si `state.force_more` es `true`, **devolvé** `{"action":"ask", "question": "...con opciones..."}` para el slot
@@ -69,6 +79,7 @@ SALIDA JSON EXACTA:
 {
   "action": "ask" | "search",
   "question": str | null,
+  "alt_questions": [str, ...],
   "intent": { "family": str|null, "family_confidence": float },
   "ready_to_search": boolean,
   "slots_required": [str, ...],
@@ -85,19 +96,14 @@ SALIDA JSON EXACTA:
 
 class LLMConfig(BaseModel):
     model_config = ConfigDict(protected_namespaces=())
-    api_key: str = Field(default=os.getenv("OPENAI_API_KEY", ""))
     model: str = Field(default=os.getenv("OPENAI_MODEL", "gpt-4o-mini"))
+    timeout: Optional[float] = Field(default=float(os.getenv("PLANNER_TIMEOUT")) if os.getenv("PLANNER_TIMEOUT") else None)  # s; None = OPENAI_TIMEOUT
+    stream: bool = Field(default=os.getenv("PLANNER_STREAM", "false").lower() in ("1", "true", "yes"))
+    state_budget: int = Field(default=int(os.getenv("PLANNER_STATE_BUDGET", "400") or 0))  # tokens del state; 0 = sin tope
+    drain_timeout: float = Field(default=float(os.getenv("PLANNER_DRAIN_TIMEOUT", "15") or 15))  # s para el resto del stream
 
-_client: OpenAI | None = None
-
-def _client_ok() -> OpenAI | None:
-    global _client
-    if _client is None:
-        cfg = LLMConfig()
-        if not cfg.api_key:
-            return None
-        _client = OpenAI(api_key=cfg.api_key)
-    return _client
+# cambia con el prompt o el modelo ⇒ lo cacheado (incluso en disco) deja de aplicar
+_CACHE_SALT = hashlib.sha1((SYSTEM_PROMPT + LLMConfig().model).encode("utf-8")).hexdigest()[:12]
 
 # --- extractores de unidades (agnósticos de rubro) ---
 _MM = re.compile(r'(\d+)\s*mm\b', re.I)
@@ -129,6 +135,7 @@ def _fallback_minimal(user_text: str, state: Dict[str, Any]) -> Dict[str, Any]:
     return {
         "action": "ask",
         "question": q,
+        "alt_questions": [],
         "intent": {"family": None, "family_confidence": 0.0},
         "ready_to_search": False,
         "slots_required": [],
@@ -140,42 +147,169 @@ def _fallback_minimal(user_text: str, state: Dict[str, Any]) -> Dict[str, Any]:
         "units": _units_from_text(user_text),
         "hypotheses": [],
         "disambiguation": None,
+        "used_llm": False,
     }
 
-def plan_next_step(user_text: str, state: Dict[str, Any]) -> Dict[str, Any]:
-    client = _client_ok()
-    if client is None:
+_LLM_ERRORS = (APIConnectionError, RateLimitError, BadRequestError, ValueError, json.JSONDecodeError)
+
+_NOSE_CLEAN = re.compile(r'\s*\|\s*no\s*s[ée]\s*', re.IGNORECASE)
+_NOSE_CLEAN2 = re.compile(r'no\s*s[ée]\s*\|\s*', re.IGNORECASE)
+
+def strip_no_se(q: str) -> str:
+    """Saca la opción 'no sé' de una pregunta con opciones (y los paréntesis que queden vacíos)."""
+    q = _NOSE_CLEAN2.sub('', _NOSE_CLEAN.sub('', q))
+    return re.sub(r'\(\s*\)', '', q).strip()
+
+async def plan_next_step(user_text: str, state: Dict[str, Any]) -> Dict[str, Any]:
+    # misma apertura + mismo estado relevante ⇒ misma decisión, sin ir al modelo
+    key = plan_key(user_text, state, salt=_CACHE_SALT) if PLAN_CACHE.enabled else None
+    if key:
+        cached = await PLAN_CACHE.aget(key)
+        if cached is not None:
+            cached.update(used_llm=False, llm_attempted=False, cache_hit=True)
+            return cached
+
+    if not openai_client.available():
         return _fallback_minimal(user_text, state)
 
+    cfg = LLMConfig()
+    if not encoding_ready(cfg.model):  # la primera carga de tiktoken puede bajar el BPE
+        await asyncio.to_thread(load_encoding, cfg.model)
+    # el prompt lleva el estado compactado; el sanitizado usa el completo
+    prompt_state = compact_state(state, cfg.state_budget, cfg.model)
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user",
+         "content": (
+             "Decide el próximo paso respetando las reglas.\n"
+             f"state={json.dumps(prompt_state, ensure_ascii=False)}\n"
+             f"user='{user_text}'\n"
+             "Devuelve SOLO el JSON con el formato indicado."
+         )}
+    ]
+    tokens = {"prompt": prompt_tokens(messages, cfg.model, cache=_SYSTEM_TOKENS),
+              "state": state_tokens(prompt_state, cfg.model), "state_raw": state_tokens(state, cfg.model)}
+    if cfg.stream:
+        data = await _plan_streaming(cfg, messages, user_text, state, key)
+        data["tokens"] = tokens
+        return data
     try:
-        resp = client.chat.completions.create(
-            model=LLMConfig().model,
-            temperature=0.6,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user",
-                 "content": (
-                     "Decide el próximo paso respetando las reglas.\n"
-                     f"state={json.dumps(state, ensure_ascii=False)}\n"
-                     f"user='{user_text}'\n"
-                     "Devuelve SOLO el JSON con el formato indicado."
-                 )}
-            ]
-        )
-        raw = resp.choices[0].message.content
+        raw = await openai_client.chat_json(model=cfg.model, temperature=0.6, timeout=cfg.timeout,
+                                            messages=messages)
         data = json.loads(raw)
-    except (APIConnectionError, RateLimitError, BadRequestError, ValueError, json.JSONDecodeError):
+        if not isinstance(data, dict):
+            raise ValueError("planner: se esperaba un objeto JSON")
+        data["used_llm"] = True
+    except _LLM_ERRORS:
         data = _fallback_minimal(user_text, state)
+    data["llm_attempted"] = True  # la llamada salió, haya servido o no
+    data = _finish_plan(data, user_text, state)
+    await _remember_plan(key, data)
+    data["tokens"] = tokens
+    return data
+
+# --- Streaming: la pregunta sale apenas el modelo la termina de escribir ---
+_SYSTEM_TOKENS: Dict[str, int] = {}  # el system prompt se cuenta una sola vez
+_BACKGROUND: set = set()  # referencias fuertes a los drenajes en curso
 
+def _early_question(fields: Dict[str, Any], asked: set) -> bool:
+    q = fields.get("question")
+    return (fields.get("action") == "ask" and isinstance(q, str) and bool(q.strip())
+            and q not in asked and strip_no_se(q) not in asked)
+
+async def _plan_streaming(cfg: LLMConfig, messages: List[Dict[str, Any]], user_text: str,
+                          state: Dict[str, Any], key: Optional[str]) -> Dict[str, Any]:
+    """
+    Parsea el JSON a medida que llega. Con `action == "ask"` y una `question`
+    usable ya completas, devuelve un plan temprano (`stream="early"`) y el resto
+    del stream se drena en segundo plano: el plan completo queda en `rest` (task)
+    para el trace y es el que se cachea. Si no, espera el JSON entero.
+    """
+    parser = TopLevelFields()
+    asked = set(state.get("asked_questions") or [])
+    stream = openai_client.stream_chat(model=cfg.model, temperature=0.6, timeout=cfg.timeout,
+                                       messages=messages)
+    early = False
+    try:
+        async for delta in stream:
+            parser.feed(delta)
+            if _early_question(parser.fields, asked):
+                early = True
+                break
+        if not early:
+            data = parser.result()
+            data["used_llm"] = True
+    except _LLM_ERRORS:
+        await stream.aclose()
+        return _finish_plan({**_fallback_minimal(user_text, state), "llm_attempted": True}, user_text, state)
+    except BaseException:
+        await stream.aclose()
+        raise
+    if not early:
+        data = _finish_plan({**data, "llm_attempted": True}, user_text, state)
+        await _remember_plan(key, data)
+        data["stream"] = "full"
+        return data
+
+    plan = _finish_plan({**parser.fields, "used_llm": True, "llm_attempted": True}, user_text, state)
+    plan["stream"] = "early"
+    rest = asyncio.create_task(_drain_plan(stream, parser, user_text, state, key, cfg.drain_timeout))
+    _BACKGROUND.add(rest)
+    rest.add_done_callback(_BACKGROUND.discard)
+    plan["rest"] = rest
+    return plan
+
+async def _drain_plan(stream, parser: TopLevelFields, user_text: str, state: Dict[str, Any],
+                      key: Optional[str], limit: float) -> Optional[Dict[str, Any]]:
+    # acotado: un stream colgado no puede retener la conexión ni el cupo del limitador
+    try:
+        async with asyncio.timeout(limit):
+            async for delta in stream:
+                parser.feed(delta)
+        data = parser.result()
+    except TimeoutError:
+        log.warning("[PLANNER] el resto del plan no llegó en %.1f s, queda el plan temprano", limit)
+        return None
+    except _LLM_ERRORS as e:
+        log.warning("[PLANNER] el stream no terminó bien, queda el plan temprano: %s", e)
+        return None
+    finally:
+        await stream.aclose()
+    data["used_llm"] = True
+    data = _finish_plan(data, user_text, state)
+    await _remember_plan(key, data)
+    return data
+
+async def cancel_background() -> int:
+    """Cancela los drenajes en curso de este loop (shutdown). Devuelve cuántos había."""
+    loop = asyncio.get_running_loop()
+    tasks = [t for t in _BACKGROUND if not t.done() and t.get_loop() is loop]
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return len(tasks)
+
+async def _remember_plan(key: Optional[str], data: Dict[str, Any]) -> None:
+    if key and data.get("used_llm"):
+        await PLAN_CACHE.aput(key, data)  # sólo decisiones del modelo, nunca el fallback
+
+def _finish_plan(data: Dict[str, Any], user_text: str, state: Dict[str, Any]) -> Dict[str, Any]:
     # Sanitizado
     asked = set(state.get("asked_questions") or [])
     q = data.get("question")
     if not isinstance(q, str) or not q.strip() or q in asked:
         data["question"] = None
     else:
-        data["question"] = re.sub(r'\s*\|\s*no\s*s[ée]\s*', '', data["question"], flags=re.IGNORECASE)
-        data["question"] = re.sub(r'no\s*s[ée]\s*\|\s*', '', data["question"], flags=re.IGNORECASE)
-        data["question"] = re.sub(r'\(\s*\)', '', data["question"]).strip()
+        data["question"] = strip_no_se(data["question"])
+
+    # alternativas en orden, sin repetidas ni ya hechas
+    alts: List[str] = []
+    for a in (data.get("alt_questions") or []):
+        if isinstance(a, str) and a.strip():
+            a = strip_no_se(a)
+            if a and a not in asked and a != data["question"] and a not in alts:
+                alts.append(a)
+    data["alt_questions"] = alts
 
     # Normalizaciones y defaults
     def _keep_strs(lst):
@@ -205,6 +339,8 @@ def plan_next_step(user_text: str, state: Dict[str, Any]) -> Dict[str, Any]:
     if data["action"] == "ask" and not data["question"]:
         if isinstance(data.get("disambiguation"), str) and data["disambiguation"].strip():
             data["question"] = data["disambiguation"].strip()
+        elif data["alt_questions"]:
+            data["question"] = data["alt_questions"].pop(0)
         else:
             # evita genéricas; pedí algo concreto
             data["question"] = "Necesito un dato concreto para avanzar (por ejemplo: medida en mm, material o ángulo)."
@@ -212,4 +348,5 @@ def plan_next_step(user_text: str, state: Dict[str, Any]) -> Dict[str, Any]:
     goal = int(data.get("variants_goal") or 25)
     data["variants_goal"] = 40 if goal >= 40 else 30 if goal >= 30 else 25
 
+    data["cache_hit"] = False
     return data
@@ -1,8 +1,10 @@
 from __future__ import annotations
-import os, re
+import asyncio, hmac, logging, os, re, time
+from contextlib import asynccontextmanager
 from typing import List, Optional, Dict, Any
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field, ConfigDict, AliasChoices
 from starlette.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
@@ -11,12 +13,17 @@ app = FastAPI()
 app.mount("/", wa_app)
 load_dotenv(override=False)
 
-from .assistant_qa import maybe_answer_felia_question
-from .llm import plan_next_step
+from .assistant_qa import maybe_answer_felia_question, router_stats
+from . import openai_client
+from .llm import cancel_background, plan_next_step, strip_no_se
 from .normalizer import normalize_user_text
-from .search import LocalCatalog, build_query_variants, hydrate_in_odoo
-from .ranker import rank_and_cut, pretty_list
+from .search import ReloadingCatalog, build_query_variants, hydrate_in_odoo
+from .odoo_client import CACHE as ODOO_CACHE
+from .settings import settings as APP_SETTINGS
+from .plan_cache import PLAN_CACHE
+from .ranker import prerank, rank_and_cut, pretty_list
 from .mock_products import generate_mock_products
+from .sessions import SessionConflict, SessionLocks, make_session_store
 
 # ========================
 # Config
@@ -25,11 +32,24 @@ class Settings(BaseModel):
     model_config = ConfigDict(protected_namespaces=())
     openai_api_key: str = Field(default=os.getenv("OPENAI_API_KEY", ""))
     catalog_path: str = Field(default=os.getenv("CATALOG_PATH", "./data/catalog.csv"))
+    catalog_snapshot_path: Optional[str] = Field(default=os.getenv("CATALOG_SNAPSHOT_PATH") or None)  # default: <csv>.snap
+    catalog_use_snapshot: bool = Field(default=os.getenv("CATALOG_SNAPSHOT", "true").lower() in ("1", "true", "yes"))
+    catalog_shared: bool = Field(default=os.getenv("CATALOG_SHARED", "false").lower() in ("1", "true", "yes"))  # mmap compartido entre workers
+    catalog_reload_interval: float = Field(default=float(os.getenv("CATALOG_RELOAD_INTERVAL", "30") or 0))  # s; 0 = sin polling (la recarga admin sólo llega a un worker)
+    admin_token: str = Field(default=os.getenv("ADMIN_TOKEN", ""))
     product_source: str = Field(default=os.getenv("PRODUCT_SOURCE", "mock"))  # "mock" | "local"
     odoo_url: Optional[str] = Field(default=os.getenv("ODOO_URL"))
     odoo_db: Optional[str] = Field(default=os.getenv("ODOO_DB"))
     odoo_user: Optional[str] = Field(default=os.getenv("ODOO_USER"))
     odoo_pass: Optional[str] = Field(default=os.getenv("ODOO_PASS"))
+    two_phase_rank: bool = Field(default=os.getenv("TWO_PHASE_RANK", "true").lower() in ("1", "true", "yes"))  # hidratar sólo el top-K
+    prerank_top_k: int = Field(default=int(os.getenv("PRERANK_TOP_K", "8") or 8))
+    use_alt_questions: bool = Field(default=os.getenv("USE_ALT_QUESTIONS", "true").lower() in ("1", "true", "yes"))  # alternativas del 1er plan antes de repreguntar
+    parallel_llm: bool = Field(default=os.getenv("PARALLEL_LLM", "true").lower() in ("1", "true", "yes"))  # router y planner a la vez
+    session_backend: str = Field(default=os.getenv("SESSION_BACKEND", "memory"))  # "memory" | "sqlite" (compartido entre workers)
+    session_db_path: Optional[str] = Field(default=os.getenv("SESSION_DB_PATH") or None)
+    session_ttl: float = Field(default=float(os.getenv("SESSION_TTL", "21600") or 21600))  # s sin turnos hasta vencer
+    session_max: int = Field(default=int(os.getenv("SESSION_MAX", "10000") or 10000))  # tope LRU del backend memory
     show_prices: bool = Field(default=True)
     currency: str = Field(default="AR$")
 
@@ -55,12 +75,24 @@ class SessionState(BaseModel):
     rejected_options: List[str] = []
     last_question_options: List[str] = []
 
-SESSIONS: Dict[str, SessionState] = {}
+SESSIONS = make_session_store(SessionState, SETTINGS.session_backend, SETTINGS.session_db_path,
+                              ttl=SETTINGS.session_ttl, maxsize=SETTINGS.session_max)
+SESSION_SAVE_RETRIES = 3  # turnos rehechos si otro worker escribió la sesión en el medio
+SESSION_LOCKS = SessionLocks()  # turnos del mismo usuario en serie, en orden de llegada
+
+log = logging.getLogger(__name__)
 
 # ========================
 # FastAPI
 # ========================
-app = FastAPI(title="Felia Orchestrator", version="5.3.0")
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+    yield
+    n = await cancel_background()  # drenajes del planner en streaming que quedaron colgados
+    if n:
+        log.info("[SHUTDOWN] cancelados %s drenajes del planner", n)
+
+app = FastAPI(title="Felia Orchestrator", version="5.3.0", lifespan=_lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -68,7 +100,11 @@ app.add_middleware(
     allow_methods=["*"], allow_headers=["*"],
 )
 
-CATALOG = LocalCatalog(SETTINGS.catalog_path)
+CATALOG = ReloadingCatalog(SETTINGS.catalog_path,
+                           poll_interval=SETTINGS.catalog_reload_interval,
+                           snapshot_path=SETTINGS.catalog_snapshot_path,
+                           use_snapshot=SETTINGS.catalog_use_snapshot,
+                           shared=SETTINGS.catalog_shared)
 
 # ========================
 # I/O
@@ -86,20 +122,15 @@ class ChatOut(BaseModel):
 # Helpers
 # ========================
 _OPTS_RE = re.compile(r"\(([^)]{0,300})\)")
-_NOSE_CLEAN = re.compile(r'\s*\|\s*no\s*s[ée]\s*', re.IGNORECASE)
-_NOSE_CLEAN2 = re.compile(r'no\s*s[ée]\s*\|\s*', re.IGNORECASE)
 _NEG_RE = re.compile(r'\b(no necesito|no es|no son|otra cosa|otro|ninguno|ninguna)\b', re.I)
 
-def _strip_no_se(q: str) -> str:
-    q2 = _NOSE_CLEAN.sub('', q)
-    q2 = _NOSE_CLEAN2.sub('', q2)
-    q2 = re.sub(r'\(\s*\)', '', q2)
-    return q2.strip()
+def _count_llm(turn: Dict[str, Any], result: Dict[str, Any]) -> None:
+    """Intentos (toda llamada que salió) y llamadas que sirvieron, por separado."""
+    turn["llm_attempts"] += int(bool(result.get("llm_attempted") or result.get("used_llm")))
+    turn["llm_calls"] += int(bool(result.get("used_llm")))
 
 def get_state(session: str) -> SessionState:
-    if session not in SESSIONS:
-        SESSIONS[session] = SessionState()
-    return SESSIONS[session]
+    return SESSIONS.load(session)
 
 def _extract_options(q: str) -> List[str]:
     m = _OPTS_RE.search(q or "")
@@ -130,29 +161,39 @@ def _facts_score(step: Dict[str, Any]) -> int:
     score += len((step.get("answered_slots") or {}))
     return score
 
-def _force_concrete_question(user_text: str, state: SessionState, base_step: Dict[str, Any]) -> str:
+def _planner_state(state: SessionState, force_more: Optional[bool] = None) -> Dict[str, Any]:
+    # copias: el planner corre como task mientras el turno sigue (y puede mutar el estado)
+    return {
+        "greeted": state.greeted,
+        "asked_questions": list(state.asked_questions),
+        "answered_slots": dict(state.answered_slots),
+        "rounds": state.rounds,
+        "need_history": list(state.need_history),
+        "force_more": state.force_more if force_more is None else force_more,
+        "pending_question": state.pending_question or "",
+        "rejected_families": list(state.rejected_families),
+        "rejected_options": list(state.rejected_options),
+        "last_question_options": list(state.last_question_options),
+    }
+
+async def _force_concrete_question(user_text: str, state: SessionState, base_step: Dict[str, Any],
+                                   turn: Dict[str, Any]) -> str:
     """
-    Hace un segundo pase a GPT con force_more=true para que
-    devuelva una pregunta **concreta** (sin 'qué dato definimos ahora').
+    Pregunta **concreta** (sin 'qué dato definimos ahora'). Primero prueba, en
+    orden, las alternativas que ya trajo el plan (`alt_questions`); sólo si
+    todas se hicieron, hace un segundo pase a GPT con force_more=true.
     Si aún así no llega, arma una pregunta específica a partir de slots_required.
     """
-    step2 = plan_next_step(
-        user_text=user_text,
-        state={
-            "greeted": state.greeted,
-            "asked_questions": state.asked_questions,
-            "answered_slots": state.answered_slots,
-            "rounds": state.rounds,
-            "need_history": state.need_history,
-            "force_more": True,  # <- clave
-            "pending_question": state.pending_question or "",
-            "rejected_families": state.rejected_families,
-            "rejected_options": state.rejected_options,
-            "last_question_options": state.last_question_options,
-        }
-    )
+    if SETTINGS.use_alt_questions:
+        for cand in [base_step.get("question"), base_step.get("disambiguation"), *(base_step.get("alt_questions") or [])]:
+            q = strip_no_se(cand.strip()) if isinstance(cand, str) else ""
+            if q and q not in state.asked_questions:
+                return q
+
+    step2 = await plan_next_step(user_text=user_text, state=_planner_state(state, force_more=True))
+    _count_llm(turn, step2)
     q = (step2.get("question") or step2.get("disambiguation") or "").strip()
-    q = _strip_no_se(q) if q else q
+    q = strip_no_se(q) if q else q
     if q:
         return q
 
@@ -167,9 +208,70 @@ def _force_concrete_question(user_text: str, state: SessionState, base_step: Dic
 # ========================
 # Endpoint
 # ========================
+_RELOAD: Dict[str, Any] = {"task": None}  # recarga en curso (una a la vez)
+
+def _reload_catalog(force: bool) -> Dict[str, Any]:
+    # la marca compartida avisa al resto de los workers (la ven en su próximo poll)
+    if force:
+        try:
+            CATALOG.request_reload()
+        except OSError as e:
+            log.warning("[CATALOG] no pude escribir %s: %s", CATALOG.marker_path, e)
+    return CATALOG.reload(force=force)
+
+@app.post("/admin/catalog/reload")
+async def admin_catalog_reload(force: bool = True, wait: bool = False,
+                               x_admin_token: Optional[str] = Header(default=None)):
+    """
+    Recarga el catálogo sin reiniciar (los /chat en curso terminan con el anterior).
+    Sin ADMIN_TOKEN configurado el endpoint no existe. La reconstrucción corre en
+    un hilo: por defecto sólo se agenda (202); con `wait=true` se espera el resultado.
+    Este worker recarga ya; los demás, en su próximo poll (CATALOG_RELOAD_INTERVAL).
+    """
+    if not SETTINGS.admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest((x_admin_token or "").encode(), SETTINGS.admin_token.encode()):
+        raise HTTPException(status_code=403, detail="admin token inválido")
+    task = _RELOAD["task"]
+    if task is None or task.done():
+        task = _RELOAD["task"] = asyncio.create_task(asyncio.to_thread(_reload_catalog, force))
+    elif not wait:
+        return JSONResponse({"scheduled": False, "running": True, "version": CATALOG.version}, status_code=202)
+    if wait:
+        return await asyncio.shield(task)
+    return JSONResponse({"scheduled": True, "version": CATALOG.version}, status_code=202)
+
+def _log_full_plan(session: str, task: "asyncio.Task") -> None:
+    if task.cancelled() or task.exception() is not None or task.result() is None:
+        return
+    full = task.result()
+    log.info("[TRACE] plan completo session=%s intent=%s hypotheses=%s answered_slots=%s",
+             session, full.get("intent"), full.get("hypotheses"), full.get("answered_slots"))
+
 @app.post("/chat", response_model=ChatOut)
-def chat(body: ChatIn):
-    state = get_state(body.session)
+async def chat(body: ChatIn):
+    return await _serve_turn(body, SESSIONS, SESSION_LOCKS)
+
+async def _serve_turn(body: ChatIn, store, locks: SessionLocks) -> ChatOut:
+    # Meta suele mandar varios mensajes seguidos del mismo wa_id: sin el lock
+    # los turnos se intercalan en los awaits y pisan need_history/pending_question.
+    # El lock ordena dentro del proceso; el lease de la store, entre workers.
+    async with locks.hold(body.session), store.lease(body.session):
+        for attempt in range(SESSION_SAVE_RETRIES + 1):
+            state = await store.aload(body.session)  # una lectura…
+            out = await _chat_turn(body, state)
+            try:
+                await store.asave(body.session, state)   # …y una escritura por turno (SQLite en un hilo)
+                break
+            except SessionConflict:
+                # otro worker guardó esta sesión en el medio (p.ej. lease vencido): se rehace el turno
+                if attempt >= SESSION_SAVE_RETRIES:
+                    raise
+                log.warning("[SESSIONS] conflicto al guardar %s, rehago el turno (%s)", body.session, attempt + 1)
+    return out
+
+async def _chat_turn(body: ChatIn, state: SessionState) -> ChatOut:
+    catalog = CATALOG.current()  # fijo para todo el turno, aunque haya recarga
     user_text = normalize_user_text(body.text)
     state.last_user_need = user_text
     state.need_history.append(user_text)
@@ -185,50 +287,74 @@ def chat(body: ChatIn):
     # Memorizar rechazos genéricos
     _update_rejections_from_user(user_text, state)
 
+    # Planner y router salen juntos: la latencia del turno es ~1 llamada, no 2.
+    # Si el router dice "qa", la llamada del planner se cancela.
+    t0 = time.perf_counter()
+    turn: Dict[str, Any] = {"llm_calls": 0, "llm_attempts": 0}  # métricas del turno para el trace
+    planner = (asyncio.create_task(plan_next_step(user_text=user_text, state=_planner_state(state)))
+               if SETTINGS.parallel_llm else None)
+
     # Router Q&A (pregunta real vs afirmación / respuesta de opción)
-    qa = maybe_answer_felia_question(
-        user_text=user_text,
-        state={
-            "greeted": state.greeted,
-            "asked_questions": state.asked_questions,
-            "need_history": state.need_history,
-            "pending_question": state.pending_question or "",
-        }
-    )
+    try:
+        qa = await maybe_answer_felia_question(
+            user_text=user_text,
+            state={
+                "greeted": state.greeted,
+                "asked_questions": state.asked_questions,
+                "need_history": state.need_history,
+                "pending_question": state.pending_question or "",
+            }
+        )
+    except BaseException:
+        if planner is not None:
+            planner.cancel()
+        raise
+
+    _count_llm(turn, qa)
+    turn["qa_kind"] = qa.get("kind")
+    turn["qa_router"] = router_stats()  # local vs modelo (local_share)
 
     # 1) Q&A real ⇒ responder breve + retomar pregunta pendiente
     if qa.get("is_qa") and qa.get("kind") == "qa":
+        if planner is not None:
+            if planner.done() and not planner.cancelled() and planner.exception() is None:
+                _count_llm(turn, planner.result())
+            elif not planner.done() and openai_client.available():
+                turn["llm_attempts"] += 1  # se cancela en vuelo: la llamada ya salió
+            planner.cancel()
         ans = (qa.get("answer") or "").strip()
         if state.pending_question:
             reply = f"{ans}\n\n{state.pending_question}" if ans else state.pending_question
         else:
             reply = ans or "¿Podés contarme un poco más del uso?"
-        return ChatOut(reply=reply, trace={"mode": "qa", "qa_confidence": qa.get("confidence", 0.0)})
+        return ChatOut(reply=reply, trace={"mode": "qa", "qa_confidence": qa.get("confidence", 0.0),
+                                           "llm_ms": round((time.perf_counter() - t0) * 1000),
+                                           **turn})
 
     # 2) answer_option / statement_need / other ⇒ seguimos con el plan principal (GPT)
-    step = plan_next_step(
-        user_text=user_text,
-        state={
-            "greeted": state.greeted,
-            "asked_questions": state.asked_questions,
-            "answered_slots": state.answered_slots,
-            "rounds": state.rounds,
-            "need_history": state.need_history,
-            "force_more": state.force_more,
-            "pending_question": state.pending_question or "",
-            "rejected_families": state.rejected_families,
-            "rejected_options": state.rejected_options,
-            "last_question_options": state.last_question_options,
-        }
-    )
+    if planner is not None:
+        step = await planner
+    else:
+        step = await plan_next_step(user_text=user_text, state=_planner_state(state))
+    _count_llm(turn, step)
+    turn["plan_cache"] = "hit" if step.get("cache_hit") else "miss"
+    turn["plan_stream"] = step.pop("stream", None)
+    turn["plan_partial"] = turn["plan_stream"] == "early"  # sin hypotheses/intent todavía
+    turn["planner_tokens"] = step.get("tokens")  # prompt / state compactado / state completo
+    rest = step.pop("rest", None)
+    if rest is not None:
+        # plan temprano: el resto (hipótesis, slots, variantes) llega después y va al log
+        rest.add_done_callback(lambda t, s=body.session: _log_full_plan(s, t))
+    turn["plan_cache_stats"] = PLAN_CACHE.stats()
+    llm_ms = round((time.perf_counter() - t0) * 1000)
 
     # Si GPT pide preguntar
     if step.get("action") == "ask":
         q = (step.get("question") or step.get("disambiguation") or "").strip()
-        q = _strip_no_se(q) if q else q
+        q = strip_no_se(q) if q else q
         if not q or q in state.asked_questions:
             # Forzar una concreta (sin genéricas)
-            q = _force_concrete_question(user_text, state, step)
+            q = await _force_concrete_question(user_text, state, step, turn)
 
         if q not in state.asked_questions:
             state.asked_questions.append(q)
@@ -236,18 +362,19 @@ def chat(body: ChatIn):
         state.rounds += 1
         state.ask_streak += 1
         state.pending_question = q
-        return ChatOut(reply=q, trace={"mode": "ask", "hypotheses": step.get("hypotheses", []), "intent": step.get("intent", {})})
+        return ChatOut(reply=q, trace={"mode": "ask", "hypotheses": step.get("hypotheses", []), "intent": step.get("intent", {}),
+                                       "llm_ms": llm_ms, **turn})
 
     # Si GPT dice buscar pero con evidencia baja, pedimos UNA concreta (sin genéricas)
     if step.get("action") == "search" and (_facts_score(step) < 3):
-        q = _force_concrete_question(user_text, state, step)
+        q = await _force_concrete_question(user_text, state, step, turn)
         if q not in state.asked_questions:
             state.asked_questions.append(q)
         state.last_question_options = _extract_options(q)
         state.rounds += 1
         state.ask_streak += 1
         state.pending_question = q
-        return ChatOut(reply=q, trace={"mode": "ask_forced", "intent": step.get("intent", {})})
+        return ChatOut(reply=q, trace={"mode": "ask_forced", "intent": step.get("intent", {}), **turn})
 
     # ================= BUSCAR =================
     not_tokens = step.get("not") or []
@@ -291,43 +418,50 @@ def chat(body: ChatIn):
         state.rejected_families = []
         state.rejected_options = []
         state.last_question_options = []
-        return ChatOut(reply=msg, trace={"mode": "mock", "variants_used": len(variants), "intent": step.get("intent", {})})
+        return ChatOut(reply=msg, trace={"mode": "mock", "variants_used": len(variants), "intent": step.get("intent", {}),
+                                           **turn})
 
     # LOCAL
-    candidates: List[Dict[str, Any]] = []
-    for vq in variants:
-        hits = CATALOG.search(vq)
-        if hits:
-            candidates.extend(hits)
-        if len(candidates) >= 200:
-            break
-
-    if not candidates:
+    candidate_ids: List[int] = []
+    search_stats: Dict[str, int] = {}
+    for ids in catalog.search_many_ids(variants, limit=200, stats=search_stats):
+        candidate_ids.extend(ids)
+
+    if not candidate_ids:
         # En vez de “¿qué preferís definir?”, forzamos una concreta
-        q = _force_concrete_question(user_text, state, step)
+        q = await _force_concrete_question(user_text, state, step, turn)
         if q not in state.asked_questions:
             state.asked_questions.append(q)
         state.last_question_options = _extract_options(q)
         state.rounds += 1
         state.ask_streak += 1
         state.pending_question = q
-        return ChatOut(reply=q, trace={"mode": "local_no_results_ask", "intent": step.get("intent", {})})
-
-    hydrated = hydrate_in_odoo(
+        return ChatOut(reply=q, trace={"mode": "local_no_results_ask", "intent": step.get("intent", {}), **turn})
+
+    # dicts sólo para los candidatos (sin repetir filas entre variantes)
+    candidates = catalog.rows_for(dict.fromkeys(candidate_ids))
+    if SETTINGS.two_phase_rank:
+        # pre-rank con datos del catálogo → sólo el top-K va a Odoo
+        candidates = prerank(candidates, must_tokens=step.get("must", []), not_tokens=not_tokens,
+                             k=SETTINGS.prerank_top_k)
+    # XML-RPC bloqueante: fuera del event loop (sin ODOO_HYDRATE no hay nada que hidratar)
+    hydrate = APP_SETTINGS.odoo_hydrate
+    hydrated = await asyncio.to_thread(
+        hydrate_in_odoo,
         candidates=candidates,
         odoo_cfg=dict(url=SETTINGS.odoo_url, db=SETTINGS.odoo_db, user=SETTINGS.odoo_user, password=SETTINGS.odoo_pass)
-    )
+    ) if hydrate else candidates
 
     top_items = rank_and_cut(hydrated or candidates, must_tokens=step.get("must", []), not_tokens=not_tokens)
     if not top_items:
-        q = _force_concrete_question(user_text, state, step)
+        q = await _force_concrete_question(user_text, state, step, turn)
         if q not in state.asked_questions:
             state.asked_questions.append(q)
         state.last_question_options = _extract_options(q)
         state.rounds += 1
         state.ask_streak += 1
         state.pending_question = q
-        return ChatOut(reply=q, trace={"mode": "local_ambiguous_ask", "intent": step.get("intent", {})})
+        return ChatOut(reply=q, trace={"mode": "local_ambiguous_ask", "intent": step.get("intent", {}), **turn})
 
     msg = pretty_list(top_items, show_prices=SETTINGS.show_prices, currency=SETTINGS.currency)
     msg += "\n¿Te lo reservo/te lo envío o preferís retirar por sucursal?"
@@ -344,4 +478,4 @@ def chat(body: ChatIn):
     state.rejected_options = []
     state.last_question_options = []
 
-    return ChatOut(reply=msg, trace={"mode": "local_ok", "variants_used": len(variants), "intent": step.get("intent", {})})
+    return ChatOut(reply=msg, trace={"mode": "local_ok", "variants_used": len(variants), "search_stats": search_stats, "hydrated": len(candidates) if hydrate else 0, "odoo_cache": ODOO_CACHE.stats(), "intent": step.get("intent", {}), **turn})
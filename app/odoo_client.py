@@ -1,49 +1,226 @@
-from typing import List, Dict
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 from .settings import settings
+import logging, threading, time
 import xmlrpc.client
 
+log = logging.getLogger(__name__)
+
+PRODUCT_FIELDS = ["name", "lst_price", "qty_available", "default_code"]
+TEMPLATE_FIELDS = ["name", "list_price", "qty_available", "default_code"]
+STOCK_FIELDS = ["qty_available", "default_code"]  # relectura sólo de stock (precio aún vigente)
+CODES_PER_CALL = 500  # tope de códigos por search_read (payload acotado)
+
 class OdooClient:
+    """
+    Sesión XML-RPC contra Odoo. El uid se autentica una vez y se reusa; los
+    ServerProxy son por hilo (no son thread-safe) y /chat corre en threadpool.
+    """
     def __init__(self):
         self.url = settings.odoo_url
         self.db = settings.odoo_db
         self.username = settings.odoo_user
         self.password = settings.odoo_password
         self._uid = None
-        self._common = xmlrpc.client.ServerProxy(f"{self.url}/xmlrpc/2/common")
-        self._models = xmlrpc.client.ServerProxy(f"{self.url}/xmlrpc/2/object")
+        self._auth_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _proxy(self, name: str) -> xmlrpc.client.ServerProxy:
+        proxy = getattr(self._local, name, None)
+        if proxy is None:
+            proxy = xmlrpc.client.ServerProxy(f"{self.url}/xmlrpc/2/{name}", allow_none=True)
+            setattr(self._local, name, proxy)
+        return proxy
 
     def _login(self):
         if self._uid is None:
-            self._uid = self._common.authenticate(self.db, self.username, self.password, {})
+            with self._auth_lock:
+                if self._uid is None:
+                    self._uid = self._proxy("common").authenticate(self.db, self.username, self.password, {})
         return self._uid
 
-    def read_product_by_code(self, default_code: str):
+    def _execute(self, model: str, method: str, args: list, kwargs: Optional[dict] = None):
         uid = self._login()
         if not uid:
-            return None
-        dom = [["default_code", "=", default_code]]
-        ids = self._models.execute_kw(self.db, uid, self.password, "product.product", "search", [dom], {"limit": 1})
-        if not ids:
-            ids_t = self._models.execute_kw(self.db, uid, self.password, "product.template", "search", [dom], {"limit": 1})
-            if not ids_t:
-                return None
-            recs = self._models.execute_kw(self.db, uid, self.password, "product.template", "read", [ids_t, ["name", "list_price", "qty_available", "default_code"]])
-            return recs[0] if recs else None
-        recs = self._models.execute_kw(self.db, uid, self.password, "product.product", "read", [ids, ["name", "lst_price", "qty_available", "default_code"]])
-        return recs[0] if recs else None
-
-def hydrate_candidates(items: List[Dict]) -> List[Dict]:
-    """Enriquece precio/stock desde Odoo por default_code (si ODOO_HYDRATE=true)."""
+            return []
+        try:
+            return self._proxy("object").execute_kw(self.db, uid, self.password, model, method, args, kwargs or {})
+        except xmlrpc.client.Fault as e:
+            if "AccessDenied" not in str(e.faultString):
+                raise
+            # sesión vencida / password rotado: re-autenticamos una vez
+            self._uid = None
+            uid = self._login()
+            if not uid:
+                return []
+            return self._proxy("object").execute_kw(self.db, uid, self.password, model, method, args, kwargs or {})
+
+    def read_products_by_codes(self, codes: Iterable[str], stock_only: bool = False) -> Dict[str, Dict[str, Any]]:
+        """
+        default_code → registro, con UN search_read por modelo: primero
+        product.product; los códigos que no aparecen, en product.template.
+        Con `stock_only` se pide sólo qty_available.
+        """
+        pending = list(dict.fromkeys(c for c in codes if c))
+        found: Dict[str, Dict[str, Any]] = {}
+        models = ((("product.product", STOCK_FIELDS), ("product.template", STOCK_FIELDS)) if stock_only else
+                  (("product.product", PRODUCT_FIELDS), ("product.template", TEMPLATE_FIELDS)))
+        for model, fields in models:
+            if not pending:
+                break
+            for i in range(0, len(pending), CODES_PER_CALL):
+                chunk = pending[i:i + CODES_PER_CALL]
+                recs = self._execute(model, "search_read", [[["default_code", "in", chunk]]], {"fields": fields})
+                for rec in recs or []:
+                    code = rec.get("default_code")
+                    if code and code not in found:
+                        found[code] = rec
+            pending = [c for c in pending if c not in found]
+        return found
+
+    def read_product_by_code(self, default_code: str):
+        return self.read_products_by_codes([default_code]).get(default_code)
+
+_CLIENTS: Dict[Tuple[str, str, str, str], OdooClient] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+def get_client() -> OdooClient:
+    """Cliente autenticado compartido (uno por url/db/usuario/password)."""
+    key = (settings.odoo_url, settings.odoo_db, settings.odoo_user, settings.odoo_password)
+    cli = _CLIENTS.get(key)
+    if cli is None:
+        with _CLIENTS_LOCK:
+            cli = _CLIENTS.setdefault(key, OdooClient())
+    return cli
+
+_MISSING = object()
+
+class HydrationCache:
+    """
+    LRU acotado default_code → (precio, stock) con un vencimiento por campo:
+    el precio cambia poco, el stock más seguido. Un código que Odoo no conoce
+    se guarda como negativo (None) para no volver a preguntarlo en cada turno.
+    Con el precio vigente y el stock vencido, `lookup` devuelve el registro
+    marcado para releer sólo qty_available.
+    """
+    def __init__(self, maxsize: int = 5000, price_ttl: float = 300.0, stock_ttl: float = 60.0,
+                 negative_ttl: float = 600.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.price_ttl = price_ttl
+        self.stock_ttl = stock_ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._data: "OrderedDict[str, Tuple]" = OrderedDict()  # code → (rec|None, price_exp, stock_exp)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.negative_hits = self.evictions = self.stock_refreshes = 0
+
+    def lookup(self, code: str) -> Tuple[Any, bool]:
+        """
+        (registro | None si es negativo | _MISSING, stock_vigente). _MISSING:
+        hay que leer todo; registro con stock_vigente=False: sólo el stock.
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._data.get(code)
+            if entry is None or entry[1] <= now:
+                self.misses += 1
+                return _MISSING, False
+            self._data.move_to_end(code)
+            if entry[2] <= now:
+                self.stock_refreshes += 1
+                return entry[0], False
+            if entry[0] is None:
+                self.negative_hits += 1
+            self.hits += 1
+            return entry[0], True
+
+    def get(self, code: str):
+        """Registro vigente (o None si es negativo); _MISSING si algo venció."""
+        rec, stock_ok = self.lookup(code)
+        return rec if stock_ok else _MISSING
+
+    def put_stock(self, code: str, qty: Any) -> None:
+        """Renueva sólo el stock (y su vencimiento); el precio conserva el suyo."""
+        with self._lock:
+            entry = self._data.get(code)
+            if entry is None or entry[0] is None:
+                return
+            self._data[code] = ({**entry[0], "qty_available": qty}, entry[1], self._clock() + self.stock_ttl)
+
+    def put(self, code: str, rec: Optional[Dict]) -> None:
+        if self.maxsize <= 0:
+            return
+        now = self._clock()
+        if rec is None:
+            exp = (now + self.negative_ttl,) * 2
+        else:
+            exp = (now + self.price_ttl, now + self.stock_ttl)
+        with self._lock:
+            self._data[code] = (rec, *exp)
+            self._data.move_to_end(code)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses,
+                "negative_hits": self.negative_hits, "evictions": self.evictions,
+                "stock_refreshes": self.stock_refreshes,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+CACHE = HydrationCache(settings.odoo_cache_size, settings.odoo_price_ttl,
+                       settings.odoo_stock_ttl, settings.odoo_negative_ttl)
+
+def _merge(it: Dict, rec: Optional[Dict]) -> Dict:
+    if not rec:
+        return it
+    qty = rec.get("qty_available", it.get("qty_available", 0))
+    price = rec.get("lst_price") or rec.get("list_price") or it.get("price", 0)
+    return {**it, "qty_available": qty, "price": float(price)}
+
+def hydrate_candidates(items: List[Dict], cache: Optional[HydrationCache] = None) -> List[Dict]:
+    """
+    Enriquece precio/stock desde Odoo por default_code (si ODOO_HYDRATE=true).
+    Primero se mira el cache; los códigos faltantes o con el precio vencido se
+    resuelven juntos (un search_read por modelo), y los que sólo tienen el
+    stock vencido, en otro batch que pide sólo qty_available. Si Odoo falla,
+    se usa lo que haya en cache y el resto queda con datos del catálogo.
+    """
     if not settings.odoo_hydrate:
         return items
-    cli = OdooClient()
-    out: List[Dict] = []
-    for it in items:
-        code = it.get("default_code")
-        rec = cli.read_product_by_code(code) if code else None
-        if rec:
-            qty = rec.get("qty_available", it.get("qty_available", 0))
-            price = rec.get("lst_price") or rec.get("list_price") or it.get("price", 0)
-            it = {**it, "qty_available": qty, "price": float(price)}
-        out.append(it)
-    return out
+    cache = CACHE if cache is None else cache
+    recs: Dict[str, Optional[Dict]] = {}
+    missing, stale_stock = [], []
+    for code in dict.fromkeys(it.get("default_code") for it in items):
+        if not code:
+            continue
+        rec, stock_ok = cache.lookup(code)
+        if rec is _MISSING:
+            missing.append(code)
+            continue
+        recs[code] = rec
+        if not stock_ok and rec is not None:
+            stale_stock.append(code)
+    try:
+        if missing:
+            found = get_client().read_products_by_codes(missing)
+            for code in missing:
+                recs[code] = found.get(code)
+                cache.put(code, recs[code])
+        if stale_stock:
+            found = get_client().read_products_by_codes(stale_stock, stock_only=True)
+            for code in stale_stock:
+                if code in found:
+                    cache.put_stock(code, found[code].get("qty_available"))
+                    recs[code] = {**recs[code], "qty_available": found[code].get("qty_available")}
+                else:
+                    cache.put(code, None)  # ya no existe en Odoo
+                    recs[code] = None
+    except (xmlrpc.client.Error, OSError) as e:
+        log.warning("[ODOO] hidratación falló, sigo con datos del catálogo: %s", e)
+    return [_merge(it, recs.get(it.get("default_code"))) for it in items]
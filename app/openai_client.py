@@ -0,0 +1,74 @@
+from __future__ import annotations
+import asyncio, os, weakref
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from pydantic import BaseModel, Field, ConfigDict
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+
+load_dotenv(override=False)
+
+class OpenAIConfig(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
+    api_key: str = Field(default=os.getenv("OPENAI_API_KEY", ""))
+    base_url: Optional[str] = Field(default=os.getenv("OPENAI_BASE_URL") or None)  # proxy / server compatible
+    timeout: float = Field(default=float(os.getenv("OPENAI_TIMEOUT", "20") or 20))  # s por llamada
+    max_concurrency: int = Field(default=int(os.getenv("OPENAI_MAX_CONCURRENCY", "64") or 64))  # llamadas en vuelo
+
+CONFIG = OpenAIConfig()
+
+# Cliente y limitador por event loop: el pool de httpx y el semáforo quedan
+# atados al loop donde se usan (uvicorn tiene uno; los tests pueden abrir varios).
+_PER_LOOP: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, tuple]" = weakref.WeakKeyDictionary()
+
+def _loop_state() -> Optional[tuple]:
+    if not CONFIG.api_key:
+        return None
+    loop = asyncio.get_running_loop()
+    st = _PER_LOOP.get(loop)
+    if st is None:
+        client = AsyncOpenAI(api_key=CONFIG.api_key, base_url=CONFIG.base_url,
+                             timeout=CONFIG.timeout, max_retries=1)
+        st = _PER_LOOP[loop] = (client, asyncio.Semaphore(CONFIG.max_concurrency))
+    return st
+
+def available() -> bool:
+    return bool(CONFIG.api_key)
+
+async def chat_json(model: str, messages: List[Dict[str, Any]], temperature: float,
+                    timeout: Optional[float] = None) -> str:
+    """
+    Una llamada a chat.completions con el cliente compartido, respetando el
+    tope de llamadas concurrentes. Devuelve el texto; los errores de la API
+    (incluido APITimeoutError) se propagan para que cada caller haga su fallback.
+    """
+    client, limiter = _loop_state()
+    async with limiter:
+        resp = await client.chat.completions.create(
+            model=model, temperature=temperature, messages=messages,
+            timeout=CONFIG.timeout if timeout is None else timeout,
+        )
+    return resp.choices[0].message.content
+
+async def stream_chat(model: str, messages: List[Dict[str, Any]], temperature: float,
+                      timeout: Optional[float] = None) -> AsyncIterator[str]:
+    """
+    Igual que chat_json pero en streaming: va entregando los deltas de texto.
+    El cupo del limitador se ocupa hasta que el stream termina (o se cierra).
+    """
+    client, limiter = _loop_state()
+    async with limiter:
+        stream = await client.chat.completions.create(
+            model=model, temperature=temperature, messages=messages, stream=True,
+            timeout=CONFIG.timeout if timeout is None else timeout,
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+
+def reset() -> None:
+    """Olvida clientes creados (p.ej. tras cambiar CONFIG)."""
+    _PER_LOOP.clear()
@@ -0,0 +1,153 @@
+from __future__ import annotations
+import asyncio, copy, hashlib, json, logging, os, re, sqlite3, threading, time, unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv(override=False)
+log = logging.getLogger(__name__)
+
+# Campos del estado que cambian la decisión del planner (además del texto). La
+# pregunta pendiente y las necesidades previas también van al prompt: sin ellas,
+# un "70 mm" tras una misma pregunta genérica compartiría plan entre sesiones
+# distintas. `need_history` entra resumido (ver `_prior_needs`).
+KEY_FIELDS = ("asked_questions", "answered_slots", "rejected_families", "rejected_options", "force_more",
+              "pending_question")
+
+def _norm_text(s: str) -> str:
+    s = unicodedata.normalize("NFKD", (s or "").lower()).encode("ascii", "ignore").decode()
+    s = re.sub(r"[^\w\s/.,°\"-]", " ", s)
+    return re.sub(r"\s+", " ", s).strip()
+
+def _prior_needs(history: Any, user_text: str) -> str:
+    """
+    Necesidades anteriores al texto actual, normalizadas, sin repetidos y
+    ordenadas, como hash corto ("" si no hay). Así una apertura (historial =
+    sólo ese texto) o una necesidad repetida no parten la clave.
+    """
+    text = _norm_text(user_text)
+    needs = {_norm_text(str(x)) for x in (history or [])} - {"", text}
+    if not needs:
+        return ""
+    return hashlib.sha1("\n".join(sorted(needs)).encode("utf-8")).hexdigest()[:16]
+
+def plan_key(user_text: str, state: Dict[str, Any], salt: str = "") -> str:
+    """
+    Clave estable: texto normalizado + campos relevantes del estado. `salt`
+    (prompt + modelo) invalida lo persistido cuando cambia el prompt.
+    """
+    payload = {"text": _norm_text(user_text), "salt": salt,
+               "prior_needs": _prior_needs(state.get("need_history"), user_text)}
+    for k in KEY_FIELDS:
+        v = state.get(k)
+        if isinstance(v, dict):
+            v = {str(a): str(b) for a, b in sorted(v.items())}
+        elif isinstance(v, (list, tuple)):
+            v = [_norm_text(str(x)) for x in v]
+        elif isinstance(v, str):
+            v = _norm_text(v)
+        payload[k] = v
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+class PlanCache:
+    """
+    LRU + TTL de decisiones del planner. Con `path`, además persiste en SQLite
+    (WAL) para que las aperturas repetidas sobrevivan a un reinicio: en memoria
+    miss → se busca en disco. Los valores se devuelven copiados (el turno muta).
+    """
+    def __init__(self, maxsize: int = 2000, ttl: float = 86400.0, path: Optional[str] = None,
+                 clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path or None
+        self._clock = clock
+        self._data: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()  # key → (expira, plan)
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.hits = self.misses = self.disk_hits = 0
+        if self.path and self.maxsize > 0:
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS plans (key TEXT PRIMARY KEY, expires REAL, value TEXT)")
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        now = self._clock()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._data[key]
+                entry = None
+            if entry is None and self._db is not None:
+                row = self._db.execute("SELECT expires, value FROM plans WHERE key = ?", (key,)).fetchone()
+                if row and row[0] > now:
+                    entry = (row[0], json.loads(row[1]))
+                    self._remember(key, entry)
+                    self.disk_hits += 1
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+    def _peek(self, key: str) -> bool:
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] > self._clock()
+
+    async def aget(self, key: str) -> Optional[Dict[str, Any]]:
+        """get desde el event loop: si hay que ir a SQLite, en un hilo."""
+        if self._db is None or self._peek(key):
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, plan: Dict[str, Any]) -> None:
+        if self._db is None:
+            return self.put(key, plan)
+        await asyncio.to_thread(self.put, key, plan)
+
+    def put(self, key: str, plan: Dict[str, Any]) -> None:
+        if not self.enabled:
+            return
+        entry = (self._clock() + self.ttl, copy.deepcopy(plan))
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                try:
+                    self._db.execute("INSERT OR REPLACE INTO plans (key, expires, value) VALUES (?, ?, ?)",
+                                     (key, entry[0], json.dumps(entry[1], ensure_ascii=False)))
+                except sqlite3.Error as e:
+                    log.warning("[PLAN_CACHE] no pude persistir: %s", e)
+
+    def _remember(self, key: str, entry: Tuple[float, Dict[str, Any]]) -> None:
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def purge_expired(self) -> int:
+        """Borra del disco lo vencido (para correr cada tanto)."""
+        if self._db is None:
+            return 0
+        with self._lock:
+            return self._db.execute("DELETE FROM plans WHERE expires <= ?", (self._clock(),)).rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses, "disk_hits": self.disk_hits,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+PLAN_CACHE = PlanCache(
+    maxsize=int(os.getenv("PLAN_CACHE_SIZE", "2000") or 0),
+    ttl=float(os.getenv("PLAN_CACHE_TTL", "86400") or 86400),
+    path=os.getenv("PLAN_CACHE_PATH") or None,
+)
@@ -22,7 +22,7 @@ def score(item: Dict[str, Any], must: List[str], nots: List[str]) -> float:
     if _qty(item) > 0: s += 1.5
     return s
 
-def rank_and_cut(items: List[Dict[str, Any]], must_tokens: List[str], not_tokens: List[str]) -> List[Dict[str, Any]]:
+def _dedup(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     # dedup por default_code
     seen = set(); uniq: List[Dict[str, Any]] = []
     for it in items:
@@ -30,6 +30,23 @@ def rank_and_cut(items: List[Dict[str, Any]], must_tokens: List[str], not_tokens
         if code in seen: 
             continue
         seen.add(code); uniq.append(it)
+    return uniq
+
+def prerank(items: List[Dict[str, Any]], must_tokens: List[str], not_tokens: List[str], k: int) -> List[Dict[str, Any]]:
+    """
+    Fase 1: mismo score que rank_and_cut pero con el stock del CSV, y corte a
+    los k mejores (orden estable). Sólo esos k se hidratan en Odoo; si el stock
+    del CSV coincide con el vivo, el top-4 final es idéntico al de rankear todo.
+    """
+    uniq = _dedup(items)
+    if len(uniq) <= k:
+        return uniq
+    scored = sorted(((score(it, must_tokens, not_tokens), i) for i, it in enumerate(uniq)),
+                    key=lambda x: x[0], reverse=True)
+    return [uniq[i] for _, i in scored[:k]]
+
+def rank_and_cut(items: List[Dict[str, Any]], must_tokens: List[str], not_tokens: List[str]) -> List[Dict[str, Any]]:
+    uniq = _dedup(items)
     scored = [(score(it, must_tokens, not_tokens), it) for it in uniq]
     scored.sort(key=lambda x: x[0], reverse=True)
     # devolvemos 2–4 items con umbral básico
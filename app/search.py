@@ -1,6 +1,14 @@
 from __future__ import annotations
-import csv, os, unicodedata, re
-from typing import List, Dict, Any, Iterable, Tuple
+import csv, logging, os, sys, threading, time, unicodedata, re
+from array import array
+from contextlib import nullcontext
+from typing import List, Dict, Any, Iterable, Tuple, Optional, Callable
+
+from .catalog_snapshot import (MmapPostings, MmapStrings, build_lock, pack_strings,
+                               read_snapshot, source_key, unpack_strings, write_snapshot)
+from .odoo_client import hydrate_candidates
+
+log = logging.getLogger(__name__)
 
 def _norm(s: str) -> str:
     s = unicodedata.normalize("NFKD", s).encode("ascii","ignore").decode()
@@ -19,19 +27,249 @@ def _tokenize(s: str) -> List[str]:
             seen.add(t); out.append(t)
     return out
 
+# Índice de n-gramas de caracteres (1..3) sobre name/code normalizados.
+# Tokens de hasta 3 caracteres se resuelven directo con su posting (exacto);
+# los más largos toman el trigrama más raro como candidatos y se verifican
+# con `tok in name or tok in code`, igual que el recorrido lineal.
+_NGRAM_MAX = 3
+_MATCH_CACHE_MAX = 512
+
+def _ngrams(s: str) -> set:
+    out = set()
+    for n in range(1, _NGRAM_MAX + 1):
+        out.update(s[i:i+n] for i in range(len(s) - n + 1))
+    return out
+
+# Bitsets empaquetados sobre ids de fila: un int de Python con el bit i
+# prendido si la fila i matchea. AND/OR/NOT corren en C sobre palabras de
+# máquina, así cada variante son unas pocas operaciones vectoriales.
+def _ids_to_bits(ids: Iterable[int], n: int) -> int:
+    buf = bytearray((n + 7) // 8)
+    for i in ids:
+        buf[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(buf, "little")
+
+def _bits_to_ids(bits: int) -> List[int]:
+    out: List[int] = []
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for k, b in enumerate(data):
+        if b:
+            base = k << 3
+            out.extend(base + j for j in range(8) if b >> j & 1)
+    return out
+
+def _at_least(sets: List[int], k: int) -> int:
+    """Bits presentes en al menos k de los sets (contador saturado bit a bit)."""
+    levels = [0] * k            # levels[j] = filas con >= j+1 hits
+    for b in sets:
+        for j in range(k - 1, 0, -1):
+            levels[j] |= levels[j - 1] & b
+        levels[0] |= b
+    return levels[k - 1]
+
+# Columnas numéricas (array de doubles); el resto son strings internados.
+_NUM_FIELDS = ("qty_available", "list_price")
+
+def _to_float(x: Any) -> float:
+    try:
+        return float(str(x).replace(",", ".")) if x not in (None, "") else 0.0
+    except ValueError:
+        return 0.0
+
+def _read_csv_columns(csv_path: str) -> Tuple[List[str], Dict[str, List[str]], Dict[str, array]]:
+    """
+    CSV → columnas: (orden de campos, columnas de texto, columnas numéricas).
+    Incluye `_norm_name`/`_norm_code`. Strings internados: categorías, uom y
+    códigos que no cambian al normalizar se comparten entre filas.
+    """
+    with open(csv_path, newline='', encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        fields = [h for h in header if h]
+        idx = [header.index(h) for h in fields]
+        text: Dict[str, List[str]] = {h: [] for h in fields if h not in _NUM_FIELDS}
+        nums: Dict[str, array] = {h: array("d") for h in fields if h in _NUM_FIELDS}
+        cols = [(text.get(h), nums.get(h), k) for h, k in zip(fields, idx)]
+        k_name = header.index("name") if "name" in header else None
+        k_code = header.index("default_code") if "default_code" in header else None
+        norm_name: List[str] = []
+        norm_code: List[str] = []
+        intern = sys.intern
+        for rec in reader:
+            if not rec:
+                continue
+            for tcol, ncol, k in cols:
+                v = rec[k] if k < len(rec) else ""
+                if ncol is not None:
+                    ncol.append(_to_float(v))
+                else:
+                    tcol.append(intern(v))
+            name = rec[k_name] if k_name is not None and k_name < len(rec) else ""
+            code = rec[k_code] if k_code is not None and k_code < len(rec) else ""
+            norm_name.append(intern(_norm(name)))
+            norm_code.append(intern(_norm(code)))
+    text["_norm_name"] = norm_name
+    text["_norm_code"] = norm_code
+    return fields, text, nums
+
 class LocalCatalog:
-    def __init__(self, csv_path: str):
+    """
+    Catálogo en columnas: una lista por campo de texto, arrays de doubles para
+    `qty_available`/`list_price` e ids de fila (posición). Las búsquedas
+    trabajan con ids; los dicts se materializan sólo con `rows_for()` para lo
+    que llega al ranking/salida.
+    """
+    def __init__(self, csv_path: str, snapshot_path: Optional[str] = None, use_snapshot: bool = True,
+                 shared: bool = False):
+        """
+        Carga el catálogo. Con `use_snapshot`, intenta primero el snapshot
+        binario (por defecto `<csv>.snap`) y sólo re-parsea el CSV y rearma el
+        índice si el CSV cambió; en ese caso regenera el snapshot (un solo
+        proceso a la vez, ver `build_lock`).
+        Con `shared`, columnas e índice se leen directo del mmap del snapshot:
+        todos los workers comparten las mismas páginas y cada uno sólo suma
+        sus caches.
+        """
         if not os.path.exists(csv_path):
             raise FileNotFoundError(f"Catálogo no encontrado: {csv_path}")
-        self.rows: List[Dict[str, Any]] = []
-        with open(csv_path, newline='', encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for r in reader:
-                r["_norm_name"] = _norm(r.get("name",""))
-                r["_norm_code"] = _norm(r.get("default_code",""))
-                self.rows.append(r)
-
-    def search(self, q: Dict[str, Any]) -> List[Dict[str, Any]]:
+        self.csv_path = csv_path
+        self.snapshot_path = snapshot_path or f"{csv_path}.snap"
+        self.shared = shared
+        use_snapshot = use_snapshot or shared
+        self._postings: Any = {}
+
+        if use_snapshot and self._load_snapshot():
+            self._reset_caches()
+            return
+        with build_lock(self.snapshot_path) if use_snapshot else nullcontext():
+            # otro worker pudo haberlo construido mientras esperábamos el lock
+            if use_snapshot and self._load_snapshot():
+                self._reset_caches()
+                return
+            self._fields, self._text, self._nums = _read_csv_columns(csv_path)
+            self._n = len(self._text["_norm_name"])
+            self._build_index()
+            if use_snapshot:
+                self._save_snapshot()
+                if shared and not self._load_snapshot():
+                    log.warning("[SNAPSHOT] modo compartido sin snapshot; uso copia privada")
+        self._reset_caches()
+
+    def __len__(self) -> int:
+        return self._n
+
+    def row(self, i: int) -> Dict[str, Any]:
+        out: Dict[str, Any] = {}
+        for k in self._fields:
+            col = self._nums.get(k)
+            out[k] = col[i] if col is not None else self._text[k][i]
+        return out
+
+    def rows_for(self, ids: Iterable[int]) -> List[Dict[str, Any]]:
+        return [self.row(i) for i in ids]
+
+    def _build_index(self) -> None:
+        """
+        n-grama → posting list (array de ids de fila ascendentes). Los n-gramas
+        se calculan por campo, así ninguno cruza el límite name/code y el
+        posting de un token corto coincide exactamente con `tok in name/code`.
+        """
+        postings: Dict[str, List[int]] = {}
+        for i, (name, code) in enumerate(zip(self._text["_norm_name"], self._text["_norm_code"])):
+            for g in _ngrams(name) | _ngrams(code):
+                plist = postings.get(g)
+                if plist is None:
+                    postings[g] = [i]
+                else:
+                    plist.append(i)
+        self._postings = {g: array("I", p) for g, p in postings.items()}
+
+    def _reset_caches(self) -> None:
+        self._all_bits = (1 << self._n) - 1
+        self._match_cache: Dict[str, int] = {}
+
+    # ---- snapshot binario (ver app/catalog_snapshot.py) ----
+    def _save_snapshot(self) -> None:
+        sections: Dict[str, Any] = {}
+        for k, col in self._text.items():
+            sections[f"text:{k}"], sections[f"text_off:{k}"] = pack_strings(list(col))
+        sections.update({f"num:{k}": col for k, col in self._nums.items()})
+        grams = sorted(self._postings.keys())
+        offsets = array("I", [0])
+        ids = array("I")
+        for g in grams:
+            ids.extend(self._postings[g])
+            offsets.append(len(ids))
+        sections["grams"], sections["gram_off"] = pack_strings(grams)
+        sections["post_offsets"] = offsets
+        sections["post_ids"] = ids
+        meta = {"rows": self._n, "fields": self._fields,
+                "text": list(self._text.keys()), "num": list(self._nums.keys())}
+        try:
+            write_snapshot(self.snapshot_path, source_key(self.csv_path), meta, sections)
+        except OSError as e:
+            log.warning("[SNAPSHOT] no se pudo escribir %s: %s", self.snapshot_path, e)
+
+    def _load_snapshot(self) -> bool:
+        snap = read_snapshot(self.snapshot_path, self.csv_path)
+        if snap is None:
+            return False
+        meta, sec = snap
+        n = int(meta.get("rows", 0))
+        text_keys = meta.get("text") or []
+
+        self._fields = list(meta.get("fields") or [])
+        # columnas numéricas y posting lists: vistas sobre el mmap, sin copiar
+        self._nums = {k: sec[f"num:{k}"] for k in meta.get("num") or []}
+        self._n = n
+        off, ids = sec["post_offsets"], sec["post_ids"]
+        if self.shared:
+            self._text = {k: MmapStrings(sec[f"text:{k}"], sec[f"text_off:{k}"]) for k in text_keys}
+            self._postings = MmapPostings(MmapStrings(sec["grams"], sec["gram_off"]), off, ids)
+        else:
+            intern = sys.intern
+            self._text = {k: [intern(x) for x in unpack_strings(sec[f"text:{k}"], n)] for k in text_keys}
+            grams = unpack_strings(sec["grams"], len(off) - 1)
+            self._postings = {g: ids[off[k]:off[k + 1]] for k, g in enumerate(grams)}
+        return all(len(col) == n for col in self._text.values())
+
+    def _match(self, tok: str, stats: Optional[Dict[str, int]] = None) -> int:
+        """
+        Bitset de filas cuyo name/code contienen `tok` como subcadena (misma
+        semántica que el recorrido lineal). Cache acotado; `stats["verified"]`
+        suma los candidatos que hubo que verificar por subcadena.
+        """
+        hit = self._match_cache.get(tok)
+        if hit is not None:
+            return hit
+        n = self._n
+        if not tok:
+            out = self._all_bits
+        elif len(tok) <= _NGRAM_MAX:
+            out = _ids_to_bits(self._postings.get(tok, ()), n)
+        else:
+            grams = {tok[i:i+_NGRAM_MAX] for i in range(len(tok) - _NGRAM_MAX + 1)}
+            cands = min((self._postings.get(g, ()) for g in grams), key=len)
+            if stats is not None:
+                stats["verified"] = stats.get("verified", 0) + len(cands)
+            names, codes = self._text["_norm_name"], self._text["_norm_code"]
+            out = _ids_to_bits((i for i in cands if tok in names[i] or tok in codes[i]), n)
+        if len(self._match_cache) >= _MATCH_CACHE_MAX:
+            self._match_cache.clear()
+        self._match_cache[tok] = out
+        return out
+
+    @staticmethod
+    def _parse_query(q: Dict[str, Any]) -> Tuple[List[str], List[str], Optional[str], int]:
+        tokens = [_norm(t) for t in q.get("tokens", []) if t]
+        nots   = [_norm(t) for t in q.get("not", []) if t]
+        family = _norm(q.get("family","")) if q.get("family") else None
+
+        needed = len(tokens)
+        min_hits = 2 if needed >= 3 else needed
+        return tokens, nots, family, min_hits
+
+    def search(self, q: Dict[str, Any], stats: Optional[Dict[str, int]] = None) -> List[Dict[str, Any]]:
         """
         q = { "tokens": ["..."], "not": ["..."], "family": "..." }
         AND suave (sin reglas por rubro):
@@ -39,18 +277,83 @@ class LocalCatalog:
           - 1–2 tokens  → pedimos todas.
         NOT fuerte: si aparece en name/code, se descarta.
         family, si viene, se usa como SUBCADENA literal (no hay mapeos).
+        Resuelto con el índice de n-gramas y bitsets por token: el AND suave es
+        un contador bit a bit, NOT una máscara y family un AND.
+        Si se pasa `stats`, acumula "verified" (candidatos chequeados por
+        subcadena) y "returned" (filas devueltas).
         """
-        tokens = [_norm(t) for t in q.get("tokens", []) if t]
-        nots   = [_norm(t) for t in q.get("not", []) if t]
-        family = _norm(q.get("family","")) if q.get("family") else None
+        return self.rows_for(self.search_ids(q, stats))
 
-        needed = len(tokens)
-        min_hits = 2 if needed >= 3 else needed
+    def search_ids(self, q: Dict[str, Any], stats: Optional[Dict[str, int]] = None) -> List[int]:
+        """Como `search`, pero devuelve ids de fila (sin materializar dicts)."""
+        return self._search_ids(q, lambda t: self._match(t, stats), stats)
+
+    def search_many(self, variants: List[Dict[str, Any]], limit: Optional[int] = None,
+                    stats: Optional[Dict[str, int]] = None) -> List[List[Dict[str, Any]]]:
+        """Como `search_many_ids`, materializando los dicts de cada variante."""
+        return [self.rows_for(ids) for ids in self.search_many_ids(variants, limit, stats)]
+
+    def search_many_ids(self, variants: List[Dict[str, Any]], limit: Optional[int] = None,
+                        stats: Optional[Dict[str, int]] = None) -> List[List[int]]:
+        """
+        Evalúa varias variantes en una pasada: cada token distinto (tokens, not,
+        family) se resuelve UNA vez y todas las variantes reusan esos sets.
+        Devuelve los ids por variante, en el mismo orden. Con `limit`, corta
+        como el orquestador: cuando los hits acumulados llegan a `limit`, las
+        variantes restantes no se evalúan y quedan como [].
+        """
+        memo: Dict[str, int] = {}
+
+        def match(t: str) -> int:
+            got = memo.get(t)
+            if got is None:
+                got = memo[t] = self._match(t, stats)
+            return got
+
+        out: List[List[int]] = []
+        total = 0
+        for vq in variants:
+            if limit is not None and total >= limit:
+                out.append([])
+                continue
+            ids = self._search_ids(vq, match, stats)
+            total += len(ids)
+            out.append(ids)
+        return out
 
-        out: List[Dict[str, Any]] = []
-        for r in self.rows:
-            name = r["_norm_name"]; code = r["_norm_code"]
+    def _search_ids(self, q: Dict[str, Any], match: Callable[[str], int],
+                    stats: Optional[Dict[str, int]] = None) -> List[int]:
+        tokens, nots, family, min_hits = self._parse_query(q)
 
+        if not tokens:
+            bits = self._all_bits
+        elif min_hits == len(tokens):
+            bits = self._all_bits
+            for t in tokens:
+                bits &= match(t)
+                if not bits:
+                    break
+        else:
+            bits = _at_least([match(t) for t in tokens], min_hits)
+
+        if bits and family:
+            bits &= match(family)
+        for n in nots:
+            if not bits:
+                break
+            bits &= ~match(n)
+
+        ids = _bits_to_ids(bits)
+        if stats is not None:
+            stats["returned"] = stats.get("returned", 0) + len(ids)
+        return ids
+
+    def scan(self, q: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Recorrido lineal original (referencia para tests y benchmarks)."""
+        tokens, nots, family, min_hits = self._parse_query(q)
+
+        out: List[int] = []
+        for i, (name, code) in enumerate(zip(self._text["_norm_name"], self._text["_norm_code"])):
             if any(n in name or n in code for n in nots):
                 continue
 
@@ -61,8 +364,100 @@ class LocalCatalog:
             if family and (family not in name and family not in code):
                 continue
 
-            out.append(r)
-        return out
+            out.append(i)
+        return self.rows_for(out)
+
+class ReloadingCatalog:
+    """
+    Contenedor de un LocalCatalog que se puede recargar en caliente.
+    Un hilo (opcional) consulta size/mtime del CSV cada `poll_interval` s; si
+    cambió, arma el catálogo nuevo en segundo plano y lo reemplaza con una
+    sola asignación. Quien tomó `current()` sigue usando su versión hasta
+    terminar (un /chat en curso no mezcla ids de dos catálogos).
+    Con varios workers, `request_reload()` escribe una marca en `<csv>.reload`;
+    el poll de cada proceso la ve y fuerza su propia recarga.
+    """
+    def __init__(self, csv_path: str, poll_interval: float = 0.0, **catalog_kwargs: Any):
+        self.csv_path = csv_path
+        self._kwargs = catalog_kwargs
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._current = LocalCatalog(csv_path, **catalog_kwargs)
+        self.marker_path = f"{csv_path}.reload"
+        self._seen = source_key(csv_path, with_hash=False)
+        self._seen_mark = self._read_mark()
+        self.version = 1
+        self.last_reload: Dict[str, Any] = {"version": 1, "rows": len(self._current)}
+        self._thread: Optional[threading.Thread] = None
+        if poll_interval > 0:
+            self._thread = threading.Thread(target=self._poll, args=(poll_interval,),
+                                            name="catalog-reload", daemon=True)
+            self._thread.start()
+
+    def current(self) -> LocalCatalog:
+        return self._current
+
+    def __getattr__(self, name: str) -> Any:
+        # compat: CATALOG.search(...) etc. van al catálogo vigente
+        return getattr(self._current, name)
+
+    def __len__(self) -> int:
+        return len(self._current)
+
+    def _read_mark(self) -> Optional[str]:
+        try:
+            with open(self.marker_path, "r", encoding="utf-8") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def request_reload(self) -> str:
+        """Pide la recarga a todos los procesos que comparten el CSV (escritura atómica)."""
+        mark = f"{time.time_ns()}-{os.getpid()}"
+        tmp = f"{self.marker_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(mark)
+        os.replace(tmp, self.marker_path)
+        return mark
+
+    def reload(self, force: bool = False) -> Dict[str, Any]:
+        """
+        Recarga si el CSV o la marca de `request_reload` cambiaron (o siempre,
+        con `force`). Devuelve
+        {"reloaded", "version", "rows", "build_s"}; un error de carga deja el
+        catálogo anterior y se informa en "error".
+        """
+        with self._lock:
+            try:
+                key = source_key(self.csv_path, with_hash=False)
+            except OSError as e:
+                return {"reloaded": False, "version": self.version, "error": str(e)}
+            mark = self._read_mark()
+            if not force and key == self._seen and mark == self._seen_mark:
+                return {"reloaded": False, "version": self.version, "rows": len(self._current)}
+            t0 = time.perf_counter()
+            try:
+                fresh = LocalCatalog(self.csv_path, **self._kwargs)
+            except (OSError, ValueError, csv.Error) as e:
+                log.warning("[CATALOG] recarga falló, sigo con v%s: %s", self.version, e)
+                return {"reloaded": False, "version": self.version, "error": str(e)}
+            build_s = round(time.perf_counter() - t0, 4)
+            self._current = fresh
+            self._seen, self._seen_mark = key, mark
+            self.version += 1
+            self.last_reload = {"version": self.version, "rows": len(fresh), "build_s": build_s}
+            log.info("[CATALOG] v%s: %s filas en %.3fs", self.version, len(fresh), build_s)
+            return {"reloaded": True, **self.last_reload}
+
+    def _poll(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            try:
+                self.reload()
+            except Exception as e:  # el hilo no debe morir por un CSV a medio escribir
+                log.warning("[CATALOG] poll: %s", e)
+
+    def close(self) -> None:
+        self._stop.set()
 
 # Variantes genéricas (sin sinónimos)
 def _variants_from_tokens(tokens: List[str]) -> Iterable[List[str]]:
@@ -147,6 +542,7 @@ def build_query_variants(plan: Dict[str, Any], target: int = 30) -> List[Dict[st
 
     return variants[:target]
 
-# Stub de hidratación Odoo (opcional)
-def hydrate_in_odoo(candidates: List[Dict[str, Any]], odoo_cfg: Dict[str,str]|None):
-    return candidates
+# Hidratación Odoo (opcional, ODOO_HYDRATE): precio/stock vía cache TTL + search_read
+def hydrate_in_odoo(candidates: List[Dict[str, Any]], odoo_cfg: Dict[str,str]|None = None):
+    # las credenciales salen de app.settings; odoo_cfg queda por compatibilidad
+    return hydrate_candidates(candidates)
@@ -0,0 +1,282 @@
+from __future__ import annotations
+import abc, asyncio, logging, sqlite3, threading, time, uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Generic, List, Optional, Tuple, Type, TypeVar
+
+from pydantic import BaseModel
+
+log = logging.getLogger(__name__)
+
+S = TypeVar("S", bound=BaseModel)
+
+class SessionConflict(RuntimeError):
+    """Otro worker guardó la sesión entre nuestro `load` y nuestro `save`."""
+
+class SessionStore(abc.ABC, Generic[S]):
+    """
+    Estado de conversación por sesión. Un turno hace `load` → muta → `save`
+    (una lectura y una escritura). Las sesiones vencen tras `ttl` s sin turnos.
+    Desde código async usar `aload`/`asave`: los backends con I/O los corren
+    en un hilo para no frenar el event loop.
+    """
+    def __init__(self, factory: Type[S], ttl: float):
+        self.factory = factory
+        self.ttl = ttl
+        self.loads = self.saves = self.expired = 0
+
+    @abc.abstractmethod
+    def load(self, session: str) -> S:
+        ...
+
+    @abc.abstractmethod
+    def save(self, session: str, state: S) -> None:
+        ...
+
+    @abc.abstractmethod
+    def delete(self, session: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def __len__(self) -> int:
+        ...
+
+    async def aload(self, session: str) -> S:
+        return await asyncio.to_thread(self.load, session)
+
+    async def asave(self, session: str, state: S) -> None:
+        await asyncio.to_thread(self.save, session, state)
+
+    @asynccontextmanager
+    async def lease(self, session: str) -> AsyncIterator[None]:
+        """Exclusión entre procesos alrededor de un turno. En memoria no hace falta (un proceso)."""
+        yield
+
+    def pop(self, session: str, default: Any = None) -> Any:
+        """Compat con el dict de antes (reset desde el bridge)."""
+        self.delete(session)
+        return default
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": type(self).__name__, "size": len(self), "loads": self.loads,
+                "saves": self.saves, "expired": self.expired}
+
+class MemorySessionStore(SessionStore[S]):
+    """LRU + TTL en memoria (un proceso). Guarda el objeto vivo: sin serializar."""
+    def __init__(self, factory: Type[S], ttl: float = 21600.0, maxsize: int = 10000,
+                 clock: Callable[[], float] = time.monotonic):
+        super().__init__(factory, ttl)
+        self.maxsize = maxsize
+        self._clock = clock
+        self._data: "OrderedDict[str, Tuple[float, S]]" = OrderedDict()  # session → (vence, estado)
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def load(self, session: str) -> S:
+        now = self._clock()
+        with self._lock:
+            self.loads += 1
+            entry = self._data.get(session)
+            if entry is not None and entry[0] <= now:
+                del self._data[session]
+                self.expired += 1
+                entry = None
+            return entry[1] if entry is not None else self.factory()
+
+    def save(self, session: str, state: S) -> None:
+        with self._lock:
+            self.saves += 1
+            self._data[session] = (self._clock() + self.ttl, state)
+            self._data.move_to_end(session)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    async def aload(self, session: str) -> S:
+        return self.load(session)  # sin I/O: no vale la pena un hilo
+
+    async def asave(self, session: str, state: S) -> None:
+        self.save(session, state)
+
+    def delete(self, session: str) -> None:
+        with self._lock:
+            self._data.pop(session, None)
+
+    def purge_expired(self) -> int:
+        now = self._clock()
+        with self._lock:
+            dead = [k for k, (expires, _) in self._data.items() if expires <= now]
+            for k in dead:
+                del self._data[k]
+            self.expired += len(dead)
+            return len(dead)
+
+    def __len__(self) -> int:
+        self.purge_expired()  # no contar sesiones vencidas que nadie volvió a leer
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "evictions": self.evictions}
+
+class SQLiteSessionStore(SessionStore[S]):
+    """
+    Sesiones en SQLite (WAL), compartidas por todos los workers que apunten al
+    mismo archivo. El estado va como JSON compacto (sin campos en default).
+    Cada fila lleva `version`: `save` es un UPDATE condicional sobre la versión
+    que leyó el último `load` de esa sesión en este store, y si otro worker
+    escribió en el medio levanta SessionConflict en vez de pisarlo.
+    `lease` serializa los turnos de una sesión entre workers (fila en `leases`
+    tomada con BEGIN IMMEDIATE; vence sola a los `lease_ttl` s si el worker muere).
+    Lo vencido se borra cada `purge_every` escrituras.
+    """
+    def __init__(self, factory: Type[S], path: str, ttl: float = 21600.0, purge_every: int = 500,
+                 clock: Callable[[], float] = time.time, lease_ttl: float = 120.0, lease_poll: float = 0.02):
+        super().__init__(factory, ttl)
+        self.path = path
+        self.purge_every = purge_every
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._versions: Dict[str, int] = {}  # session → versión leída (-1 = no existía)
+        self.lease_ttl = lease_ttl
+        self.lease_poll = lease_poll
+        self.conflicts = self.lease_waits = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, expires REAL, state TEXT, "
+                         "version INTEGER NOT NULL DEFAULT 0)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS leases (id TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+        cols = {r[1] for r in self._db.execute("PRAGMA table_info(sessions)")}
+        if "version" not in cols:  # archivo de antes de versionar
+            self._db.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def load(self, session: str) -> S:
+        with self._lock:
+            self.loads += 1
+            row = self._db.execute("SELECT expires, state, version FROM sessions WHERE id = ?",
+                                   (session,)).fetchone()
+            self._versions[session] = row[2] if row else -1
+        if row is None:
+            return self.factory()
+        if row[0] <= self._clock():
+            self.expired += 1
+            return self.factory()
+        try:
+            return self.factory.model_validate_json(row[1])
+        except ValueError as e:
+            log.warning("[SESSIONS] estado ilegible para %s, empiezo de cero: %s", session, e)
+            return self.factory()
+
+    def save(self, session: str, state: S) -> None:
+        raw = state.model_dump_json(exclude_defaults=True)
+        with self._lock:
+            self.saves += 1
+            expires = self._clock() + self.ttl
+            seen = self._versions.pop(session, None)
+            if seen is None:  # sin load previo: escritura ciega (p.ej. scripts)
+                self._db.execute("INSERT INTO sessions (id, expires, state, version) VALUES (?, ?, ?, 1) "
+                                 "ON CONFLICT(id) DO UPDATE SET expires = excluded.expires, "
+                                 "state = excluded.state, version = sessions.version + 1",
+                                 (session, expires, raw))
+            elif seen < 0:  # no existía al leer: sólo si nadie la creó en el medio
+                done = self._db.execute("INSERT INTO sessions (id, expires, state, version) VALUES (?, ?, ?, 1) "
+                                        "ON CONFLICT(id) DO NOTHING", (session, expires, raw)).rowcount
+            else:
+                done = self._db.execute("UPDATE sessions SET expires = ?, state = ?, version = version + 1 "
+                                        "WHERE id = ? AND version = ?", (expires, raw, session, seen)).rowcount
+            if seen is not None and not done:
+                self.conflicts += 1
+                raise SessionConflict(session)
+            if self.purge_every and self.saves % self.purge_every == 0:
+                self._db.execute("DELETE FROM sessions WHERE expires <= ?", (self._clock(),))
+
+    def _try_lease(self, session: str, owner: str) -> bool:
+        now = self._clock()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")  # toma el lock de escritura de la base: chequeo+alta atómicos
+            try:
+                row = self._db.execute("SELECT owner, expires FROM leases WHERE id = ?", (session,)).fetchone()
+                free = row is None or row[1] <= now or row[0] == owner
+                if free:
+                    self._db.execute("INSERT OR REPLACE INTO leases (id, owner, expires) VALUES (?, ?, ?)",
+                                     (session, owner, now + self.lease_ttl))
+            finally:
+                self._db.execute("COMMIT")
+        return free
+
+    def _release(self, session: str, owner: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM leases WHERE id = ? AND owner = ?", (session, owner))
+
+    @asynccontextmanager
+    async def lease(self, session: str) -> AsyncIterator[None]:
+        owner = uuid.uuid4().hex
+        waited = False
+        while not await asyncio.to_thread(self._try_lease, session, owner):
+            if not waited:
+                waited = True
+                self.lease_waits += 1
+            await asyncio.sleep(self.lease_poll)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self._release, session, owner)
+
+    def delete(self, session: str) -> None:
+        with self._lock:
+            self._versions.pop(session, None)
+            self._db.execute("DELETE FROM sessions WHERE id = ?", (session,))
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._db.execute("DELETE FROM sessions WHERE expires <= ?", (self._clock(),)).rowcount
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM sessions WHERE expires > ?", (self._clock(),)).fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "conflicts": self.conflicts, "lease_waits": self.lease_waits}
+
+class SessionLocks:
+    """
+    Un asyncio.Lock por sesión: los turnos de un mismo usuario corren de a uno
+    y en orden de llegada (el Lock despierta a los que esperan en FIFO); los de
+    usuarios distintos siguen en paralelo. La entrada se borra cuando nadie la
+    usa, así el dict no crece con cada wa_id visto. Ordena dentro de un proceso;
+    entre workers (SESSION_BACKEND=sqlite) la exclusión la da `store.lease` y,
+    como red, el save condicional por versión.
+    """
+    def __init__(self):
+        self._locks: Dict[str, List] = {}  # session → [lock, turnos usando/esperando]
+        self.waits = 0
+
+    @asynccontextmanager
+    async def hold(self, session: str) -> AsyncIterator[None]:
+        entry = self._locks.get(session)
+        if entry is None:
+            entry = self._locks[session] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            if entry[0].locked():
+                self.waits += 1
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(session, None)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+def make_session_store(factory: Type[S], backend: str = "memory", path: Optional[str] = None,
+                       ttl: float = 21600.0, maxsize: int = 10000) -> SessionStore[S]:
+    backend = (backend or "memory").lower()
+    if backend == "sqlite":
+        if not path:
+            raise ValueError("SESSION_BACKEND=sqlite requiere SESSION_DB_PATH")
+        return SQLiteSessionStore(factory, path, ttl=ttl)
+    if backend != "memory":
+        raise ValueError(f"SESSION_BACKEND desconocido: {backend!r} (memory | sqlite)")
+    return MemorySessionStore(factory, ttl=ttl, maxsize=maxsize)
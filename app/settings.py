@@ -1,10 +1,11 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
 class Settings(BaseModel):
+    model_config = ConfigDict(protected_namespaces=())
     # OpenAI
     openai_api_key: str = os.getenv("OPENAI_API_KEY", "")
     # Compatibilidad con ambos nombres
@@ -14,11 +15,23 @@ class Settings(BaseModel):
         or "gpt-4o"
     )
 
-    # Catlogo local
+    # Catálogo local
     catalog_path: str = os.getenv("CATALOG_PATH", "./catalog.json")
     max_return: int = int(os.getenv("MAX_RETURN", "4"))
     min_return: int = int(os.getenv("MIN_RETURN", "2"))
 
+    # Odoo (opcional; acepta ODOO_USERNAME u ODOO_USER)
+    odoo_hydrate: bool = os.getenv("ODOO_HYDRATE", "false").lower() in ("1", "true", "yes")
+    odoo_url: str = (os.getenv("ODOO_URL", "") or "").rstrip("/")
+    odoo_db: str = os.getenv("ODOO_DB", "")
+    odoo_user: str = os.getenv("ODOO_USERNAME") or os.getenv("ODOO_USER") or ""
+    odoo_password: str = os.getenv("ODOO_PASSWORD", "")
+    # Cache de hidratación por default_code (TTL en segundos; 0 = sin cache)
+    odoo_cache_size: int = int(os.getenv("ODOO_CACHE_SIZE", "5000"))
+    odoo_price_ttl: float = float(os.getenv("ODOO_PRICE_TTL", "300"))
+    odoo_stock_ttl: float = float(os.getenv("ODOO_STOCK_TTL", "60"))
+    odoo_negative_ttl: float = float(os.getenv("ODOO_NEGATIVE_TTL", "600"))
+
     # Flujo
     min_pre_questions_before_search: int = int(os.getenv("MIN_PRE_QUESTIONS_BEFORE_SEARCH", "1"))
     postsearch_ask_if_results_gt: int = int(os.getenv("POSTSEARCH_ASK_IF_RESULTS_GT", "3"))
@@ -0,0 +1,148 @@
+from __future__ import annotations
+import json, math, re
+from typing import Any, Callable, Dict, List, Optional
+
+try:  # tokenizer real si está instalado; si no, heurística por caracteres
+    import tiktoken
+except ImportError:  # pragma: no cover - dependencia opcional
+    tiktoken = None
+
+_ENCODINGS: Dict[str, Any] = {}  # modelo → encoding (o None si no se pudo cargar)
+
+def load_encoding(model: str):
+    """
+    Carga el encoding una vez por modelo. La primera vez tiktoken puede bajar el
+    archivo BPE (red, bloqueante): desde async, llamarla con asyncio.to_thread.
+    """
+    if tiktoken is None:
+        return None
+    if model not in _ENCODINGS:
+        try:
+            enc = tiktoken.encoding_for_model(model)
+        except Exception:  # modelo desconocido o sin el archivo BPE (sin red)
+            try:
+                enc = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                enc = None
+        _ENCODINGS[model] = enc
+    return _ENCODINGS[model]
+
+def encoding_ready(model: str) -> bool:
+    """True si contar tokens para `model` ya no toca disco ni red."""
+    return tiktoken is None or model in _ENCODINGS
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """Tokens de `text` con tiktoken; sin él, ~4 caracteres por token."""
+    enc = load_encoding(model)
+    if enc is not None:
+        return len(enc.encode(text or ""))
+    return math.ceil(len(text or "") / 4)
+
+def state_tokens(state: Dict[str, Any], model: str = "gpt-4o-mini") -> int:
+    return count_tokens(json.dumps(state, ensure_ascii=False), model)
+
+# listas que crecen con la conversación → cuántas quedan completas
+RECENT = {"asked_questions": 3, "need_history": 4, "rejected_families": 10, "rejected_options": 10}
+STEM_CHARS = 60
+SUMMARY_CHARS = 160
+
+def _dedup(items) -> List[str]:
+    """Sin repetidos, quedándose con la última aparición (el orden importa: lo reciente al final)."""
+    out: List[str] = []
+    for x in reversed(list(items or [])):
+        x = str(x).strip()
+        if x and x not in out:
+            out.append(x)
+    return out[::-1]
+
+def _stem(q: str) -> str:
+    """Pregunta sin las opciones: '¿Qué tipo de taladro? (a | b)' → '¿Qué tipo de taladro?'."""
+    q = re.sub(r"\s*\([^)]*\|[^)]*\)\s*", " ", q).strip()
+    return q if len(q) <= STEM_CHARS else q[:STEM_CHARS - 1].rstrip() + "…"
+
+def compact_state(state: Dict[str, Any], budget: int, model: str = "gpt-4o-mini") -> Dict[str, Any]:
+    """
+    Estado para el prompt del planner dentro de `budget` tokens (0 = sin tope):
+      1) listas sin repetidos y recortadas a lo reciente (RECENT);
+      2) preguntas viejas → `asked_before` (sólo el enunciado, sin opciones),
+         pedidos viejos → `need_summary` (texto corrido y truncado);
+      3) si todavía no entra, se va soltando lo más viejo hasta que entre
+         (los rechazos, recién al final).
+    No toca `state`: el sanitizado del planner sigue usando el estado completo.
+    """
+    out = dict(state)
+    for k in RECENT:
+        if k in out:
+            out[k] = _dedup(out.get(k))
+    if budget <= 0 or state_tokens(out, model) <= budget:
+        return out
+
+    asked = out.get("asked_questions") or []
+    keep = RECENT["asked_questions"]
+    if len(asked) > keep:
+        out["asked_before"] = _dedup(_stem(q) for q in asked[:-keep])
+        out["asked_questions"] = asked[-keep:]
+    needs = out.get("need_history") or []
+    keep = RECENT["need_history"]
+    if len(needs) > keep:
+        summary = " / ".join(needs[:-keep])
+        out["need_summary"] = summary if len(summary) <= SUMMARY_CHARS else "…" + summary[-(SUMMARY_CHARS - 1):]
+        out["need_history"] = needs[-keep:]
+    for k in ("rejected_families", "rejected_options"):
+        if len(out.get(k) or []) > RECENT[k]:
+            out[k] = out[k][-RECENT[k]:]
+
+    # recortes en orden de sacrificio: primero lo resumido, después lo viejo de
+    # la charla y al final los rechazos (sin ellos el planner vuelve a ofrecer
+    # lo que el usuario ya descartó). Cada paso descuenta lo que sacó en vez de
+    # volver a serializar todo el estado; sólo se re-mide al llegar al tope.
+    def item_cost(x: Any) -> int:
+        return count_tokens(json.dumps(x, ensure_ascii=False) + ", ", model)
+
+    def drop_oldest(key: str, floor: int) -> Callable[[], int]:
+        def step() -> int:
+            if len(out.get(key) or []) <= floor:
+                return 0
+            cost = item_cost(out[key][0])
+            out[key] = out[key][1:]
+            if not out[key] and key not in state:  # resumen vacío: fuera
+                del out[key]
+                cost += count_tokens(f'"{key}": [], ', model)
+            return cost
+        return step
+
+    def drop_key(key: str) -> Callable[[], int]:
+        def step() -> int:
+            if key not in out:
+                return 0
+            return count_tokens(f'"{key}": ', model) + item_cost(out.pop(key))
+        return step
+
+    reducers = [drop_oldest("asked_before", 0), drop_key("need_summary"),
+                drop_oldest("need_history", 1), drop_oldest("asked_questions", 1),
+                drop_oldest("rejected_options", 0), drop_oldest("rejected_families", 0)]
+    total = state_tokens(out, model)
+    for reduce in reducers:
+        while total > budget:
+            cost = reduce()
+            if not cost:
+                break
+            total -= cost
+            if total <= budget:
+                total = state_tokens(out, model)  # confirma con la medida real
+    return out
+
+def prompt_tokens(messages: List[Dict[str, Any]], model: str = "gpt-4o-mini",
+                  cache: Optional[Dict[str, int]] = None) -> int:
+    """Tokens de los mensajes (contenido + ~4 de formato por mensaje)."""
+    total = 0
+    for m in messages:
+        content = m.get("content") or ""
+        if cache is not None and m.get("role") == "system":
+            if content not in cache:
+                cache[content] = count_tokens(content, model)
+            total += cache[content]
+        else:
+            total += count_tokens(content, model)
+        total += 4
+    return total
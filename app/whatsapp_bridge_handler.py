@@ -8,19 +8,19 @@ def _get_core():
     """
     from .main import ChatIn, chat  # tu lógica real de la demo por terminal
     try:
-        from .main import SESSIONS   # dict de estado por sesión, si existe
+        from .main import SESSIONS   # store de sesiones (app/sessions.py)
     except Exception:
         SESSIONS = {}
     return ChatIn, chat, SESSIONS
 
-def handle_message(user_id: str, text: str):
+async def handle_message(user_id: str, text: str):
     """
     Reproduce EXACTAMENTE el flujo de la terminal:
-      ChatIn(session=<wa_id>, text=<mensaje>) -> chat(...) -> ChatOut.reply
+      ChatIn(session=<wa_id>, text=<mensaje>) -> await chat(...) -> ChatOut.reply
     """
     ChatIn, chat, _ = _get_core()
     ci = ChatIn(session=user_id, text=text)
-    co = chat(ci)  # debe devolver ChatOut
+    co = await chat(ci)  # debe devolver ChatOut
     try:
         return co.reply
     except Exception:
@@ -33,6 +33,9 @@ def reset_session(user_id: str):
     """
     _, _, SESSIONS = _get_core()
     try:
-        SESSIONS.pop(user_id, None)
+        if hasattr(SESSIONS, "delete"):
+            SESSIONS.delete(user_id)  # también borra la fila compartida en SQLite
+        else:
+            SESSIONS.pop(user_id, None)
     except Exception:
         pass
@@ -1,11 +1,15 @@
 # modules/catalog_export.py — v2.0
 import os
 import csv
+import json
 import logging
 import ssl
+import time
+import threading
 import http.client
 import xmlrpc.client
-from typing import List, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 from pathlib import Path
 
 log = logging.getLogger(__name__)
@@ -28,6 +32,16 @@ ODOO_DB       = os.getenv("ODOO_DB", "") or ""
 ODOO_USERNAME = os.getenv("ODOO_USERNAME") or os.getenv("ODOO_USER") or ""
 ODOO_PASSWORD = os.getenv("ODOO_PASSWORD") or ""
 
+# ── Lecturas concurrentes: workers (un ServerProxy c/u) y reintentos por batch ─
+EXPORT_WORKERS = int(os.getenv("ODOO_EXPORT_WORKERS", "4") or 4)
+EXPORT_RETRIES = int(os.getenv("ODOO_EXPORT_RETRIES", "3") or 3)
+EXPORT_BACKOFF = float(os.getenv("ODOO_EXPORT_BACKOFF", "0.5") or 0.5)
+# Los movimientos de stock no tocan product.template.write_date. El incremental
+# detecta los templates con stock.move hechos desde su propia marca de agua y
+# relee qty_available sólo de esos ("moves"). "full" relee el stock de todo el
+# catálogo (para una corrida aparte, p.ej. nocturna); "off" no lo toca.
+EXPORT_STOCK = (os.getenv("ODOO_EXPORT_STOCK", "moves") or "moves").lower()
+
 class InsecureTransport(xmlrpc.client.Transport):
     def make_connection(self, host):
         return http.client.HTTPSConnection(host, context=ssl._create_unverified_context())
@@ -53,12 +67,142 @@ def _session() -> Tuple[int, xmlrpc.client.ServerProxy]:
     uid = common.authenticate(ODOO_DB, ODOO_USERNAME, ODOO_PASSWORD, {})
     if not uid:
         raise RuntimeError("Autenticación Odoo falló (usuario/contraseña/DB/URL).")
-    models = xmlrpc.client.ServerProxy(f"{ODOO_URL}/xmlrpc/2/object", transport=transport)
-    return uid, models
+    return uid, _models_proxy()
+
+def _models_proxy() -> xmlrpc.client.ServerProxy:
+    # ServerProxy/Transport no son thread-safe: uno por worker
+    transport = InsecureTransport() if ODOO_URL.startswith("https://") else None
+    return xmlrpc.client.ServerProxy(f"{ODOO_URL}/xmlrpc/2/object", transport=transport)
 
 FIELDS = ["id", "name", "default_code", "qty_available", "list_price", "categ_id", "uom_id"]
+# Campos extra que se leen pero no van al CSV: write_date alimenta la marca de
+# agua del modo incremental; active distingue altas/cambios de archivados.
+READ_FIELDS = FIELDS + ["write_date", "active"]
+STOCK_FIELDS = ["id", "qty_available"]
+QTY_COL = FIELDS.index("qty_available")
+
+def _csv_row(r: Dict) -> List:
+    categ = r.get("categ_id") or [None, ""]
+    uom = r.get("uom_id") or [None, ""]
+    return [
+        r.get("id"),
+        (r.get("name") or "").replace("\n", " ").strip(),
+        (r.get("default_code") or "").strip(),
+        r.get("qty_available") or 0,
+        r.get("list_price") or 0,
+        categ[1] or "",
+        uom[1] or ""
+    ]
+
+def _read_batches(uid: int, models: xmlrpc.client.ServerProxy, ids: List[int], limit_batch: int,
+                  workers: Optional[int] = None, retries: Optional[int] = None,
+                  backoff: Optional[float] = None, fields: Optional[List[str]] = None) -> Iterator[Dict]:
+    """
+    Lee `ids` en batches de `limit_batch`. Con workers > 1 los batches van en
+    paralelo (pool acotado, un ServerProxy por hilo); los resultados salen
+    igual en el orden de `ids`. Cada batch reintenta con backoff exponencial.
+    """
+    workers = EXPORT_WORKERS if workers is None else workers
+    retries = EXPORT_RETRIES if retries is None else retries
+    backoff = EXPORT_BACKOFF if backoff is None else backoff
+    fields = READ_FIELDS if fields is None else fields
+    batches = [ids[i:i + limit_batch] for i in range(0, len(ids), limit_batch)]
+    local = threading.local()
+
+    def read(batch_ids: List[int]) -> List[Dict]:
+        proxy = models if workers <= 1 else getattr(local, "proxy", None)
+        for attempt in range(retries + 1):
+            if proxy is None:
+                proxy = local.proxy = _models_proxy()
+            try:
+                return proxy.execute_kw(
+                    ODOO_DB, uid, ODOO_PASSWORD,
+                    "product.template", "read", [batch_ids],
+                    {"fields": fields}
+                )
+            except (xmlrpc.client.Error, OSError) as e:
+                if attempt >= retries:
+                    raise
+                wait = backoff * (2 ** attempt)
+                log.warning("Batch de %s ids falló (%s); reintento %s/%s en %.1fs",
+                            len(batch_ids), e, attempt + 1, retries, wait)
+                time.sleep(wait)
+                if workers > 1:
+                    proxy = None  # conexión nueva para el reintento
+        return []
+
+    if workers <= 1 or len(batches) <= 1:
+        for b in batches:
+            yield from read(b)
+        return
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="odoo-read") as pool:
+        # map conserva el orden de entrada aunque los batches terminen desordenados
+        for rows in pool.map(read, batches):
+            yield from rows
+
+def _write_csv(csv_path: str, rows: Iterable[List]) -> None:
+    # se escribe a un temporal y se reemplaza al final: quien recarga el
+    # catálogo en caliente nunca ve un CSV a medio escribir
+    Path(csv_path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = f"{csv_path}.tmp"
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(FIELDS)
+        w.writerows(rows)
+    os.replace(tmp_path, csv_path)
+
+# ── Estado del modo incremental: <csv>.state.json ─────────────────────────────
+def _state_path(csv_path: str) -> str:
+    return f"{csv_path}.state.json"
+
+def _load_state(csv_path: str) -> Dict:
+    try:
+        with open(_state_path(csv_path), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_state(csv_path: str, state: Dict) -> None:
+    tmp = f"{_state_path(csv_path)}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp, _state_path(csv_path))
+
+def _max_write_date(current: Optional[str], rec: Dict) -> Optional[str]:
+    wd = rec.get("write_date") or None
+    # "YYYY-MM-DD HH:MM:SS": el orden lexicográfico es el cronológico
+    return wd if wd and (current is None or wd > current) else current
+
+def _stock_moves_since(uid: int, models: xmlrpc.client.ServerProxy, mark: Optional[str]
+                       ) -> Tuple[set, Optional[str]]:
+    """
+    Templates con movimientos de stock hechos desde `mark` (write_date >=) y la
+    nueva marca. Sin `mark` sólo devuelve la marca actual (el último movimiento).
+    """
+    if mark is None:
+        last = models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD, "stock.move", "search_read",
+                                 [[("state", "=", "done")]],
+                                 {"fields": ["write_date"], "order": "write_date desc", "limit": 1})
+        return set(), (last[0].get("write_date") or None) if last else None
+    moves = models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD, "stock.move", "search_read",
+                              [[("write_date", ">=", mark), ("state", "=", "done")]],
+                              {"fields": ["product_tmpl_id", "write_date"]})
+    tmpl_ids = set()
+    for m in moves:
+        mark = _max_write_date(mark, m)
+        tmpl = m.get("product_tmpl_id")
+        if tmpl:
+            tmpl_ids.add(tmpl[0] if isinstance(tmpl, list) else tmpl)
+    return tmpl_ids, mark
 
-def export_catalog(csv_path: str, limit_batch: int = 200) -> int:
+def _stock_mark(uid: int, models: xmlrpc.client.ServerProxy) -> Optional[str]:
+    try:
+        return _stock_moves_since(uid, models, None)[1]
+    except (xmlrpc.client.Error, OSError) as e:  # sin módulo de inventario / sin permisos
+        log.warning("No pude leer stock.move (%s): el incremental no va a detectar movimientos", e)
+        return None
+
+def export_catalog(csv_path: str, limit_batch: int = 200, workers: Optional[int] = None) -> int:
     uid, models = _session()
     ids = models.execute_kw(ODOO_DB, uid, ODOO_PASSWORD, "product.template", "search", [[("active", "=", True)]])
     total = len(ids)
@@ -66,35 +210,123 @@ def export_catalog(csv_path: str, limit_batch: int = 200) -> int:
         log.info("No hay productos para exportar.")
         return 0
 
-    Path(csv_path).parent.mkdir(parents=True, exist_ok=True)
     log.info(f"Exportando {total} productos a {csv_path} …")
-
-    with open(csv_path, "w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow(FIELDS)
-        for i in range(0, total, limit_batch):
-            batch_ids = ids[i:i + limit_batch]
-            rows = models.execute_kw(
-                ODOO_DB, uid, ODOO_PASSWORD,
-                "product.template", "read", [batch_ids],
-                {"fields": FIELDS}
-            )
-            for r in rows:
-                categ = r.get("categ_id") or [None, ""]
-                uom = r.get("uom_id") or [None, ""]
-                w.writerow([
-                    r.get("id"),
-                    (r.get("name") or "").replace("\n", " ").strip(),
-                    (r.get("default_code") or "").strip(),
-                    r.get("qty_available") or 0,
-                    r.get("list_price") or 0,
-                    categ[1] or "",
-                    uom[1] or ""
-                ])
+    stock_hwm = _stock_mark(uid, models)  # antes de leer: un movimiento durante el export se relee
+    hwm: Optional[str] = None
+    rows = []
+    for r in _read_batches(uid, models, ids, limit_batch, workers=workers):
+        hwm = _max_write_date(hwm, r)
+        rows.append(_csv_row(r))
+    _write_csv(csv_path, rows)
+    _save_state(csv_path, {"write_date": hwm, "stock_date": stock_hwm, "count": total})
     log.info("Export finalizado.")
     return total
 
+def _same_qty(a: Any, b: Any) -> bool:
+    try:
+        return float(a) == float(b)
+    except (TypeError, ValueError):
+        return str(a) == str(b)
+
+def export_catalog_incremental(csv_path: str, limit_batch: int = 200,
+                               workers: Optional[int] = None,
+                               stock: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Sincroniza sólo lo que cambió desde la última corrida (marcas de agua en
+    <csv>.state.json):
+      - templates con write_date >= marca (activos o archivados) → upsert/baja,
+      - ids activos actuales (un search sin read) → baja de los borrados,
+      - stock (`stock`, default ODOO_EXPORT_STOCK): un movimiento NO cambia
+        write_date del template, así que con "moves" se buscan los stock.move
+        hechos desde la marca de stock y se relee qty_available sólo de esos
+        templates; "full" relee el stock de todas las filas (para correrlo con
+        su propio horario, no en cada ciclo); "off" lo deja como está.
+    Mergea sobre el CSV existente manteniendo el orden de filas; el snapshot
+    del catálogo se regenera solo al cambiar el CSV. Sin CSV o sin marca,
+    hace el export completo.
+    """
+    stock = (EXPORT_STOCK if stock is None else stock).lower()
+    state = _load_state(csv_path)
+    if not os.path.exists(csv_path) or not state.get("write_date"):
+        total = export_catalog(csv_path, limit_batch, workers=workers)
+        return {"mode": "full", "total": total, "changed": total, "removed": 0}
+
+    uid, models = _session()
+    hwm = state["write_date"]
+    stock_hwm = state.get("stock_date")
+    # ">=": un registro escrito en el mismo segundo que la marca no se pierde
+    changed_ids = models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD, "product.template", "search",
+        [[("write_date", ">=", hwm), ("active", "in", [True, False])]]
+    )
+    active_ids = set(models.execute_kw(
+        ODOO_DB, uid, ODOO_PASSWORD, "product.template", "search", [[("active", "=", True)]]
+    ))
+    moved: Optional[set] = None  # None = todas las filas
+    if stock == "moves":
+        try:
+            moved, stock_hwm = _stock_moves_since(uid, models, stock_hwm)
+        except (xmlrpc.client.Error, OSError) as e:
+            log.warning("No pude leer stock.move (%s): stock sin refrescar en esta corrida", e)
+            moved = set()
+
+    upserts: Dict[str, List] = {}
+    archived = set()
+    for r in _read_batches(uid, models, changed_ids, limit_batch, workers=workers):
+        hwm = _max_write_date(hwm, r)
+        if r.get("active", True) and r["id"] in active_ids:
+            upserts[str(r["id"])] = _csv_row(r)
+        else:
+            archived.add(str(r["id"]))
+
+    with open(csv_path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        existing = [row for row in reader if row]
+
+    merged: List[List] = []
+    seen = set()
+    removed = 0
+    for row in existing:
+        rid = row[0]
+        if rid in archived or (rid.isdigit() and int(rid) not in active_ids):
+            removed += 1
+            continue
+        merged.append(upserts.get(rid, row))
+        seen.add(rid)
+    merged.extend(row for rid, row in upserts.items() if rid not in seen)
+
+    restocked = 0
+    if stock in ("moves", "full"):
+        stale = [int(row[0]) for row in merged if str(row[0]).isdigit() and str(row[0]) not in upserts
+                 and (moved is None or int(row[0]) in moved)]
+        qty = {str(r["id"]): r.get("qty_available") or 0
+               for r in _read_batches(uid, models, stale, limit_batch, workers=workers, fields=STOCK_FIELDS)}
+        for row in merged:
+            q = qty.get(str(row[0]))
+            if q is not None and not _same_qty(q, row[QTY_COL]):
+                row[QTY_COL] = q
+                restocked += 1
+
+    if upserts or removed or restocked:
+        _write_csv(csv_path, merged)
+    _save_state(csv_path, {"write_date": hwm, "stock_date": stock_hwm, "count": len(merged)})
+    log.info("Incremental: %s cambios, %s bajas, %s stocks, %s filas.", len(upserts), removed, restocked, len(merged))
+    return {"mode": "incremental", "total": len(merged), "changed": len(upserts), "removed": removed,
+            "restocked": restocked}
+
 if __name__ == "__main__":
+    import argparse
     logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--incremental", action="store_true",
+                    default=os.getenv("CATALOG_EXPORT_INCREMENTAL", "").lower() in ("1", "true", "yes"))
+    ap.add_argument("--workers", type=int, default=EXPORT_WORKERS)
+    ap.add_argument("--stock", choices=["moves", "full", "off"], default=EXPORT_STOCK,
+                    help="incremental: stock por movimientos (default), de todo el catálogo u omitido")
+    a = ap.parse_args()
     out = os.getenv("CATALOG_CSV_PATH", "./catalog.csv")
-    export_catalog(out)
+    if a.incremental:
+        export_catalog_incremental(out, workers=a.workers, stock=a.stock)
+    else:
+        export_catalog(out, workers=a.workers)
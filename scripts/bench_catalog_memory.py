@@ -0,0 +1,124 @@
+# scripts/bench_catalog_memory.py
+# RSS del catálogo en memoria: un dict por fila (antes) vs columnas (después).
+# Cada modo corre en un proceso nuevo para que las mediciones no se pisen.
+#   python scripts/bench_catalog_memory.py --csv ./catalog.csv
+# Con --workers N además levanta N procesos a la vez (como uvicorn --workers)
+# y suma su PSS (páginas compartidas repartidas): privado vs CATALOG_SHARED.
+#   python scripts/bench_catalog_memory.py --csv ./catalog.csv --workers 4
+import os, sys, csv, gc, json, argparse, subprocess
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+MODES = ("dicts", "columns", "catalog", "snapshot")
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource  # sin /proc: pico de RSS (macOS reporta bytes, Linux KB)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _pss_mb() -> float:
+    try:
+        with open("/proc/self/smaps_rollup", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return _rss_mb()
+
+def _worker(shared: bool, csv_path: str) -> None:
+    from app.search import LocalCatalog
+    base = _pss_mb()
+    cat = LocalCatalog(csv_path, shared=shared)
+    for q in ({"tokens": ["perfil", "70"]}, {"tokens": ["cemento", "25", "kg"]}, {"tokens": ["galv"]}):
+        cat.search_ids(q)
+    print("ready", flush=True)
+    sys.stdin.readline()  # esperamos a que todos carguen antes de medir
+    print(json.dumps({"base_mb": base, "pss_mb": _pss_mb()}), flush=True)
+
+def _workers(n: int, shared: bool, csv_path: str) -> float:
+    procs = [subprocess.Popen([sys.executable, __file__, "--csv", csv_path, "--worker",
+                               "shared" if shared else "private"],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+             for _ in range(n)]
+    for p in procs:
+        assert p.stdout.readline().strip() == "ready"
+    for p in procs:
+        p.stdin.write("\n"); p.stdin.flush()
+    total = 0.0
+    for p in procs:
+        r = json.loads(p.stdout.readline())
+        total += r["pss_mb"] - r["base_mb"]
+        p.wait()
+    return total
+
+def _child(mode: str, csv_path: str) -> dict:
+    from app.search import LocalCatalog, _norm, _read_csv_columns
+    gc.collect()
+    before = _rss_mb()
+    if mode == "dicts":
+        # almacenamiento anterior: csv.DictReader + _norm_* por fila
+        rows = []
+        with open(csv_path, newline="", encoding="utf-8") as f:
+            for r in csv.DictReader(f):
+                r["_norm_name"] = _norm(r.get("name", ""))
+                r["_norm_code"] = _norm(r.get("default_code", ""))
+                rows.append(r)
+        keep = rows
+    elif mode == "columns":
+        keep = _read_csv_columns(csv_path)
+    elif mode == "catalog":
+        keep = LocalCatalog(csv_path, use_snapshot=False)
+    else:
+        LocalCatalog(csv_path)  # asegura el snapshot en disco
+        gc.collect()
+        before = _rss_mb()
+        keep = LocalCatalog(csv_path)
+    gc.collect()
+    after = _rss_mb()
+    del keep
+    return {"mode": mode, "before_mb": round(before, 1), "after_mb": round(after, 1),
+            "delta_mb": round(after - before, 1)}
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--csv", default=os.getenv("CATALOG_PATH", "./data/catalog.csv"))
+    ap.add_argument("--mode", choices=MODES)
+    ap.add_argument("--workers", type=int, default=0)
+    ap.add_argument("--worker", choices=("private", "shared"), help=argparse.SUPPRESS)
+    a = ap.parse_args()
+
+    if a.worker:
+        _worker(a.worker == "shared", a.csv)
+        return
+    if a.mode:
+        print(json.dumps(_child(a.mode, a.csv)))
+        return
+
+    labels = {
+        "dicts": "filas dict (antes)",
+        "columns": "columnas (después)",
+        "catalog": "columnas + índice",
+        "snapshot": "desde snapshot",
+    }
+    print(f"{'modo':<22}{'RSS antes':>12}{'RSS después':>14}{'delta':>10}")
+    for mode in MODES:
+        out = subprocess.run([sys.executable, __file__, "--csv", a.csv, "--mode", mode],
+                             capture_output=True, text=True, check=True)
+        r = json.loads(out.stdout.strip().splitlines()[-1])
+        print(f"{labels[mode]:<22}{r['before_mb']:>10.1f}MB{r['after_mb']:>12.1f}MB{r['delta_mb']:>8.1f}MB")
+
+    if a.workers:
+        print(f"\n{'workers':<10}{'privado (PSS)':>16}{'compartido (PSS)':>20}")
+        for n in sorted({1, a.workers}):
+            print(f"{n:<10}{_workers(n, False, a.csv):>14.1f}MB{_workers(n, True, a.csv):>18.1f}MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# scripts/bench_search.py
+# Micro-benchmark de LocalCatalog: recorrido lineal vs bitsets por token.
+#   python scripts/bench_search.py --csv ./catalog.csv --repeat 3
+import os, sys, time, argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from app.search import LocalCatalog, build_query_variants
+
+PLANS = [
+    {"q": "perfil montante galvanizado 70", "must": ["perfil"], "not": []},
+    {"q": "caño termofusion 1/2 codo 90", "must": [], "not": ["gas"]},
+    {"q": "tornillo t1 punta mecha", "must": ["tornillo"], "not": []},
+    {"q": "cemento 25 kg", "must": [], "not": ["adhesivo"], "family": "cemento"},
+    {"q": "alambre recocido 16", "must": [], "not": []},
+]
+
+def _timeit(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--csv", default=os.getenv("CATALOG_PATH", "./data/catalog.csv"))
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--variants", type=int, default=30)
+    a = ap.parse_args()
+
+    t0 = time.perf_counter()
+    cat = LocalCatalog(a.csv)
+    print(f"carga: {len(cat)} filas en {time.perf_counter() - t0:.2f}s")
+
+    variants = [v for p in PLANS for v in build_query_variants(p, target=a.variants)]
+    print(f"variantes: {len(variants)} ({a.variants} por plan, {len(PLANS)} planes)\n")
+
+    def loop():
+        for v in variants:
+            cat.scan(v)
+
+    def bitsets_cold():
+        cat._match_cache.clear()
+        for v in variants:
+            cat.search(v)
+
+    def bitsets_warm():
+        for v in variants:
+            cat.search(v)
+
+    def batched():
+        cat._match_cache.clear()
+        cat.search_many(variants)
+
+    for v in variants:
+        assert cat.search(v) == cat.scan(v), v
+
+    base = _timeit(loop, a.repeat)
+    print(f"{'modo':<24}{'total':>10}{'por variante':>16}{'speedup':>10}")
+    for label, fn in (("loop (scan)", loop), ("bitsets (cache frío)", bitsets_cold),
+                      ("bitsets (cache tibio)", bitsets_warm), ("search_many", batched)):
+        t = base if fn is loop else _timeit(fn, a.repeat)
+        print(f"{label:<24}{t*1000:>8.1f}ms{t*1e6/len(variants):>13.0f}µs{base/t:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
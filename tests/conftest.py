@@ -0,0 +1,12 @@
+# Entorno mínimo para importar app.main en tests: nunca la API real ni Odoo,
+# catálogo del repo y credenciales de WhatsApp de mentira.
+import os
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+os.environ["OPENAI_API_KEY"] = ""
+os.environ["ODOO_HYDRATE"] = "false"
+os.environ.setdefault("CATALOG_PATH", os.path.join(ROOT, "catalog.csv"))
+os.environ.setdefault("WA_VERIFY_TOKEN", "test")
+os.environ.setdefault("WA_ACCESS_TOKEN", "test")
+os.environ.setdefault("WA_DEFAULT_PHONE_ID", "0")
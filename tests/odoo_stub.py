@@ -0,0 +1,114 @@
+# Odoo XML-RPC mínimo en memoria para tests (common/authenticate + object/execute_kw).
+import threading, time
+from socketserver import ThreadingMixIn
+from xmlrpc.server import MultiPathXMLRPCServer, SimpleXMLRPCDispatcher, SimpleXMLRPCRequestHandler
+
+class _Server(ThreadingMixIn, MultiPathXMLRPCServer):
+    daemon_threads = True
+
+class _Quiet(SimpleXMLRPCRequestHandler):
+    rpc_paths = ("/xmlrpc/2/common", "/xmlrpc/2/object")
+
+    def log_message(self, *args):
+        pass
+
+def _match(rec, domain):
+    for field, op, value in domain:
+        v = rec.get(field)
+        if op == "=" and v != value: return False
+        if op == "!=" and v == value: return False
+        if op == "in" and v not in value: return False
+        if op == ">" and not (v is not None and v > value): return False
+        if op == ">=" and not (v is not None and v >= value): return False
+        if op == "<" and not (v is not None and v < value): return False
+    return True
+
+class OdooStub:
+    """
+    models = {"product.template": {id: {...}}, "product.product": {...}}.
+    `latency` (s) se duerme en cada execute_kw; `fail` = {(model, method): n}
+    hace fallar las primeras n llamadas. `calls` cuenta llamadas por método.
+    """
+    def __init__(self, models, latency=0.0, fail=None):
+        self.models = models
+        self.latency = latency
+        self.fail = dict(fail or {})
+        self.calls = {}
+        self.max_inflight = 0
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self._server = _Server(("127.0.0.1", 0), requestHandler=_Quiet, allow_none=True, logRequests=False)
+        common = SimpleXMLRPCDispatcher(allow_none=True)
+        common.register_function(self.authenticate, "authenticate")
+        obj = SimpleXMLRPCDispatcher(allow_none=True)
+        obj.register_function(self.execute_kw, "execute_kw")
+        self._server.add_dispatcher("/xmlrpc/2/common", common)
+        self._server.add_dispatcher("/xmlrpc/2/object", obj)
+        self.url = "http://127.0.0.1:%d" % self._server.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def authenticate(self, db, user, password, ctx):
+        with self._lock:
+            self.calls["authenticate"] = self.calls.get("authenticate", 0) + 1
+        return 2
+
+    def execute_kw(self, db, uid, password, model, method, args, kwargs=None):
+        kwargs = kwargs or {}
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self._inflight += 1
+            self.max_inflight = max(self.max_inflight, self._inflight)
+            left = self.fail.get((model, method), 0)
+            if left:
+                self.fail[(model, method)] = left - 1
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if left:
+                raise RuntimeError("falla simulada")
+            recs = self.models.get(model, {})
+            if method == "search":
+                return self._search(recs, args[0], kwargs.get("limit"))
+            if method == "read":
+                fields = kwargs.get("fields") or (args[1] if len(args) > 1 else None)
+                return [self._pick(recs[i], fields) for i in args[0] if i in recs]
+            if method == "search_read":
+                fields = kwargs.get("fields") or (args[1] if len(args) > 1 else None)
+                ids = self._search(recs, args[0], None if kwargs.get("order") else kwargs.get("limit"))
+                if kwargs.get("order"):  # "campo [asc|desc]"
+                    field, _, way = kwargs["order"].partition(" ")
+                    ids.sort(key=lambda i: recs[i].get(field) or "", reverse=way.strip().lower() == "desc")
+                    ids = ids[:kwargs["limit"]] if kwargs.get("limit") else ids
+                return [self._pick(recs[i], fields) for i in ids]
+            raise ValueError(method)
+        finally:
+            with self._lock:
+                self._inflight -= 1
+
+    @staticmethod
+    def _search(recs, domain, limit=None):
+        domain = [tuple(d) for d in domain]
+        has_active = any("active" in r for r in recs.values())  # como Odoo: sólo modelos con active
+        if has_active and not any(d[0] == "active" for d in domain):
+            domain.append(("active", "=", True))
+        ids = [i for i in sorted(recs) if _match(recs[i], domain)]
+        return ids[:limit] if limit else ids
+
+    @staticmethod
+    def _pick(rec, fields):
+        if not fields:
+            return dict(rec)
+        out = {f: rec.get(f, False) for f in fields}
+        out["id"] = rec["id"]
+        return out
+
+def template(i, name, code, qty=0, price=0.0, write_date="2026-01-01 00:00:00", active=True):
+    return {"id": i, "name": name, "default_code": code, "qty_available": qty, "list_price": price,
+            "categ_id": [1, "All"], "uom_id": [1, "Units"], "write_date": write_date, "active": active}
@@ -0,0 +1,93 @@
+# Server mínimo compatible con /v1/chat/completions para tests (latencia artificial).
+import json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 512  # ráfagas de cientos de conexiones
+
+class OpenAIStub:
+    """
+    `responder(messages) -> dict` arma el JSON que devuelve el "modelo";
+    `latency` (s) se duerme en cada request. `calls` cuenta requests y
+    `max_inflight` registra cuántas hubo a la vez. Con `"stream": true`
+    responde SSE en pedazos de `chunk_size` caracteres, `chunk_latency` s c/u.
+    """
+    def __init__(self, responder, latency=0.0, chunk_size=16, chunk_latency=0.0):
+        self.responder = responder
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_latency = chunk_latency
+        self.calls = 0
+        self.max_inflight = 0
+        self._inflight = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, como la API real
+            disable_nagle_algorithm = True  # headers y body van en writes separados
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                with stub._lock:
+                    stub.calls += 1
+                    stub._inflight += 1
+                    stub.max_inflight = max(stub.max_inflight, stub._inflight)
+                try:
+                    time.sleep(stub.latency)
+                    content = json.dumps(stub.responder(body.get("messages") or []), ensure_ascii=False)
+                    if body.get("stream"):
+                        return self._stream(body, content)
+                finally:
+                    with stub._lock:
+                        stub._inflight -= 1
+                out = json.dumps({
+                    "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()),
+                    "model": body.get("model", "stub"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def _stream(self, body, content):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def event(data):
+                    raw = f"data: {data}\n\n".encode()
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(raw), raw))
+                    self.wfile.flush()
+
+                for i in range(0, len(content), stub.chunk_size):
+                    if i:
+                        time.sleep(stub.chunk_latency)
+                    event(json.dumps({
+                        "id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                        "model": body.get("model", "stub"),
+                        "choices": [{"index": 0, "finish_reason": None,
+                                     "delta": {"content": content[i:i + stub.chunk_size]}}],
+                    }))
+                event("[DONE]")
+                self.wfile.write(b"0\r\n\r\n")
+
+        self._server = _Server(("127.0.0.1", 0), Handler)
+        self.base_url = "http://127.0.0.1:%d/v1" % self._server.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
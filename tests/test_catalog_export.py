@@ -0,0 +1,115 @@
+import csv
+
+import pytest
+
+from modules import catalog_export as ce
+from odoo_stub import OdooStub, template
+
+@pytest.fixture
+def odoo(monkeypatch):
+    models = {"product.template": {
+        1: template(1, "Perfil C 70", "PF-C-70", 10, 100.0, "2026-01-01 10:00:00"),
+        2: template(2, "Perfil U 35", "PF-U-35", 0, 80.0, "2026-01-01 10:00:00"),
+        3: template(3, "Omega 45", "PF-O-45", 5, 90.0, "2026-01-01 10:00:00"),
+        4: template(4, "Viejo", "OLD", 1, 1.0, "2025-01-01 10:00:00", active=False),
+    }}
+    with OdooStub(models) as stub:
+        monkeypatch.setattr(ce, "ODOO_URL", stub.url)
+        monkeypatch.setattr(ce, "ODOO_DB", "db")
+        monkeypatch.setattr(ce, "ODOO_USERNAME", "u")
+        monkeypatch.setattr(ce, "ODOO_PASSWORD", "p")
+        yield stub
+
+def _read(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+def test_incremental_trae_solo_cambios_y_bajas(odoo, tmp_path):
+    out = str(tmp_path / "catalog.csv")
+    first = ce.export_catalog_incremental(out, limit_batch=2)
+    assert first["mode"] == "full" and first["total"] == 3
+    assert [r["default_code"] for r in _read(out)] == ["PF-C-70", "PF-U-35", "PF-O-45"]
+
+    tpl = odoo.models["product.template"]
+    tpl[2].update(qty_available=7, write_date="2026-01-02 09:00:00")                   # cambio
+    tpl[3].update(active=False, write_date="2026-01-02 09:05:00")                      # archivado
+    tpl[5] = template(5, "Tornillo T1", "T1", 100, 5.0, "2026-01-02 09:10:00")         # alta
+    del tpl[1]                                                                         # borrado
+    odoo.calls.clear()
+
+    delta = ce.export_catalog_incremental(out, limit_batch=2, stock="off")
+    assert delta == {"mode": "incremental", "total": 2, "changed": 2, "removed": 2, "restocked": 0}
+    rows = _read(out)
+    assert [r["default_code"] for r in rows] == ["PF-U-35", "T1"]
+    assert float(rows[0]["qty_available"]) == 7
+    # sólo se leyeron los 3 templates tocados, en 2 batches
+    assert odoo.calls["read"] == 2
+
+    odoo.calls.clear()
+    again = ce.export_catalog_incremental(out, stock="off")
+    assert again["changed"] == 1  # el de write_date == marca se relee (>=), sin duplicar
+    assert [r["default_code"] for r in _read(out)] == ["PF-U-35", "T1"]
+
+def _move(i, tmpl_id, write_date):
+    return {"id": i, "product_tmpl_id": [tmpl_id, "x"], "state": "done", "write_date": write_date}
+
+def test_incremental_refresca_stock_por_movimientos(odoo, tmp_path):
+    out = str(tmp_path / "catalog.csv")
+    tpl = odoo.models["product.template"]
+    moves = odoo.models["stock.move"] = {1: _move(1, 1, "2026-01-01 08:00:00")}
+    tpl[1]["write_date"] = tpl[2]["write_date"] = "2025-12-01 10:00:00"
+    ce.export_catalog_incremental(out)
+    # un movimiento de stock no toca write_date del template
+    tpl[1]["qty_available"] = 3
+    tpl[2]["qty_available"] = 9  # cambió sin movimiento registrado: no se relee
+    moves[2] = _move(2, 1, "2026-01-03 12:00:00")
+    odoo.calls.clear()
+    delta = ce.export_catalog_incremental(out, limit_batch=2)
+    assert delta["changed"] == 1 and delta["restocked"] == 1  # el de la marca se relee igual
+    assert [float(r["qty_available"]) for r in _read(out)] == [3, 0, 5]
+    assert odoo.calls["read"] == 2  # template de la marca + stock del único movido
+
+    odoo.calls.clear()
+    assert ce.export_catalog_incremental(out)["restocked"] == 0
+    assert odoo.calls["read"] == 2  # el movimiento de la marca (>=) se vuelve a mirar, nada más
+
+    # corrida aparte con todo el stock (p.ej. nocturna)
+    assert ce.export_catalog_incremental(out, stock="full")["restocked"] == 1
+    assert [float(r["qty_available"]) for r in _read(out)] == [3, 9, 5]
+
+def _many(n, latency, fail=None):
+    tpl = {i: template(i, f"Producto {i}", f"P{i:04d}", i % 3, float(i)) for i in range(1, n + 1)}
+    return OdooStub({"product.template": tpl}, latency=latency, fail=fail)
+
+def _export_with(stub, monkeypatch, out, **kw):
+    monkeypatch.setattr(ce, "ODOO_URL", stub.url)
+    monkeypatch.setattr(ce, "ODOO_DB", "db")
+    monkeypatch.setattr(ce, "ODOO_USERNAME", "u")
+    monkeypatch.setattr(ce, "ODOO_PASSWORD", "p")
+    return ce.export_catalog(out, **kw)
+
+def test_batches_concurrentes_mismo_csv_y_menos_tiempo(monkeypatch, tmp_path):
+    import time
+    seq, par = str(tmp_path / "seq.csv"), str(tmp_path / "par.csv")
+    with _many(100, latency=0.05) as stub:
+        t0 = time.perf_counter()
+        _export_with(stub, monkeypatch, seq, limit_batch=10, workers=1)
+        t_seq = time.perf_counter() - t0
+        assert stub.max_inflight == 1
+
+        t0 = time.perf_counter()
+        _export_with(stub, monkeypatch, par, limit_batch=10, workers=5)
+        t_par = time.perf_counter() - t0
+        assert stub.max_inflight > 1
+
+    assert open(seq, encoding="utf-8").read() == open(par, encoding="utf-8").read()
+    assert [r["id"] for r in _read(par)] == [str(i) for i in range(1, 101)]
+    assert t_par < t_seq / 2
+
+def test_batch_reintenta_con_backoff(monkeypatch, tmp_path):
+    monkeypatch.setattr(ce, "EXPORT_BACKOFF", 0.01)
+    out = str(tmp_path / "catalog.csv")
+    with _many(30, latency=0.0, fail={("product.template", "read"): 2}) as stub:
+        assert _export_with(stub, monkeypatch, out, limit_batch=10, workers=3) == 30
+        assert stub.calls["read"] == 3 + 2
+    assert len(_read(out)) == 30
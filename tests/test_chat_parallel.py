@@ -0,0 +1,163 @@
+import asyncio, time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import assistant_qa, llm, main, openai_client
+from app.plan_cache import PlanCache
+from openai_stub import OpenAIStub
+
+LATENCY = 0.3
+
+def _responder(messages):
+    system, user = messages[0]["content"], messages[-1]["content"]
+    if "Router+Q&A" in system:
+        if "?" in user:
+            return {"kind": "qa", "is_qa": True, "answer": "El percutor sirve para concreto.", "confidence": 0.9}
+        return {"kind": "statement_need", "is_qa": False, "answer": None, "confidence": 0.8}
+    return {"action": "ask", "question": "¿Qué tipo de taladro? (percutor | atornillador | banco)",
+            "intent": {"family": "taladro", "family_confidence": 0.8}}
+
+def _use_stub(monkeypatch, stub, **cfg):
+    monkeypatch.setattr(openai_client, "CONFIG",
+                        openai_client.OpenAIConfig(api_key="test", base_url=stub.base_url, **cfg))
+    openai_client.reset()
+    monkeypatch.setattr(llm, "PLAN_CACHE", PlanCache(maxsize=0))  # acá se cuentan llamadas reales
+    monkeypatch.setattr(assistant_qa, "LOCAL_RULES", False)       # y el router siempre va al modelo
+
+@pytest.fixture
+def chat(monkeypatch):
+    with OpenAIStub(_responder, latency=LATENCY) as stub, TestClient(main.app) as http:
+        _use_stub(monkeypatch, stub)
+
+        def send(session, text):
+            t0 = time.perf_counter()
+            r = http.post("/chat", json={"session": session, "text": text})
+            assert r.status_code == 200
+            return r.json(), time.perf_counter() - t0
+        send.stub = stub
+        yield send
+
+def _turn(chat, session, text):
+    chat(session, "hola")  # el primer mensaje sólo saluda
+    chat.stub.calls = chat.stub.max_inflight = 0
+    return chat(session, text)
+
+def test_router_y_planner_en_paralelo(chat, monkeypatch):
+    monkeypatch.setattr(main.SETTINGS, "parallel_llm", False)
+    out, t_seq = _turn(chat, "seq", "necesito un taladro")
+    assert out["trace"]["mode"] == "ask" and chat.stub.max_inflight == 1
+
+    monkeypatch.setattr(main.SETTINGS, "parallel_llm", True)
+    out_par, t_par = _turn(chat, "par", "necesito un taladro")
+    assert out_par["reply"] == out["reply"]
+    assert chat.stub.calls == 2 and chat.stub.max_inflight == 2
+    assert t_seq >= 2 * LATENCY and t_par < 1.5 * LATENCY
+
+def test_qa_descarta_el_plan(chat):
+    out, t = _turn(chat, "qa", "¿sirve para concreto?")
+    assert out["trace"]["mode"] == "qa"
+    assert out["reply"].startswith("El percutor sirve para concreto.")
+    assert t < 1.5 * LATENCY
+    assert main.get_state("qa").asked_questions == []  # el plan ignorado no tocó el estado
+
+def test_muchas_sesiones_concurrentes_en_un_worker(monkeypatch):
+    n, latency = 200, 0.2
+
+    async def run():
+        await asyncio.gather(*(main.chat(main.ChatIn(session=f"c{i}", text="hola")) for i in range(n)))
+        t0 = time.perf_counter()
+        outs = await asyncio.gather(*(main.chat(main.ChatIn(session=f"c{i}", text="necesito un taladro"))
+                                      for i in range(n)))
+        return outs, time.perf_counter() - t0
+
+    with OpenAIStub(_responder, latency=latency) as stub:
+        _use_stub(monkeypatch, stub, max_concurrency=64)
+        outs, elapsed = asyncio.run(run())
+    assert all(o.trace["mode"] == "ask" for o in outs)
+    assert stub.calls == 2 * n
+    assert 1 < stub.max_inflight <= 64         # el limitador acota las llamadas en vuelo
+    assert elapsed < (2 * n * latency) / 5     # lejos de atender de a una (80 s en serie)
+
+def test_timeout_por_llamada_cae_al_fallback(monkeypatch):
+    async def run():
+        await main.chat(main.ChatIn(session="slow", text="hola"))
+        return await main.chat(main.ChatIn(session="slow", text="necesito un taladro"))
+
+    with OpenAIStub(_responder, latency=1.0) as stub:
+        _use_stub(monkeypatch, stub, timeout=0.2)
+        t0 = time.perf_counter()
+        out = asyncio.run(run())
+    assert out.trace["mode"] == "ask"  # pregunta del fallback, sin colgar el turno
+    assert time.perf_counter() - t0 < 3
+
+ALT = "¿Qué ancho de perfil? (35 mm | 70 mm | 100 mm)"
+
+def _search_sin_datos(messages):
+    system, user = messages[0]["content"], messages[-1]["content"]
+    if "Router+Q&A" in system:
+        return {"kind": "statement_need", "is_qa": False, "answer": None, "confidence": 0.8}
+    if '"force_more": true' in user:
+        return {"action": "ask", "question": "¿Para qué lo vas a usar? (tabique | cielorraso | revestimiento)"}
+    # pide buscar sin evidencia suficiente (facts_score < 3) pero trae alternativas
+    return {"action": "search", "question": None, "alt_questions": [ALT, ALT + " "],
+            "intent": {"family": "perfil", "family_confidence": 0.7}}
+
+def test_alt_questions_evitan_la_segunda_llamada(monkeypatch):
+    http = TestClient(main.app)
+    with OpenAIStub(_search_sin_datos) as stub:
+        _use_stub(monkeypatch, stub)
+        http.post("/chat", json={"session": "alt", "text": "hola"})
+
+        out = http.post("/chat", json={"session": "alt", "text": "perfiles para durlock"}).json()
+        assert out["reply"] == ALT and out["trace"]["mode"] == "ask_forced"
+        assert out["trace"]["llm_calls"] == 2 and stub.calls == 2
+
+        # la única alternativa ya se preguntó ⇒ recién ahí el pase extra con force_more
+        out = http.post("/chat", json={"session": "alt", "text": "no sé"}).json()
+        assert out["reply"].startswith("¿Para qué lo vas a usar?")
+        assert out["trace"]["llm_calls"] == 3 and stub.calls == 5
+
+def test_sin_alt_questions_hace_el_pase_extra(monkeypatch):
+    monkeypatch.setattr(main.SETTINGS, "use_alt_questions", False)
+    http = TestClient(main.app)
+    with OpenAIStub(_search_sin_datos) as stub:
+        _use_stub(monkeypatch, stub)
+        http.post("/chat", json={"session": "noalt", "text": "hola"})
+        out = http.post("/chat", json={"session": "noalt", "text": "perfiles para durlock"}).json()
+        assert out["trace"]["llm_calls"] == 3 and stub.calls == 3
+
+def test_trace_cuenta_intentos_aparte_de_las_llamadas_utiles(monkeypatch):
+    def roto(messages):
+        if "Router+Q&A" in messages[0]["content"]:
+            return _responder(messages)
+        return ["no", "es", "un", "objeto"]  # el planner responde algo inservible
+    http = TestClient(main.app)
+    with OpenAIStub(roto) as stub:
+        _use_stub(monkeypatch, stub)
+        http.post("/chat", json={"session": "fail", "text": "hola"})
+        out = http.post("/chat", json={"session": "fail", "text": "necesito un taladro"}).json()
+        assert stub.calls >= 2
+        assert out["trace"]["llm_attempts"] > out["trace"]["llm_calls"]
+
+def test_trace_hydrated_en_cero_sin_odoo(monkeypatch):
+    plan = {"action": "search", "query_variants": [["perfil", "70"]], "intent": {"family": "perfil"},
+            "answered_slots": {"medida": "70", "uso": "durlock"}}
+    def responder(messages):
+        if "Router+Q&A" in messages[0]["content"]:
+            return _responder(messages)
+        return plan
+    calls = []
+    monkeypatch.setattr(main.SETTINGS, "product_source", "local")
+    monkeypatch.setattr(main, "hydrate_in_odoo", lambda candidates, odoo_cfg=None: calls.append(1) or candidates)
+    http = TestClient(main.app)
+    with OpenAIStub(responder) as stub:
+        _use_stub(monkeypatch, stub)
+        http.post("/chat", json={"session": "hyd", "text": "hola"})
+        out = http.post("/chat", json={"session": "hyd", "text": "perfil de 70 para durlock"}).json()
+        assert out["trace"]["mode"] == "local_ok" and out["trace"]["hydrated"] == 0 and calls == []
+
+        monkeypatch.setattr(main.APP_SETTINGS, "odoo_hydrate", True)
+        http.post("/chat", json={"session": "hyd2", "text": "hola"})
+        out = http.post("/chat", json={"session": "hyd2", "text": "perfil de 70 para durlock"}).json()
+        assert out["trace"]["hydrated"] > 0 and calls == [1]
@@ -0,0 +1,100 @@
+import asyncio, json, time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import assistant_qa, llm, main, openai_client
+from app.json_stream import TopLevelFields
+from app.plan_cache import PlanCache
+from openai_stub import OpenAIStub
+
+PLAN = {
+    "action": "ask",
+    "question": "¿Qué tipo de taladro? (percutor | atornillador | banco)",
+    "alt_questions": ["¿Inalámbrico o con cable? (inalámbrico | con cable)"],
+    "intent": {"family": "taladro", "family_confidence": 0.8},
+    "ready_to_search": False,
+    "slots_required": ["tipo", "fuente"],
+    "answered_slots": {"uso": "obra, \"pesado\" {x}"},
+    "hypotheses": ["taladro percutor 13mm", "rotomartillo sds plus", "atornillador 18V"] * 4,
+    "disambiguation": None,
+}
+
+@pytest.mark.parametrize("size", [1, 3, 7, 64])
+def test_parser_incremental_por_pedazos(size):
+    raw = json.dumps(PLAN, ensure_ascii=False)
+    p, seen = TopLevelFields(), []
+    for i in range(0, len(raw), size):
+        seen.extend(p.feed(raw[i:i + size]))
+    assert seen[:2] == ["action", "question"]  # en el orden en que se completan
+    assert p.done and p.fields == PLAN == p.result()
+
+def test_parser_no_cierra_miembros_abiertos():
+    p = TopLevelFields()
+    assert p.feed('{"action": "ask", "question": "¿A, B o C? (a | b') == {"action": "ask"}
+    assert p.feed(' | c)", "intent": {"family": "x",') == {"question": "¿A, B o C? (a | b | c)"}
+    assert "intent" not in p.fields and not p.done
+
+@pytest.fixture
+def stream_stub(monkeypatch):
+    plans = {"plan": PLAN}
+    with OpenAIStub(lambda messages: plans["plan"], latency=0.05, chunk_size=8, chunk_latency=0.01) as stub:
+        monkeypatch.setattr(openai_client, "CONFIG", openai_client.OpenAIConfig(api_key="test", base_url=stub.base_url))
+        openai_client.reset()
+        monkeypatch.setattr(llm, "PLAN_CACHE", PlanCache(maxsize=100))
+        cfg = llm.LLMConfig(stream=True)
+        monkeypatch.setattr(llm, "LLMConfig", lambda: cfg)
+        stub.plans = plans
+        yield stub
+
+def test_ask_sale_antes_y_el_resto_llega_despues(stream_stub):
+    async def run():
+        t0 = time.perf_counter()
+        step = await llm.plan_next_step("necesito un taladro", {"asked_questions": []})
+        t_early = time.perf_counter() - t0
+        assert step["stream"] == "early" and step["question"] == PLAN["question"]
+        assert step["hypotheses"] == []  # todavía no llegó
+        full = await step["rest"]
+        t_full = time.perf_counter() - t0
+        return step, full, t_early, t_full
+
+    step, full, t_early, t_full = asyncio.run(run())
+    assert full["hypotheses"] == PLAN["hypotheses"] and full["intent"]["family"] == "taladro"
+    assert t_early < t_full / 2
+    # se cachea el plan completo, no el temprano
+    cached = llm.PLAN_CACHE.get(llm.plan_key("necesito un taladro", {"asked_questions": []}, salt=llm._CACHE_SALT))
+    assert cached["hypotheses"] == PLAN["hypotheses"]
+
+def test_search_o_pregunta_repetida_espera_el_json_entero(stream_stub):
+    stream_stub.plans["plan"] = {**PLAN, "action": "search", "query_variants": [["taladro", "percutor"]]}
+    step = asyncio.run(llm.plan_next_step("taladro percutor", {"asked_questions": []}))
+    assert step["stream"] == "full" and step["query_variants"] == [["taladro", "percutor"]]
+
+    stream_stub.plans["plan"] = PLAN
+    step = asyncio.run(llm.plan_next_step("otro", {"asked_questions": [PLAN["question"]]}))
+    assert step["stream"] == "full" and step["question"] == PLAN["alt_questions"][0]
+
+def test_drenaje_acotado_y_cancelable(stream_stub, monkeypatch):
+    stream_stub.chunk_latency = 0.05  # el resto del plan tarda ~1 s en llegar
+    cfg = llm.LLMConfig().model_copy(update={"drain_timeout": 0.2})
+    monkeypatch.setattr(llm, "LLMConfig", lambda: cfg)
+
+    async def run():
+        step = await llm.plan_next_step("necesito un taladro", {"asked_questions": []})
+        t0 = time.perf_counter()
+        full = await step["rest"]
+        waited = time.perf_counter() - t0
+        step2 = await llm.plan_next_step("quiero un taladro", {"asked_questions": []})
+        cancelled = await llm.cancel_background()
+        return step, full, waited, step2, cancelled
+
+    step, full, waited, step2, cancelled = asyncio.run(run())
+    assert step["stream"] == "early" and full is None and waited < 0.5
+    assert cancelled == 1 and step2["rest"].cancelled() and not llm._BACKGROUND
+
+def test_trace_marca_el_plan_parcial(stream_stub, monkeypatch):
+    monkeypatch.setattr(assistant_qa, "LOCAL_RULES", True)  # el router no va al modelo
+    with TestClient(main.app) as http:
+        http.post("/chat", json={"session": "partial", "text": "hola"})
+        out = http.post("/chat", json={"session": "partial", "text": "necesito un taladro"}).json()
+    assert out["trace"]["plan_stream"] == "early" and out["trace"]["plan_partial"] is True
@@ -0,0 +1,189 @@
+import csv
+
+import pytest
+
+from app.search import LocalCatalog
+
+ROWS = [
+    {"id": "1", "name": "Perfil C galvanizado 70x35x0.9mm 3m", "default_code": "PF-C-70x35", "qty_available": "25", "list_price": "14350"},
+    {"id": "2", "name": "Perfil U galvanizado 35x35 3m", "default_code": "PF-U-35x35", "qty_available": "0", "list_price": "11800"},
+    {"id": "3", "name": "Omega galvanizado 45x15 70 mm", "default_code": "PF-O-45x15", "qty_available": "12", "list_price": "12990"},
+    {"id": "4", "name": "Caño PPR 1/2\" termofusión", "default_code": "PPR-12", "qty_available": "3", "list_price": "900"},
+    {"id": "5", "name": "Tornillo T1 punta mecha", "default_code": "T1-PM", "qty_available": "100", "list_price": "10"},
+]
+
+QUERIES = [
+    {"tokens": ["perfil", "70"]},
+    {"tokens": ["perfil", "galv", "3m"]},
+    {"tokens": ["galvanizado", "35"], "not": ["omega"]},
+    {"tokens": ["70 mm"]},
+    {"tokens": ["1/2", "cano"]},
+    {"tokens": ["pf"], "family": "perfil"},
+    {"tokens": [], "not": ["galv"]},
+    {"tokens": ["x", "y", "z"]},
+]
+
+def _catalog(tmp_path) -> LocalCatalog:
+    p = tmp_path / "catalog.csv"
+    with open(p, "w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=list(ROWS[0].keys()))
+        w.writeheader()
+        w.writerows(ROWS)
+    return LocalCatalog(str(p))
+
+def test_indice_igual_al_recorrido_lineal(tmp_path):
+    cat = _catalog(tmp_path)
+    for q in QUERIES:
+        assert cat.search(q) == cat.scan(q), q
+
+def test_and_suave_pide_dos_de_tres(tmp_path):
+    cat = _catalog(tmp_path)
+    codes = [r["default_code"] for r in cat.search({"tokens": ["perfil", "galv", "omega"]})]
+    assert codes == ["PF-C-70x35", "PF-U-35x35", "PF-O-45x15"]
+
+def test_ngramas_igual_al_recorrido_lineal_en_catalogo_real():
+    import os, random
+    from app.search import _tokenize
+    here = os.path.dirname(os.path.abspath(__file__))
+    cat = LocalCatalog(os.path.join(here, "..", "catalog.csv"))
+
+    # consultas armadas con pedazos reales de nombres: palabras, prefijos
+    # parciales ("galv", "70") y subcadenas con espacios
+    rng = random.Random(7)
+    queries = [{"tokens": ["70"]}, {"tokens": ["galv", "70"]}, {"tokens": ["perfil", "70 mm", "x"]}]
+    names = cat._text["_norm_name"]; codes = cat._text["_norm_code"]
+    for i in rng.sample(range(len(cat)), 30):
+        toks = _tokenize(names[i])
+        sub = names[i][3:11]
+        pick = rng.sample(toks, min(3, len(toks)))
+        queries.append({"tokens": [t[:rng.randint(2, 5)] for t in pick],
+                        "not": [rng.choice("aeiou") + rng.choice("nrst")],
+                        "family": sub if rng.random() < 0.3 else None})
+        queries.append({"tokens": pick + [sub, codes[i]]})
+
+    verified = returned = 0
+    for q in queries:
+        stats = {}
+        assert cat.search(q, stats) == cat.scan(q), q
+        verified += stats.get("verified", 0)
+        returned += stats.get("returned", 0)
+    assert returned > 0 and verified > 0
+
+def test_search_many_igual_a_search_por_variante(tmp_path):
+    cat = _catalog(tmp_path)
+    assert cat.search_many(QUERIES) == [cat.search(q) for q in QUERIES]
+
+def test_search_many_corta_en_limit(tmp_path):
+    cat = _catalog(tmp_path)
+    variants = [{"tokens": ["galvanizado"]}, {"tokens": ["perfil"]}, {"tokens": ["tornillo"]}]
+    res = cat.search_many(variants, limit=3)
+    assert [len(h) for h in res] == [3, 0, 0]
+
+def test_snapshot_se_reusa_y_se_invalida_si_cambia_el_csv(tmp_path):
+    import os
+    cat = _catalog(tmp_path)
+    snap = tmp_path / "catalog.csv.snap"
+    assert snap.exists()
+
+    again = LocalCatalog(str(tmp_path / "catalog.csv"))
+    assert again.rows_for(range(len(again))) == cat.rows_for(range(len(cat)))
+    for q in QUERIES:
+        assert again.search(q) == cat.search(q), q
+
+    # mismo contenido con otro mtime: se reusa (hash igual)
+    st = os.stat(tmp_path / "catalog.csv")
+    os.utime(tmp_path / "catalog.csv", ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    touched = LocalCatalog(str(tmp_path / "catalog.csv"))
+    assert touched.rows_for(range(len(touched))) == cat.rows_for(range(len(cat)))
+
+    with open(tmp_path / "catalog.csv", "a", encoding="utf-8") as f:
+        f.write('6,Perfil Omega nuevo,PF-O-NEW,1,1\n')
+    fresh = LocalCatalog(str(tmp_path / "catalog.csv"))
+    assert [r["default_code"] for r in fresh.search({"tokens": ["nuevo"]})] == ["PF-O-NEW"]
+
+@pytest.mark.parametrize("keep", [4, 20, -3, -64])
+def test_snapshot_truncado_se_reconstruye(tmp_path, keep):
+    from app.catalog_snapshot import read_snapshot
+    cat = _catalog(tmp_path)
+    snap = tmp_path / "catalog.csv.snap"
+    raw = snap.read_bytes()
+    snap.write_bytes(raw[:keep])  # escritura cortada (disco lleno, copia a medias)
+    assert read_snapshot(str(snap), str(tmp_path / "catalog.csv")) is None
+
+    again = LocalCatalog(str(tmp_path / "catalog.csv"))
+    assert again.rows_for(range(len(again))) == cat.rows_for(range(len(cat)))
+    assert snap.read_bytes() == raw  # se regeneró completo
+
+def test_columnas_materializan_dicts_con_numeros(tmp_path):
+    cat = _catalog(tmp_path)
+    assert len(cat) == len(ROWS)
+    ids = cat.search_ids({"tokens": ["omega"]})
+    assert ids == [2]
+    r = cat.row(2)
+    assert r["default_code"] == "PF-O-45x15"
+    assert r["qty_available"] == 12.0 and r["list_price"] == 12990.0
+    assert set(r) == set(ROWS[0])
+
+def test_modo_compartido_lee_del_mmap_igual_que_en_memoria(tmp_path):
+    cat = _catalog(tmp_path)
+    shared = LocalCatalog(str(tmp_path / "catalog.csv"), shared=True)
+    assert not isinstance(shared._text["name"], list)
+    assert shared.rows_for(range(len(shared))) == cat.rows_for(range(len(cat)))
+    for q in QUERIES:
+        assert shared.search(q) == cat.search(q), q
+
+def test_recarga_en_caliente_mantiene_el_catalogo_anterior_para_quien_lo_tomo(tmp_path):
+    import time
+    from app.search import ReloadingCatalog
+    _catalog(tmp_path)
+    live = ReloadingCatalog(str(tmp_path / "catalog.csv"), poll_interval=0.02)
+    try:
+        old = live.current()
+        assert live.reload() == {"reloaded": False, "version": 1, "rows": len(ROWS)}
+
+        with open(tmp_path / "catalog.csv", "a", encoding="utf-8") as f:
+            f.write('6,Perfil Omega nuevo,PF-O-NEW,1,1\n')
+        deadline = time.time() + 5
+        while live.version == 1 and time.time() < deadline:
+            time.sleep(0.02)
+        assert live.version == 2
+        assert len(live.current()) == len(ROWS) + 1
+        assert live.search({"tokens": ["nuevo"]})[0]["default_code"] == "PF-O-NEW"
+        # el turno que ya tenía el catálogo viejo sigue viendo lo mismo
+        assert old.search({"tokens": ["nuevo"]}) == []
+
+        forced = live.reload(force=True)
+        assert forced["reloaded"] and forced["version"] == 3 and forced["build_s"] >= 0
+    finally:
+        live.close()
+
+def test_marca_de_recarga_llega_a_otro_worker(tmp_path):
+    from app.search import ReloadingCatalog
+    _catalog(tmp_path)
+    a = ReloadingCatalog(str(tmp_path / "catalog.csv"))
+    b = ReloadingCatalog(str(tmp_path / "catalog.csv"))  # otro proceso, mismo CSV
+    assert b.reload()["reloaded"] is False
+    a.request_reload()
+    assert a.reload(force=True)["version"] == 2
+    # b no recibió el request pero ve la marca en su poll
+    assert b.reload() == {"reloaded": True, "version": 2, "rows": len(ROWS), "build_s": b.last_reload["build_s"]}
+    assert b.reload()["reloaded"] is False
+    assert (tmp_path / "catalog.csv.reload").exists()
+
+def test_admin_reload_protegido_y_fuera_del_request(monkeypatch):
+    from fastapi.testclient import TestClient
+    from app import main
+
+    with TestClient(main.app) as http:
+        monkeypatch.setattr(main.SETTINGS, "admin_token", "")
+        assert http.post("/admin/catalog/reload").status_code == 404  # sin token: deshabilitado
+
+        monkeypatch.setattr(main.SETTINGS, "admin_token", "s3cret")
+        assert http.post("/admin/catalog/reload", headers={"X-Admin-Token": "nope"}).status_code == 403
+        assert http.post("/admin/catalog/reload").status_code == 403
+
+        v = main.CATALOG.version
+        r = http.post("/admin/catalog/reload", headers={"X-Admin-Token": "s3cret"})
+        assert r.status_code == 202 and r.json()["version"] == v
+        r = http.post("/admin/catalog/reload?wait=true", headers={"X-Admin-Token": "s3cret"})
+        assert r.status_code == 200 and r.json()["reloaded"] and main.CATALOG.version >= v + 1
@@ -0,0 +1,124 @@
+import time
+
+import pytest
+
+from app import odoo_client as oc
+from app.settings import settings
+from odoo_stub import OdooStub, template
+
+def _product(i, code, qty, price):
+    return {"id": i, "name": f"Var {code}", "default_code": code, "qty_available": qty,
+            "lst_price": price, "active": True}
+
+def _models(n):
+    # la mitad de los códigos existe como variante; la otra mitad sólo como template
+    tpl = {i: template(i, f"Producto {i}", f"P{i:03d}", i, float(i)) for i in range(1, n + 1)}
+    prod = {i: _product(i, f"P{i:03d}", 100 + i, 1000.0 + i) for i in range(1, n + 1, 2)}
+    return {"product.template": tpl, "product.product": prod}
+
+@pytest.fixture
+def odoo(monkeypatch):
+    def start(n, latency=0.0):
+        stub = OdooStub(_models(n), latency=latency).__enter__()
+        monkeypatch.setattr(settings, "odoo_hydrate", True)
+        monkeypatch.setattr(settings, "odoo_url", stub.url)
+        monkeypatch.setattr(settings, "odoo_db", "db")
+        monkeypatch.setattr(settings, "odoo_user", "u")
+        monkeypatch.setattr(settings, "odoo_password", "p")
+        monkeypatch.setattr(oc, "_CLIENTS", {})
+        monkeypatch.setattr(oc, "CACHE", oc.HydrationCache())
+        stubs.append(stub)
+        return stub
+    stubs = []
+    yield start
+    for s in stubs:
+        s.__exit__(None, None, None)
+
+def _items(n):
+    return [{"default_code": f"P{i:03d}", "name": f"Producto {i}", "price": 0.0, "qty_available": 0}
+            for i in range(1, n + 1)] + [{"default_code": "NO-EXISTE", "price": 1.0}]
+
+def test_batch_mergea_variante_y_template(odoo):
+    stub = odoo(6)
+    out = oc.hydrate_candidates(_items(6))
+    assert [(o["qty_available"], o["price"]) for o in out[:4]] == [(101, 1001.0), (2, 2.0), (103, 1003.0), (4, 4.0)]
+    assert out[-1] == {"default_code": "NO-EXISTE", "price": 1.0}
+    # una llamada por modelo, sin importar la cantidad de códigos
+    assert stub.calls == {"authenticate": 1, "search_read": 2}
+
+    oc.hydrate_candidates(_items(6))
+    assert stub.calls["authenticate"] == 1  # sesión cacheada entre turnos
+
+def test_batch_vs_por_codigo_con_latencia(odoo):
+    stub = odoo(40, latency=0.01)
+    items = _items(40)
+    cli = oc.get_client()
+
+    t0 = time.perf_counter()
+    one = {it["default_code"]: cli.read_product_by_code(it["default_code"]) for it in items}
+    t_one = time.perf_counter() - t0
+    calls_one = stub.calls["search_read"]
+
+    stub.calls.clear()
+    t0 = time.perf_counter()
+    many = cli.read_products_by_codes(it["default_code"] for it in items)
+    t_many = time.perf_counter() - t0
+
+    assert {k: v for k, v in one.items() if v} == many
+    assert stub.calls["search_read"] == 2 and calls_one > 40
+    assert t_many < t_one / 10
+
+def test_odoo_caido_devuelve_items_sin_hidratar(odoo, monkeypatch):
+    odoo(2)
+    monkeypatch.setattr(settings, "odoo_url", "http://127.0.0.1:9")
+    items = _items(2)
+    assert oc.hydrate_candidates(items) == items
+
+def test_sin_flag_no_llama_a_odoo(odoo, monkeypatch):
+    stub = odoo(2)
+    monkeypatch.setattr(settings, "odoo_hydrate", False)
+    items = _items(2)
+    assert oc.hydrate_candidates(items) is items
+    assert stub.calls == {}
+
+class _Clock:
+    def __init__(self):
+        self.t = 0.0
+    def __call__(self):
+        return self.t
+
+def test_cache_ttl_por_campo_negativos_y_stats(odoo):
+    stub = odoo(4)
+    clock = _Clock()
+    cache = oc.HydrationCache(maxsize=100, price_ttl=300, stock_ttl=60, negative_ttl=600, clock=clock)
+    items = _items(4)
+
+    first = oc.hydrate_candidates(items, cache=cache)
+    assert stub.calls["search_read"] == 2
+    assert oc.hydrate_candidates(items, cache=cache) == first
+    assert stub.calls["search_read"] == 2  # todo desde cache, incluido el negativo
+    st = cache.stats()
+    assert (st["hits"], st["misses"], st["negative_hits"]) == (5, 5, 1) and st["hit_rate"] == 0.5
+
+    stub.models["product.product"][1].update(qty_available=0, lst_price=9999.0)
+    clock.t = 61  # vence el stock (no el precio ni el negativo) → se relee sólo qty
+    out = oc.hydrate_candidates(items, cache=cache)
+    assert out[0]["qty_available"] == 0 and out[0]["price"] == 1001.0  # precio aún del cache
+    assert stub.calls["search_read"] == 4
+    assert cache.stats()["stock_refreshes"] == 4
+    assert oc.hydrate_candidates(items, cache=cache) == out
+    assert stub.calls["search_read"] == 4  # stock renovado: vuelve a ser hit
+    clock.t = 301  # vence el precio → relectura completa
+    assert oc.hydrate_candidates(items, cache=cache)[0]["price"] == 9999.0
+    assert stub.calls["search_read"] == 6
+    clock.t = 601  # ahora también vence el negativo
+    stub.calls.clear()
+    oc.hydrate_candidates(items[-1:], cache=cache)
+    assert stub.calls["search_read"] == 2
+
+def test_cache_lru_acotado(odoo):
+    odoo(6)
+    cache = oc.HydrationCache(maxsize=3)
+    oc.hydrate_candidates(_items(6)[:6], cache=cache)
+    assert cache.stats()["size"] == 3 and cache.stats()["evictions"] == 3
+    assert cache.get("P006") is not oc._MISSING and cache.get("P001") is oc._MISSING
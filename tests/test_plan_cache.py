@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from app import llm, openai_client
+from app.plan_cache import PlanCache, plan_key
+from openai_stub import OpenAIStub
+
+STATE = {"asked_questions": [], "answered_slots": {}, "rejected_families": [], "rejected_options": [],
+         "force_more": False, "need_history": ["necesito perfiles para durlock 70"]}
+
+def _planner(messages):
+    return {"action": "ask", "question": "¿Montante o solera? (montante | solera | omega)",
+            "alt_questions": ["¿Qué largo? (2.6 m | 3 m | 4 m)"]}
+
+class _Clock:
+    def __init__(self):
+        self.t = 1000.0
+    def __call__(self):
+        return self.t
+
+def test_clave_normaliza_texto_y_usa_el_estado():
+    k = plan_key("Necesito  perfiles para DURLOCK 70", STATE)
+    assert k == plan_key("necesito perfiles para durlock 70", dict(STATE, need_history=["Necesito perfiles para  durlock 70"]))
+    # apertura: el historial sólo repite el texto actual, no cambia la clave
+    assert k == plan_key("necesito perfiles para durlock 70", dict(STATE, need_history=[]))
+    assert k != plan_key("necesito perfiles para durlock 70", dict(STATE, need_history=["caño 20 mm"]))
+    # misma respuesta corta tras la misma pregunta, con historiales distintos ⇒ claves distintas
+    q = {"pending_question": "Contame el dato clave que falta (por ejemplo, medida o material)."}
+    a = plan_key("70 mm", dict(STATE, **q, need_history=["perfil durlock", "70 mm"]))
+    b = plan_key("70 mm", dict(STATE, **q, need_history=["caño termofusión", "70 mm"]))
+    assert a != b and a != plan_key("70 mm", dict(STATE, need_history=["perfil durlock", "70 mm"]))
+    assert k != plan_key("necesito perfiles para durlock 70", dict(STATE, asked_questions=["¿Montante?"]))
+    assert k != plan_key("necesito perfiles para durlock 70", dict(STATE, force_more=True))
+    assert k != plan_key("necesito perfiles para durlock 70", STATE, salt="otro prompt")
+
+def test_historial_se_resume_normalizado():
+    q = {"pending_question": "¿Qué medida?"}
+    a = plan_key("70 mm", dict(STATE, **q, need_history=["Perfil  DURLOCK", "70 mm"]))
+    # mismas necesidades previas repetidas o en otro orden ⇒ misma clave
+    assert a == plan_key("70 mm", dict(STATE, **q, need_history=["perfil durlock", "perfil durlock", "70 mm"]))
+    assert plan_key("x", dict(STATE, need_history=["a", "b"])) == plan_key("x", dict(STATE, need_history=["b", "a"]))
+
+def test_lru_ttl_y_copias():
+    clock = _Clock()
+    c = PlanCache(maxsize=2, ttl=60, clock=clock)
+    c.put("a", {"question": "A", "alt_questions": ["x"]})
+    got = c.get("a")
+    got["alt_questions"].pop()
+    assert c.get("a") == {"question": "A", "alt_questions": ["x"]}  # el turno no pisa el cache
+    c.put("b", {}); c.put("c", {})
+    assert c.get("a") is None  # LRU
+    clock.t += 61
+    assert c.get("c") is None  # TTL
+    assert c.stats()["hits"] == 2 and c.stats()["misses"] == 2
+
+def test_persistencia_sqlite(tmp_path):
+    path = str(tmp_path / "plans.sqlite")
+    PlanCache(path=path).put("k", {"action": "ask", "question": "Q"})
+    c = PlanCache(path=path)  # "reinicio"
+    assert c.get("k") == {"action": "ask", "question": "Q"}
+    assert c.stats()["disk_hits"] == 1
+
+@pytest.fixture
+def planner(monkeypatch, tmp_path):
+    monkeypatch.setattr(llm, "PLAN_CACHE", PlanCache(path=str(tmp_path / "plans.sqlite")))
+    with OpenAIStub(_planner) as stub:
+        monkeypatch.setattr(openai_client, "CONFIG", openai_client.OpenAIConfig(api_key="test", base_url=stub.base_url))
+        openai_client.reset()
+        yield stub
+
+def test_apertura_repetida_no_llama_al_modelo(planner):
+    async def run():
+        first = await llm.plan_next_step("Necesito perfiles para durlock 70", STATE)
+        again = await llm.plan_next_step("necesito perfiles para  durlock 70", dict(STATE))
+        # otra sesión con la misma apertura (historial con otras mayúsculas/espacios)
+        third = await llm.plan_next_step("necesito perfiles para durlock 70",
+                                         dict(STATE, need_history=["Necesito perfiles  para durlock 70"]))
+        other = await llm.plan_next_step("necesito perfiles para durlock 70", dict(STATE, force_more=True))
+        return first, again, third, other
+
+    first, again, third, other = asyncio.run(run())
+    assert first["used_llm"] and not first["cache_hit"]
+    assert again["cache_hit"] and not again["used_llm"]
+    assert again["question"] == first["question"] and again["alt_questions"] == first["alt_questions"]
+    assert other["used_llm"]  # force_more es parte de la clave
+    assert third["cache_hit"] and not third["used_llm"]
+    assert planner.calls == 2
+    assert llm.PLAN_CACHE.stats()["hits"] == 2
+
+def test_fallback_no_se_cachea(monkeypatch):
+    monkeypatch.setattr(llm, "PLAN_CACHE", PlanCache())
+    monkeypatch.setattr(openai_client, "CONFIG", openai_client.OpenAIConfig(api_key=""))
+    asyncio.run(llm.plan_next_step("hola", STATE))
+    assert llm.PLAN_CACHE.stats()["size"] == 0
@@ -0,0 +1,52 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app import assistant_qa, llm, main, openai_client
+from app.plan_cache import PlanCache
+from openai_stub import OpenAIStub
+
+PENDING = "¿Qué tensión? (12V | 18V | 20V)"
+
+@pytest.mark.parametrize("text,kind", [
+    ("necesito un taladro", "statement_need"),
+    ("estoy buscando tornillos autoperforantes", "statement_need"),
+    ("mostrame perfiles C", "statement_need"),
+    ("perfil c 70", "statement_need"),
+    ("no sé", "statement_need"),
+    ("hola, buenas tardes!", "smalltalk"),
+    ("gracias!!", "smalltalk"),
+    ("18V", "answer_option"),
+])
+def test_clasifica_sin_modelo(text, kind):
+    assert assistant_qa.classify_locally(text, PENDING)["kind"] == kind
+
+@pytest.mark.parametrize("text", [
+    "¿sirve para concreto?", "tenés tornillos?", "cual me conviene",
+    "qué diferencia hay entre el percutor y el atornillador", "como se instala",
+])
+def test_pregunta_real_va_al_modelo(text):
+    assert assistant_qa.classify_locally(text, PENDING) is None
+
+ROUTER_CALLS = []
+
+def _responder(messages):
+    if "Router+Q&A" in messages[0]["content"]:
+        ROUTER_CALLS.append(messages[-1]["content"])
+        return {"kind": "qa", "is_qa": True, "answer": "Sí, sirve.", "confidence": 0.9}
+    return {"action": "ask", "question": "¿Qué tipo de taladro? (percutor | atornillador | banco)",
+            "intent": {"family": "taladro", "family_confidence": 0.8}}
+
+def test_afirmaciones_no_llaman_al_router(monkeypatch):
+    monkeypatch.setattr(assistant_qa, "_STATS", {"local": 0, "llm": 0})
+    with OpenAIStub(_responder, latency=0.0) as stub, TestClient(main.app) as http:
+        monkeypatch.setattr(openai_client, "CONFIG", openai_client.OpenAIConfig(api_key="test", base_url=stub.base_url))
+        openai_client.reset()
+        monkeypatch.setattr(llm, "PLAN_CACHE", PlanCache(maxsize=0))
+        for text in ("hola", "necesito un taladro", "percutor", "¿sirve para concreto?"):
+            out = http.post("/chat", json={"session": "r", "text": text}).json()
+        # hola/afirmación/respuesta: locales; sólo la pregunta real consultó al router
+        assert len(ROUTER_CALLS) == 1 and "concreto" in ROUTER_CALLS[0]
+        assert out["trace"]["mode"] == "qa"
+        stats = out["trace"]["qa_router"]
+        assert stats["llm"] == 1 and stats["local"] >= 2
+        assert stats["local_share"] == round(stats["local"] / (stats["local"] + 1), 3)
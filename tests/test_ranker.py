@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from app.ranker import prerank, rank_and_cut
+from app.search import LocalCatalog, build_query_variants
+
+CATALOG_CSV = os.path.join(os.path.dirname(__file__), "..", "catalog.csv")
+
+CASES = [
+    ("perfil galvanizado 70", ["perfil", "70"], []),
+    ("alambre recocido", ["alambre"], ["galvanizado"]),
+    ("cemento 25 kg", ["cemento"], []),
+    ("tornillo autoperforante", ["tornillo", "t2"], ["madera"]),
+    ("cano ppr 1/2", ["ppr"], []),
+]
+
+@pytest.fixture(scope="module")
+def catalog():
+    return LocalCatalog(CATALOG_CSV, use_snapshot=False)
+
+def _candidates(catalog, text):
+    ids = []
+    for found in catalog.search_many_ids(build_query_variants({"q": text, "must": []}), limit=200):
+        ids.extend(found)
+    return catalog.rows_for(dict.fromkeys(ids))
+
+@pytest.mark.parametrize("text,must,nots", CASES)
+def test_dos_fases_mismo_top4(catalog, text, must, nots):
+    cands = _candidates(catalog, text)
+    assert len(cands) > 8
+    hydrated = []
+    def hydrate(items):  # Odoo con el mismo stock que el CSV
+        hydrated.append(len(items))
+        return [dict(it, price=it.get("list_price")) for it in items]
+
+    full = rank_and_cut(hydrate(cands), must, nots)
+    short = rank_and_cut(hydrate(prerank(cands, must, nots, k=8)), must, nots)
+    assert [it["default_code"] for it in short] == [it["default_code"] for it in full]
+    assert hydrated[1] == 8 and hydrated[0] >= hydrated[1]
+
+def test_prerank_dedup_y_k_mayor_que_candidatos():
+    items = [{"default_code": "A", "name": "perfil"}, {"default_code": "A", "name": "perfil"},
+             {"default_code": "B", "name": "omega", "qty_available": 3}]
+    assert [it["default_code"] for it in prerank(items, ["perfil"], [], k=8)] == ["A", "B"]
+    assert [it["default_code"] for it in prerank(items, [], [], k=1)] == ["B"]
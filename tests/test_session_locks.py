@@ -0,0 +1,95 @@
+import asyncio, random
+
+from app import llm, main, openai_client
+from app.main import ChatIn, SessionState
+from app.plan_cache import PlanCache
+from app.sessions import SessionLocks, SQLiteSessionStore
+from openai_stub import OpenAIStub
+
+def test_lock_por_sesion_en_orden_y_sin_fugas():
+    locks, log = SessionLocks(), []
+
+    async def turn(session, i):
+        async with locks.hold(session):
+            log.append((session, i, "in"))
+            await asyncio.sleep(random.random() / 100)
+            log.append((session, i, "out"))
+
+    async def run():
+        await asyncio.gather(*(turn(f"s{i % 3}", i) for i in range(30)))
+
+    asyncio.run(run())
+    for s in ("s0", "s1", "s2"):
+        mine = [(i, ev) for ses, i, ev in log if ses == s]
+        # nunca dos turnos a la vez de la misma sesión, y en orden de llegada
+        assert [ev for _, ev in mine] == ["in", "out"] * 10
+        assert [i for i, _ in mine[::2]] == sorted(i for i, _ in mine[::2])
+    # hubo sesiones distintas intercaladas (en paralelo)
+    assert [ses for ses, _, ev in log[:6] if ev == "in"] != ["s0"] * 3
+    assert len(locks) == 0 and locks.waits > 0
+
+def _responder(messages):
+    return {"action": "ask", "question": f"¿Qué medida? (opción {random.randint(0, 10 ** 6)} | otra)",
+            "intent": {"family": "tornillo", "family_confidence": 0.7}}
+
+def test_estres_mensajes_intercalados_de_muchas_sesiones(monkeypatch, tmp_path):
+    sessions, per_session = 40, 5
+    store = SQLiteSessionStore(SessionState, str(tmp_path / "s.sqlite"))
+    monkeypatch.setattr(main, "SESSIONS", store)
+    monkeypatch.setattr(main, "SESSION_LOCKS", SessionLocks())
+    monkeypatch.setattr(llm, "PLAN_CACHE", PlanCache(maxsize=0))
+    with OpenAIStub(_responder, latency=0.02) as stub:
+        monkeypatch.setattr(openai_client, "CONFIG", openai_client.OpenAIConfig(api_key="t", base_url=stub.base_url))
+        openai_client.reset()
+
+        async def user(i):
+            # los mensajes de un usuario llegan casi juntos, intercalados con los de los demás
+            msgs = ["hola"] + [f"necesito tornillos tipo {k}" for k in range(1, per_session)]
+            return await asyncio.gather(*(main.chat(ChatIn(session=f"wa{i}", text=m)) for m in msgs))
+
+        async def run():
+            return await asyncio.gather(*(user(i) for i in range(sessions)))
+
+        outs = asyncio.run(run())
+        assert stub.max_inflight > 1  # sesiones distintas en paralelo
+
+    for i, replies in enumerate(outs):
+        st = store.load(f"wa{i}")
+        assert st.need_history == ["hola"] + [f"necesito tornillos tipo {k}" for k in range(1, per_session)]
+        assert replies[0].trace["note"] == "greeting_only"
+        # cada respuesta quedó registrada: ninguna escritura pisó a otra
+        assert st.asked_questions == [r.reply for r in replies[1:]]
+        assert st.pending_question == replies[-1].reply
+    assert len(main.SESSION_LOCKS) == 0
+
+def test_estres_dos_workers_sobre_el_mismo_archivo(monkeypatch, tmp_path):
+    # dos procesos de uvicorn: cada uno con su store y sus locks, misma base SQLite
+    path = str(tmp_path / "s.sqlite")
+    workers = [(SQLiteSessionStore(SessionState, path), SessionLocks()) for _ in range(2)]
+    sessions, per_session = 12, 6
+    monkeypatch.setattr(llm, "PLAN_CACHE", PlanCache(maxsize=0))
+    with OpenAIStub(_responder, latency=0.02) as stub:
+        monkeypatch.setattr(openai_client, "CONFIG", openai_client.OpenAIConfig(api_key="t", base_url=stub.base_url))
+        openai_client.reset()
+
+        async def user(i):
+            msgs = [f"necesito tornillos tipo {k}" for k in range(per_session)]
+            # Meta reparte los mensajes de un mismo wa_id entre los dos workers
+            return await asyncio.gather(*(main._serve_turn(ChatIn(session=f"wa{i}", text=m), *workers[k % 2])
+                                          for k, m in enumerate(msgs)))
+
+        async def run():
+            return await asyncio.gather(*(user(i) for i in range(sessions)))
+
+        outs = asyncio.run(run())
+
+    store = workers[0][0]
+    for i, replies in enumerate(outs):
+        st = store.load(f"wa{i}")
+        # ningún turno se perdió: cada mensaje y cada pregunta quedó una vez
+        assert sorted(st.need_history) == sorted(f"necesito tornillos tipo {k}" for k in range(per_session))
+        greetings = [r for r in replies if r.trace.get("note") == "greeting_only"]
+        assert len(greetings) == 1 and len(st.asked_questions) == per_session - 1
+        assert all(any(q in r.reply for r in replies) for q in st.asked_questions)
+    assert sum(w.stats()["lease_waits"] for w, _ in workers) > 0
+    assert store._db.execute("SELECT COUNT(*) FROM leases").fetchone()[0] == 0
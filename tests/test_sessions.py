@@ -0,0 +1,136 @@
+import asyncio, json, sqlite3, threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+from app.main import SessionState
+from app.sessions import (MemorySessionStore, SessionConflict, SessionStore, SQLiteSessionStore,
+                          make_session_store)
+from app.whatsapp_bridge_handler import reset_session
+
+class Clock:
+    def __init__(self):
+        self.t = 1000.0
+    def __call__(self):
+        return self.t
+
+def test_memory_lru_y_ttl():
+    clock = Clock()
+    store = MemorySessionStore(SessionState, ttl=60, maxsize=2, clock=clock)
+    a = store.load("a")
+    a.greeted = True
+    store.save("a", a)
+    assert store.load("a") is a  # objeto vivo, sin serializar
+    store.save("b", SessionState())
+    store.save("c", SessionState())
+    assert len(store) == 2 and store.load("a").greeted is False and store.evictions == 1
+
+    clock.t += 61
+    assert store.load("c") == SessionState() and store.expired == 1
+
+def test_sqlite_compacto_y_compartido(tmp_path):
+    path = str(tmp_path / "sessions.sqlite")
+    clock = Clock()
+    w1 = SQLiteSessionStore(SessionState, path, ttl=60, clock=clock)
+    w2 = SQLiteSessionStore(SessionState, path, ttl=60, clock=clock)  # otro worker
+    st = w1.load("549111")
+    st.greeted, st.asked_questions = True, ["¿Qué medida? (35mm | 70mm)"]
+    w1.save("549111", st)
+
+    raw = w1._db.execute("SELECT state FROM sessions").fetchone()[0]
+    assert json.loads(raw) == {"greeted": True, "asked_questions": ["¿Qué medida? (35mm | 70mm)"]}
+    assert w2.load("549111") == st
+
+    clock.t += 30
+    w2.save("549111", w2.load("549111"))  # un turno renueva el TTL
+    clock.t += 45
+    assert w1.load("549111").greeted
+    clock.t += 61
+    assert w1.load("549111") == SessionState() and len(w1) == 0
+    assert w1.purge_expired() == 1
+
+def test_len_no_cuenta_vencidas_y_base_abstracta():
+    clock = Clock()
+    store = MemorySessionStore(SessionState, ttl=60, clock=clock)
+    store.save("a", SessionState())
+    clock.t += 30
+    store.save("b", SessionState())
+    clock.t += 31
+    assert len(store) == 1 and store.expired == 1 and store.stats()["size"] == 1
+    with pytest.raises(TypeError):
+        SessionStore(SessionState, ttl=60)
+
+def test_sqlite_async_fuera_del_loop(tmp_path):
+    store = SQLiteSessionStore(SessionState, str(tmp_path / "s.sqlite"))
+    threads = []
+    load = store.load
+    def spy(session):
+        threads.append(threading.current_thread())
+        return load(session)
+    store.load = spy
+
+    async def turn():
+        st = await store.aload("x")
+        st.greeted = True
+        await store.asave("x", st)
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(turn())
+    assert threads and threads[0] is not loop_thread
+    assert store.load("x").greeted
+
+def test_sqlite_save_condicional_por_version(tmp_path):
+    path = str(tmp_path / "s.sqlite")
+    w1, w2 = SQLiteSessionStore(SessionState, path), SQLiteSessionStore(SessionState, path)
+    a, b = w1.load("wa"), w2.load("wa")  # los dos leen la sesión (todavía no existe)
+    a.need_history = ["hola"]
+    w1.save("wa", a)
+    b.need_history = ["otro mensaje"]
+    with pytest.raises(SessionConflict):
+        w2.save("wa", b)  # habría pisado lo de w1
+    assert w2.load("wa").need_history == ["hola"] and w2.stats()["conflicts"] == 1
+
+    a, b = w1.load("wa"), w2.load("wa")
+    a.need_history.append("taladro")
+    w1.save("wa", a)
+    with pytest.raises(SessionConflict):
+        w2.save("wa", b)
+    b = w2.load("wa")  # releer y reintentar sí pasa
+    b.need_history.append("percutor")
+    w2.save("wa", b)
+    assert w1.load("wa").need_history == ["hola", "taladro", "percutor"]
+
+def test_sqlite_migra_tabla_sin_version(tmp_path):
+    path = str(tmp_path / "s.sqlite")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE sessions (id TEXT PRIMARY KEY, expires REAL, state TEXT)")
+    db.execute("INSERT INTO sessions VALUES ('wa', 1e12, '{\"greeted\": true}')")
+    db.commit()
+    db.close()
+    store = SQLiteSessionStore(SessionState, path)
+    st = store.load("wa")
+    assert st.greeted
+    store.save("wa", st)
+
+def test_backend_desconocido():
+    with pytest.raises(ValueError):
+        make_session_store(SessionState, "redis")
+    with pytest.raises(ValueError):
+        make_session_store(SessionState, "sqlite")
+
+def test_turnos_en_workers_distintos_comparten_estado(monkeypatch, tmp_path):
+    path = str(tmp_path / "sessions.sqlite")
+    workers = [SQLiteSessionStore(SessionState, path), SQLiteSessionStore(SessionState, path)]
+    with TestClient(main.app) as http:
+        monkeypatch.setattr(main, "SESSIONS", workers[0])
+        first = http.post("/chat", json={"session": "wa", "text": "hola"}).json()
+        assert first["trace"]["note"] == "greeting_only"
+
+        monkeypatch.setattr(main, "SESSIONS", workers[1])
+        second = http.post("/chat", json={"session": "wa", "text": "necesito un taladro"}).json()
+        assert second["trace"].get("note") != "greeting_only"
+        assert workers[0].load("wa").need_history == ["hola", "necesito un taladro"]
+
+        reset_session("wa")
+        assert workers[0].load("wa") == SessionState()
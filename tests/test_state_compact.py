@@ -0,0 +1,81 @@
+import asyncio
+
+from app import llm, openai_client
+from app.plan_cache import PlanCache
+from app.state_compact import compact_state, count_tokens, state_tokens
+from openai_stub import OpenAIStub
+
+def _long_state(turns):
+    return {
+        "greeted": True,
+        "asked_questions": [f"¿Qué medida del perfil {i}? (35mm | 70mm | 100mm | 150mm)" for i in range(turns)],
+        "need_history": [f"necesito perfiles para durlock, tanda {i}" for i in range(turns)],
+        "rejected_families": ["taladro", "taladro", "amoladora"],
+        "rejected_options": [f"opción {i}" for i in range(turns)],
+        "answered_slots": {"uso": "obra"},
+        "force_more": False,
+    }
+
+def test_dedup_sin_tocar_lo_demas():
+    st = {"asked_questions": ["a", "b", "a"], "answered_slots": {"x": "1"}, "rejected_families": ["t", " t "]}
+    out = compact_state(st, budget=0)
+    assert out["asked_questions"] == ["b", "a"] and out["rejected_families"] == ["t"]
+    assert out["answered_slots"] == {"x": "1"} and st["asked_questions"] == ["a", "b", "a"]
+
+def test_resume_lo_viejo_y_respeta_el_presupuesto():
+    st = _long_state(30)
+    out = compact_state(st, budget=300)
+    assert state_tokens(out) <= 300 < state_tokens(st)
+    assert out["asked_questions"] == st["asked_questions"][-len(out["asked_questions"]):]
+    assert out["need_history"][-1] == st["need_history"][-1]
+    assert all("|" not in q for q in out.get("asked_before", []))  # sólo enunciados
+
+def test_tope_chico_deja_lo_mas_reciente():
+    st = _long_state(30)
+    out = compact_state(st, budget=60)
+    assert out["asked_questions"] == st["asked_questions"][-1:]
+    assert out["need_history"] == st["need_history"][-1:]
+
+def test_prompt_plano_en_sesiones_largas(monkeypatch):
+    plan = {"action": "ask", "question": "¿Qué espesor? (0.5mm | 0.9mm)"}
+    with OpenAIStub(lambda m: plan) as stub:
+        monkeypatch.setattr(openai_client, "CONFIG", openai_client.OpenAIConfig(api_key="t", base_url=stub.base_url))
+        openai_client.reset()
+        monkeypatch.setattr(llm, "PLAN_CACHE", PlanCache(maxsize=0))
+        short = asyncio.run(llm.plan_next_step("perfil", _long_state(3)))["tokens"]
+        long = asyncio.run(llm.plan_next_step("perfil", _long_state(60)))["tokens"]
+    assert long["state_raw"] > 5 * short["state_raw"]
+    assert long["state"] <= llm.LLMConfig().state_budget
+    assert long["prompt"] - short["prompt"] <= llm.LLMConfig().state_budget
+    assert short["prompt"] > count_tokens(llm.SYSTEM_PROMPT)
+
+def test_rechazos_se_sueltan_al_final_y_sin_reserializar(monkeypatch):
+    from app import state_compact
+    calls = []
+    real = state_compact.state_tokens
+    monkeypatch.setattr(state_compact, "state_tokens", lambda s, m="gpt-4o-mini": calls.append(1) or real(s, m))
+    st = _long_state(30)
+    out = compact_state(st, budget=120)
+    assert out["rejected_options"] == st["rejected_options"][-10:]  # la charla vieja se fue antes
+    assert out["rejected_families"] == ["taladro", "amoladora"]
+    assert out["need_history"] == st["need_history"][-1:] and real(out) <= 120
+    assert len(calls) <= 4  # no una medición por ítem soltado
+
+def test_encoding_se_carga_una_vez_fuera_del_event_loop(monkeypatch):
+    import threading, types
+    from app import state_compact
+    loads = []
+    def encoding_for_model(model):  # el real puede bajar el BPE por red
+        loads.append(threading.current_thread())
+        return types.SimpleNamespace(encode=lambda text: text.split())
+    monkeypatch.setattr(state_compact, "tiktoken", types.SimpleNamespace(encoding_for_model=encoding_for_model))
+    monkeypatch.setattr(state_compact, "_ENCODINGS", {})
+    plan = {"action": "ask", "question": "¿Qué espesor? (0.5mm | 0.9mm)"}
+    with OpenAIStub(lambda m: plan) as stub:
+        monkeypatch.setattr(openai_client, "CONFIG", openai_client.OpenAIConfig(api_key="t", base_url=stub.base_url))
+        openai_client.reset()
+        monkeypatch.setattr(llm, "PLAN_CACHE", PlanCache(maxsize=0))
+        for _ in range(2):
+            asyncio.run(llm.plan_next_step("perfil", _long_state(3)))
+    assert len(loads) == 1 and loads[0] is not threading.main_thread()
+    assert state_compact.encoding_ready(llm.LLMConfig().model)
@@ -0,0 +1,98 @@
+import pytest
+
+import whatsapp_adapter as wa_mod
+
+RAW = "5492944899918"
+
+def _client(resolved=None, works=None):
+    cli = wa_mod.WhatsAppClient("t", "0", resolved=resolved if resolved is not None else wa_mod.ResolvedNumbers(path=None))
+    variants = wa_mod.generate_argentina_variants(RAW)
+    state = {"works": works or variants[2], "posts": [], "outage": []}
+
+    def send_text(to, text):
+        state["posts"].append(to)
+        if state["outage"]:  # falla general de Graph, no del número
+            return False, state["outage"].pop(0)
+        if to == state["works"]:
+            return True, {"to": to}
+        return False, {"error": {"code": 131026, "message": "Message undeliverable"}, "status_code": 400}
+    cli.send_text = send_text
+    return cli, state, variants
+
+@pytest.fixture(autouse=True)
+def _sin_espera(monkeypatch):
+    monkeypatch.setattr(wa_mod, "WA_SEND_BACKOFF", 0.0)
+    monkeypatch.setattr(wa_mod, "WA_SEND_RETRIES", 2)
+
+def test_recuerda_la_variante_que_funciono():
+    cli, st, variants = _client()
+    ok, _, tried = cli.send_text_try_arg_variants(RAW, "hola")
+    assert ok and tried == variants[:3]
+    for _ in range(4):  # los demás chunks van directo
+        assert cli.send_text_try_arg_variants(RAW, "chunk")[2] == [variants[2]]
+    assert len(st["posts"]) == 3 + 4
+    s = cli.stats()
+    assert s["messages"] == 5 and s["attempts"] == 7 and s["resolved_hits"] == 4
+    assert s["attempts_per_message"] == 1.4
+
+def test_falla_de_entrega_invalida_y_vuelve_a_probar():
+    cli, st, variants = _client()
+    cli.send_text_try_arg_variants(RAW, "hola")
+    st["works"] = variants[0]  # el número que andaba dejó de andar
+    ok, _, tried = cli.send_text_try_arg_variants(RAW, "otra")
+    assert ok and tried == [variants[2], variants[0]]
+    assert cli.resolved.get(RAW) == variants[0] and cli.stats()["invalidations"] == 1
+
+    st["works"] = None
+    ok, _, tried = cli.send_text_try_arg_variants(RAW, "nada")
+    assert not ok and cli.resolved.get(RAW) is None and cli.stats()["undelivered"] == 1
+
+def test_persistencia_entre_procesos(tmp_path):
+    path = str(tmp_path / "resolved.sqlite")
+    cli, _, variants = _client(resolved=wa_mod.ResolvedNumbers(path=path))
+    cli.send_text_try_arg_variants(RAW, "hola")
+    again, st, _ = _client(resolved=wa_mod.ResolvedNumbers(path=path))
+    again.send_text_try_arg_variants(RAW, "hola")
+    assert st["posts"] == [variants[2]]
+
+def test_falla_transitoria_reintenta_el_numero_conocido():
+    cli, st, variants = _client()
+    cli.send_text_try_arg_variants(RAW, "hola")
+    st["posts"].clear()
+    st["outage"] = [{"error": {"code": 130429, "message": "Rate limit hit"}, "status_code": 429}]
+    ok, _, tried = cli.send_text_try_arg_variants(RAW, "chunk")
+    assert ok and tried == [variants[2], variants[2]]  # sin probar otras variantes
+    assert cli.resolved.get(RAW) == variants[2] and cli.stats()["invalidations"] == 0
+
+    st["outage"] = [{"error": {"code": 190, "message": "token expirado"}, "status_code": 401}] * 3
+    ok, _, tried = cli.send_text_try_arg_variants(RAW, "otro")
+    assert not ok and tried == [variants[2]] * 3 and cli.resolved.get(RAW) == variants[2]
+
+def test_falla_general_no_abandona_las_demas_variantes():
+    cli, st, variants = _client()
+    st["outage"] = [{"status_code": 503, "text": "Service Unavailable"}] * 3  # agota los reintentos del primero
+    ok, _, tried = cli.send_text_try_arg_variants(RAW, "hola")
+    assert ok and tried == [variants[0]] * 3 + variants[1:3]
+    assert cli.resolved.get(RAW) == variants[2]
+
+def test_status_failed_olvida_la_variante():
+    cli, st, variants = _client()
+    cli.send_text = lambda to, text: (st["posts"].append(to) or True, {"messages": [{"id": f"wamid.{len(st['posts'])}"}]})
+    cli.resolved.put(RAW, variants[1])
+    cli.send_text_try_arg_variants(RAW, "hola")
+    # la ventana de 24 h vencida no es culpa del número
+    assert cli.delivery_failed([{"id": "wamid.1", "status": "failed", "errors": [{"code": 131047}]}]) == 0
+    assert cli.resolved.get(RAW) == variants[1]
+
+    cli.send_text_try_arg_variants(RAW, "otra")
+    assert cli.delivery_failed([{"id": "wamid.2", "status": "failed", "recipient_id": "otro",
+                                 "errors": [{"code": 131026}]}]) == 1
+    assert cli.resolved.get(RAW) is None and cli.stats()["delivery_failures"] == 2
+
+def test_numeros_resueltos_lru_acotado():
+    resolved = wa_mod.ResolvedNumbers(path=None, maxsize=2)
+    resolved.put("a", "1")
+    resolved.put("b", "2")
+    resolved.get("a")
+    resolved.put("c", "3")
+    assert len(resolved) == 2 and resolved.get("b") is None and resolved.get("a") == "1"
@@ -0,0 +1,183 @@
+import asyncio, time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import whatsapp_adapter as wa_mod
+
+def _payload(*msgs):
+    return {"entry": [{"changes": [{"value": {
+        "contacts": [{"profile": {"name": "Cliente"}}],
+        "messages": [{"id": mid, "from": frm, "type": "text", "text": {"body": body}} for mid, frm, body in msgs],
+    }}]}]}
+
+@pytest.fixture
+def webhook(monkeypatch):
+    sent, handled = [], []
+
+    async def handler(user_id, text):
+        handled.append((user_id, text))
+        await asyncio.sleep(0.2)  # "varias llamadas al LLM"
+        return [f"re: {text}", "¿algo más?"]
+
+    def send(to, text):
+        time.sleep(0.01)  # POST bloqueante a Graph
+        sent.append((to, text))
+        return True, {}, [to]
+
+    monkeypatch.setattr(wa_mod, "handle_message", handler)
+    monkeypatch.setattr(wa_mod.wa, "send_text_try_arg_variants", send)
+    monkeypatch.setattr(wa_mod, "WA_SEND_DELAY", 0.0)
+    queue = wa_mod.MessageQueue(wa_mod.process_message, workers=4, maxsize=6)
+    monkeypatch.setattr(wa_mod, "QUEUE", queue)
+    monkeypatch.setattr(wa_mod, "SEEN", wa_mod.SeenMessages(path=None))
+    with TestClient(wa_mod.app) as http:
+        def drain(timeout=5.0):
+            t0 = time.perf_counter()
+            while queue.stats()["processed"] + queue.stats()["failed"] < queue.enqueued:
+                assert time.perf_counter() - t0 < timeout
+                time.sleep(0.01)
+        http.sent, http.handled, http.queue, http.drain = sent, handled, queue, drain
+        yield http
+
+def test_ack_inmediato_y_respuestas_en_segundo_plano(webhook):
+    t0 = time.perf_counter()
+    r = webhook.post("/webhook", json=_payload(("m1", "5491", "hola"), ("m2", "5491", "taladro"),
+                                               ("m3", "5492", "perfil")))
+    assert r.status_code == 200 and r.json() == {"status": "ok", "queued": 3, "duplicates": 0}
+    assert time.perf_counter() - t0 < 0.15 and webhook.sent == []
+
+    webhook.drain()
+    mine = [t for to, t in webhook.sent if to == "5491"]
+    assert mine == ["re: hola", "¿algo más?", "re: taladro", "¿algo más?"]  # en orden por usuario
+    m = webhook.get("/metrics").json()["queue"]
+    assert m["processed"] == 3 and m["depth"] == 0 and m["max_depth"] >= 1 and m["avg_process_ms"] >= 200
+
+def test_usuarios_distintos_en_paralelo(webhook):
+    t0 = time.perf_counter()
+    webhook.post("/webhook", json=_payload(*[(f"m{i}", f"54{i}", "hola") for i in range(4)]))
+    webhook.drain()
+    assert time.perf_counter() - t0 < 0.6  # 4 × 0.2 s en serie serían 0.8 s
+
+def test_rafaga_de_un_usuario_no_bloquea_a_los_demas(webhook):
+    t0 = time.perf_counter()
+    burst = [(f"r{i}", "5491", f"msg {i}") for i in range(4)]
+    r = webhook.post("/webhook", json=_payload(*burst, ("o1", "5492", "hola"), ("o2", "5493", "hola")))
+    assert r.status_code == 200
+    done = {}
+    while len(done) < 2:
+        for to, _ in webhook.sent:
+            if to != "5491":
+                done.setdefault(to, time.perf_counter() - t0)
+        assert time.perf_counter() - t0 < 2.0
+        time.sleep(0.01)
+    assert max(done.values()) < 0.4  # no quedan detrás de la ráfaga (4 × 0.2 s)
+    assert webhook.queue.stats()["inflight"] <= 3  # la ráfaga ocupa un solo worker
+    webhook.drain()
+    mine = [t for to, t in webhook.sent if to == "5491" and t.startswith("re:")]
+    assert mine == [f"re: msg {i}" for i in range(4)]
+
+def test_cola_llena_responde_503(webhook):
+    busy = _payload(*[(f"w{i}", f"54{i}", "x") for i in range(4)])  # ocupa los 4 workers
+    assert webhook.post("/webhook", json=busy).status_code == 200
+    time.sleep(0.05)
+    assert webhook.post("/webhook", json=_payload(*[(f"a{i}", f"55{i}", "x") for i in range(6)])).status_code == 200
+    r = webhook.post("/webhook", json=_payload(("b1", "5492", "y")))
+    assert r.status_code == 503
+    assert webhook.get("/metrics").json()["queue"]["rejected"] == 1
+    webhook.drain()
+    assert len(webhook.handled) == 10
+
+def test_error_del_handler_avisa_al_usuario(webhook, monkeypatch):
+    async def boom(user_id, text):
+        raise RuntimeError("llm caído")
+    monkeypatch.setattr(wa_mod, "handle_message", boom)
+    webhook.post("/webhook", json=_payload(("m1", "5491", "hola")))
+    webhook.drain()
+    assert webhook.sent == [("5491", "Tuvimos un problema interno, ¿podés repetir tu consulta?")]
+
+def test_payload_sin_mensajes(webhook):
+    r = webhook.post("/webhook", json={"entry": [{"changes": [{"value": {"statuses": [{}]}}]}]})
+    assert r.json() == {"status": "ok", "queued": 0, "duplicates": 0}
+
+def test_reenvio_de_meta_no_vuelve_a_correr_el_turno(webhook):
+    first = _payload(("wamid.1", "5491", "hola"))
+    webhook.post("/webhook", json=first)
+    r = webhook.post("/webhook", json=first)  # Meta se cansó de esperar y reenvía
+    assert r.json() == {"status": "ok", "queued": 0, "duplicates": 1}
+    webhook.post("/webhook", json=_payload(("wamid.1", "5491", "hola"), ("wamid.2", "5491", "taladro")))
+    webhook.drain()
+    assert webhook.handled == [("5491", "hola"), ("5491", "taladro")]
+    assert webhook.get("/metrics").json()["dedup"]["suppressed"] == 2
+
+def test_rechazado_por_cola_llena_pasa_en_el_reintento(webhook):
+    webhook.post("/webhook", json=_payload(*[(f"w{i}", f"54{i}", "x") for i in range(4)]))
+    time.sleep(0.05)
+    webhook.post("/webhook", json=_payload(*[(f"a{i}", f"55{i}", "x") for i in range(6)]))
+    retry = _payload(("b1", "5492", "y"))
+    assert webhook.post("/webhook", json=retry).status_code == 503
+    webhook.drain()
+    assert webhook.post("/webhook", json=retry).json()["queued"] == 1
+
+@pytest.mark.parametrize("timeout", [5.0, 0.3])
+def test_apagado_drena_la_cola(monkeypatch, timeout):
+    sent = []
+    async def handler(user_id, text):
+        await asyncio.sleep(0.2)
+        return [f"re: {text}"]
+    monkeypatch.setattr(wa_mod, "handle_message", handler)
+    monkeypatch.setattr(wa_mod.wa, "send_text_try_arg_variants", lambda to, text: sent.append(text) or (True, {}, [to]))
+    monkeypatch.setattr(wa_mod, "WA_SEND_DELAY", 0.0)
+    monkeypatch.setattr(wa_mod, "WA_DRAIN_TIMEOUT", timeout)
+    queue = wa_mod.MessageQueue(wa_mod.process_message, workers=2)
+    monkeypatch.setattr(wa_mod, "QUEUE", queue)
+    monkeypatch.setattr(wa_mod, "SEEN", wa_mod.SeenMessages(path=None))
+    with TestClient(wa_mod.app) as http:  # un usuario, 5 mensajes en serie: ~1 s
+        assert http.post("/webhook", json=_payload(*[(f"m{i}", "5491", str(i)) for i in range(5)])).status_code == 200
+    # al salir corrió el shutdown: esperó hasta `timeout` y contó lo que no llegó a procesarse
+    dropped = queue.stats()["dropped"]
+    assert queue.closing and (dropped == 0 if timeout > 1 else dropped >= 2)
+    assert len(sent) + dropped == 5
+    assert not queue.offer([{"user_id": "5492", "text": "tarde"}])  # ya no acepta
+
+class Clock:
+    def __init__(self):
+        self.t = 1000.0
+    def __call__(self):
+        return self.t
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_seen_ventana_y_backend(backend, tmp_path):
+    clock = Clock()
+    path = str(tmp_path / "seen.sqlite") if backend == "sqlite" else None
+    seen = wa_mod.SeenMessages(window=60, maxsize=100, path=path, clock=clock)
+    assert seen.add("a") and not seen.add("a") and seen.add(None)
+    clock.t += 61
+    assert seen.add("a")  # fuera de la ventana vuelve a contar como nuevo
+    seen.forget(["a"])
+    assert seen.add("a")
+    assert seen.stats()["suppressed"] == 1
+    if path:  # otro worker sobre el mismo archivo ve lo mismo
+        other = wa_mod.SeenMessages(window=60, path=path, clock=clock)
+        assert not other.add("a") and other.add("b")
+    assert seen.stats()["size"] == (2 if path else 1)  # en SQLite cuenta lo de todos los workers
+    assert asyncio.run(seen.aadd("c")) and not asyncio.run(seen.aadd("c"))
+    asyncio.run(seen.aforget(["c"]))
+    assert seen.add("c")
+
+def test_seen_memoria_acotada():
+    seen = wa_mod.SeenMessages(window=60, maxsize=2, path=None)
+    for i in "abc":
+        seen.add(i)
+    assert seen.stats()["size"] == 2 and seen.add("a")
+
+def test_status_failed_del_webhook_olvida_el_numero(webhook, monkeypatch):
+    seen = []
+    monkeypatch.setattr(wa_mod.wa, "delivery_failed", lambda statuses: seen.extend(statuses) or len(statuses))
+    body = {"entry": [{"changes": [{"value": {"statuses": [
+        {"id": "wamid.1", "status": "delivered", "recipient_id": "5491"},
+        {"id": "wamid.2", "status": "failed", "recipient_id": "5491", "errors": [{"code": 131026}]},
+    ]}}]}]}
+    r = webhook.post("/webhook", json=body)
+    assert r.status_code == 200 and r.json()["queued"] == 0
+    assert [s["id"] for s in seen] == ["wamid.2"]
@@ -1,13 +1,16 @@
 # whatsapp_adapter.py
 from __future__ import annotations
-import os, re, json, time, importlib, logging
-from typing import Callable, Iterable, List, Optional, Tuple, Union
+import os, re, json, time, asyncio, importlib, inspect, logging, sqlite3, threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 import requests
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import PlainTextResponse, JSONResponse
 from dotenv import load_dotenv
 
+
 # ------------------------------------------------------------------------------
 # Config
 # ------------------------------------------------------------------------------
@@ -18,6 +21,17 @@ WA_ACCESS_TOKEN = os.getenv("WA_ACCESS_TOKEN")                  # tu token de Me
 WA_PHONE_ID     = os.getenv("WA_DEFAULT_PHONE_ID")              # ej: 874624205724101
 FELIA_HANDLER_PATH = os.getenv("FELIA_HANDLER", "felia_adapter_bridge:handle_message")
 FELIA_RESET_HANDLER_PATH = os.getenv("FELIA_RESET_HANDLER")     # opcional: mod:func
+WA_WORKERS      = int(os.getenv("WA_WORKERS", "8") or 8)            # mensajes procesándose a la vez
+WA_QUEUE_MAX    = int(os.getenv("WA_QUEUE_MAX", "1000") or 1000)    # cola llena ⇒ 503 (Meta reintenta)
+WA_DRAIN_TIMEOUT = float(os.getenv("WA_DRAIN_TIMEOUT", "20") or 0)   # s para vaciar la cola al apagar
+WA_SEND_DELAY   = float(os.getenv("WA_SEND_DELAY", "0.25") or 0)    # s entre chunks de una respuesta
+WA_DEDUP_WINDOW = float(os.getenv("WA_DEDUP_WINDOW", "86400") or 0)  # s que se recuerda un messages[].id
+WA_DEDUP_MAX    = int(os.getenv("WA_DEDUP_MAX", "50000") or 50000)
+WA_DEDUP_PATH   = os.getenv("WA_DEDUP_PATH") or None                 # SQLite compartido entre workers
+WA_VARIANT_PATH = os.getenv("WA_VARIANT_PATH") or None               # persistir el número que funcionó por wa_id
+WA_VARIANT_MAX  = int(os.getenv("WA_VARIANT_MAX", "50000") or 50000)   # wa_ids recordados en memoria (LRU)
+WA_SEND_RETRIES = int(os.getenv("WA_SEND_RETRIES", "2") or 0)         # reintentos ante 429/5xx/token, mismo número
+WA_SEND_BACKOFF = float(os.getenv("WA_SEND_BACKOFF", "0.5") or 0)     # s de espera base entre reintentos
 
 def _require_env():
     missing = [k for k, v in {
@@ -97,14 +111,77 @@ def reset_session(user_id: str) -> bool:
 # ------------------------------------------------------------------------------
 # WhatsApp Cloud API
 # ------------------------------------------------------------------------------
+# errores de Graph que significan "este número no sirve" (vs. 429/5xx/token):
+# 100 parámetro inválido, 131009 valor inválido, 131021 destinatario = remitente,
+# 131026 no entregable (sin WhatsApp), 131030 fuera de la lista permitida
+RECIPIENT_ERROR_CODES = {100, 131009, 131021, 131026, 131030}
+# statuses "failed" que NO son culpa del número (ventana de 24 h, límites):
+# no invalidan la variante resuelta
+NOT_RECIPIENT_STATUS_CODES = {130429, 131047, 131048, 131056}
+_SENT_IDS_MAX = 20000  # wamid → wa_id recordados para mapear los statuses
+
+class ResolvedNumbers:
+    """
+    wa_id crudo → variante de número que Graph aceptó. En memoria (LRU de
+    `maxsize`); con `path` también en SQLite (sobrevive reinicios y lo
+    comparten los workers).
+    """
+    def __init__(self, path: Optional[str] = WA_VARIANT_PATH, maxsize: int = WA_VARIANT_MAX):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS resolved (wa_id TEXT PRIMARY KEY, number TEXT)")
+
+    def get(self, wa_id: str) -> Optional[str]:
+        with self._lock:
+            number = self._data.get(wa_id)
+            if number is not None:
+                self._data.move_to_end(wa_id)
+            elif self._db is not None:
+                row = self._db.execute("SELECT number FROM resolved WHERE wa_id = ?", (wa_id,)).fetchone()
+                if row:
+                    number = row[0]
+                    self._remember(wa_id, number)
+            return number
+
+    def _remember(self, wa_id: str, number: str) -> None:
+        self._data[wa_id] = number
+        self._data.move_to_end(wa_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)  # en SQLite sigue estando
+
+    def put(self, wa_id: str, number: str) -> None:
+        with self._lock:
+            self._remember(wa_id, number)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO resolved (wa_id, number) VALUES (?, ?)", (wa_id, number))
+
+    def forget(self, wa_id: str) -> None:
+        with self._lock:
+            self._data.pop(wa_id, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM resolved WHERE wa_id = ?", (wa_id,))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
 class WhatsAppClient:
-    def __init__(self, access_token: str, phone_id: str) -> None:
+    def __init__(self, access_token: str, phone_id: str, resolved: Optional[ResolvedNumbers] = None) -> None:
         self.base_url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
         self.session = requests.Session()
         self.session.headers.update({
             "Authorization": f"Bearer {access_token}",
             "Content-Type": "application/json",
         })
+        self.resolved = resolved if resolved is not None else ResolvedNumbers()
+        self._stats_lock = threading.Lock()
+        self._sent_ids: "OrderedDict[str, str]" = OrderedDict()  # wamid → wa_id crudo
+        self.sent = self.undelivered = self.attempts = self.resolved_hits = self.invalidations = 0
+        self.delivery_failures = 0
 
     def send_text(self, to: str, text: str) -> Tuple[bool, dict]:
         payload = {
@@ -120,22 +197,110 @@ class WhatsAppClient:
         except Exception:
             data = {"status_code": r.status_code, "text": r.text}
         if not ok:
+            if isinstance(data, dict):
+                data.setdefault("status_code", r.status_code)
             log.warning("Fallo al enviar a %s: %s %s", to, r.status_code, data)
         return ok, data
 
+    @staticmethod
+    def recipient_error(data: Any) -> bool:
+        """True si Graph rechazó el NÚMERO (no registrado / inválido): ahí sí conviene otra variante."""
+        err = data.get("error") if isinstance(data, dict) else None
+        return isinstance(err, dict) and err.get("code") in RECIPIENT_ERROR_CODES
+
+    def _send_retrying(self, to: str, text: str, tried: List[str]) -> Tuple[bool, dict]:
+        """POST a `to`; ante errores que no son del destinatario (429, 5xx, token) reintenta el mismo número."""
+        for attempt in range(WA_SEND_RETRIES + 1):
+            if attempt and WA_SEND_BACKOFF > 0:
+                time.sleep(WA_SEND_BACKOFF * 2 ** (attempt - 1))
+            tried.append(to)
+            ok, data = self.send_text(to, text)
+            if ok or self.recipient_error(data):
+                break
+        return ok, data
+
     def send_text_try_arg_variants(self, to_base: str, text: str) -> Tuple[bool, dict, List[str]]:
+        """
+        Primero el número que ya funcionó para este wa_id. Sólo si Graph lo
+        rechaza como destinatario se invalida y se prueban las variantes AR en
+        orden; un 429/5xx/error de token se reintenta sobre el mismo número
+        (probar otras variantes no arregla eso y suma POSTs en plena falla).
+        """
         tried: List[str] = []
-        last = {}
+        known = self.resolved.get(to_base)
+        if known:
+            ok, data = self._send_retrying(known, text, tried)
+            if ok:
+                self._count(tried, True, hit=True)
+                self._remember_sent(data, to_base)
+                return True, data, tried
+            if not self.recipient_error(data):
+                self._count(tried, False)
+                return False, data, tried
+            self.resolved.forget(to_base)
+            with self._stats_lock:
+                self.invalidations += 1
+        last: dict = {}
         for cand in generate_argentina_variants(to_base):
             if cand in tried:
                 continue
-            tried.append(cand)
-            ok, data = self.send_text(cand, text)
-            last = data
+            ok, last = self._send_retrying(cand, text, tried)
             if ok:
-                return True, data, tried
+                self.resolved.put(to_base, cand)
+                self._count(tried, True)
+                self._remember_sent(last, to_base)
+                return True, last, tried
+        self._count(tried, False)
         return False, last, tried
 
+    def _remember_sent(self, data: Any, wa_id: str) -> None:
+        msgs = data.get("messages") if isinstance(data, dict) else None
+        wamid = msgs[0].get("id") if msgs and isinstance(msgs[0], dict) else None
+        if not wamid:
+            return
+        with self._stats_lock:
+            self._sent_ids[wamid] = wa_id
+            while len(self._sent_ids) > _SENT_IDS_MAX:
+                self._sent_ids.popitem(last=False)
+
+    def delivery_failed(self, statuses: List[Dict[str, Any]]) -> int:
+        """
+        Statuses "failed" del webhook: Graph aceptó el POST (200) pero no pudo
+        entregar. Si el error es del destinatario, la variante resuelta no
+        sirve y se olvida (el próximo envío vuelve a probar). Devuelve cuántas.
+        """
+        forgotten = 0
+        for st in statuses:
+            with self._stats_lock:
+                self.delivery_failures += 1
+                wa_id = self._sent_ids.pop(st.get("id"), None) or st.get("recipient_id")
+            codes = {e.get("code") for e in st.get("errors") or [] if isinstance(e, dict)}
+            if not wa_id or (codes and codes <= NOT_RECIPIENT_STATUS_CODES):
+                continue
+            self.resolved.forget(wa_id)
+            forgotten += 1
+            log.info("Entrega fallida a %s %s: olvido la variante resuelta", wa_id, sorted(codes, key=str))
+        with self._stats_lock:
+            self.invalidations += forgotten
+        return forgotten
+
+    def _count(self, tried: List[str], ok: bool, hit: bool = False) -> None:
+        with self._stats_lock:
+            self.attempts += len(tried)
+            self.resolved_hits += int(hit)
+            if ok:
+                self.sent += 1
+            else:
+                self.undelivered += 1
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.sent + self.undelivered
+        return {"messages": total, "sent": self.sent, "undelivered": self.undelivered,
+                "attempts": self.attempts, "attempts_per_message": round(self.attempts / total, 2) if total else 0.0,
+                "resolved_hits": self.resolved_hits, "invalidations": self.invalidations,
+                "delivery_failures": self.delivery_failures,
+                "resolved_numbers": len(self.resolved)}
+
 # ------------------------------------------------------------------------------
 # Números AR (variantes) — evita "doble 9", soporta "54 <area> 54 <numero>"
 # y agrega forzados tipo 2941→2941 54 ...
@@ -222,7 +387,12 @@ def generate_argentina_variants(raw: str) -> List[str]:
 # ------------------------------------------------------------------------------
 # FastAPI app
 # ------------------------------------------------------------------------------
-app = FastAPI(title="Felia WhatsApp Adapter", version="1.2.0")
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+    yield
+    await QUEUE.drain(WA_DRAIN_TIMEOUT)  # lo ya aceptado con 200 no se reintenta: terminarlo
+
+app = FastAPI(title="Felia WhatsApp Adapter", version="1.2.0", lifespan=_lifespan)
 wa = WhatsAppClient(WA_ACCESS_TOKEN, WA_PHONE_ID)
 
 @app.get("/health")
@@ -241,16 +411,13 @@ async def verify_webhook(request: Request):
         return PlainTextResponse(challenge)
     raise HTTPException(status_code=403, detail="Token de verificación inválido")
 
-# POST webhook: alias en ambos paths
-@app.post("/webhook")
-@app.post("/whatsapp/webhook")
-async def webhook_post(request: Request):
-    try:
-        body = await request.json()
-    except Exception:
-        body = {}
-    log.debug("Webhook body: %s", json.dumps(body, ensure_ascii=False))
-
+# ------------------------------------------------------------------------------
+# Cola de mensajes: el webhook sólo valida y encola; un pool acotado de workers
+# async corre el handler (varias llamadas al LLM) y manda las respuestas.
+# ------------------------------------------------------------------------------
+def extract_messages(body: dict) -> List[Dict[str, Any]]:
+    """Mensajes del payload de Meta → [{id, user_id, text, profile_name}]."""
+    jobs: List[Dict[str, Any]] = []
     changes = []
     try:
         changes = body.get("entry", [])[0].get("changes", [])
@@ -283,39 +450,298 @@ async def webhook_post(request: Request):
 
             if not text:
                 text = f"[Tipo {mtype} recibido]"
-
-            user_id = wa_id or "unknown"
-            log.info("Mensaje de %s (%s): %s", profile_name, user_id, text)
-
-            # RESET DEMO
-            if text and text.strip().lower() == "reset":
-                try:
-                    done = reset_session(user_id)
-                except Exception:
-                    done = False
-                wa.send_text_try_arg_variants(
-                    user_id,
-                    "Listo, reiniciamos la conversación. Arrancamos de cero. Contame qué necesitás."
-                )
-                log.info("Reset solicitado por %s → %s", user_id, "OK" if done else "sin handler")
-                continue
-
-            # Llamar al orquestador (tu lógica)
+            jobs.append({"id": msg.get("id"), "user_id": wa_id or "unknown", "text": text,
+                         "profile_name": profile_name})
+    return jobs
+
+def extract_failed_statuses(body: dict) -> List[Dict[str, Any]]:
+    """statuses[] con status == "failed" (entregas que Graph aceptó pero no pudo hacer)."""
+    out: List[Dict[str, Any]] = []
+    for entry in (body.get("entry") or []) if isinstance(body, dict) else []:
+        for change in entry.get("changes") or []:
+            for st in (change.get("value") or {}).get("statuses") or []:
+                if isinstance(st, dict) and st.get("status") == "failed":
+                    out.append(st)
+    return out
+
+class MessageQueue:
+    """
+    Cola acotada + `workers` tareas que la consumen. Cada wa_id tiene su buzón
+    (deque) y figura como mucho una vez en la cola de listos: un worker toma un
+    usuario, procesa UN mensaje suyo y, si le quedan más, lo vuelve a poner al
+    final. Así los mensajes de un usuario salen en orden y una ráfaga de uno
+    solo nunca ocupa más de un worker. Se arranca sola en el loop del primer
+    webhook (las sub-apps montadas no corren startup). Al apagar, `drain()`
+    deja de aceptar y espera a que se vacíe.
+    """
+    def __init__(self, process: Callable[[Dict[str, Any]], Any], workers: int = WA_WORKERS,
+                 maxsize: int = WA_QUEUE_MAX):
+        self.process = process
+        self.workers = workers
+        self.maxsize = maxsize
+        self._ready: Optional[asyncio.Queue] = None  # wa_ids con mensajes pendientes
+        self._mailboxes: Dict[str, deque] = {}      # wa_id → deque[(encolado, job)]
+        self._tasks: List[asyncio.Task] = []
+        self._loop = None
+        self.pending = 0
+        self.closing = False
+        self.enqueued = self.processed = self.failed = self.rejected = self.dropped = 0
+        self.inflight = self.max_depth = 0
+        self._wait_total = self._proc_total = 0.0
+
+    def _ensure_started(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        if self._ready is None or self._loop is not loop:
+            self._loop = loop
+            self._ready = asyncio.Queue()
+            self._mailboxes.clear()
+            self.pending = 0
+            self._tasks = [loop.create_task(self._worker(i)) for i in range(self.workers)]
+        return self._ready
+
+    def offer(self, jobs: List[Dict[str, Any]]) -> bool:
+        """Encola todos o ninguno (un payload no queda a medias)."""
+        if self.closing:  # apagando: 503 y Meta reintenta contra otra instancia
+            self.rejected += len(jobs)
+            return False
+        ready = self._ensure_started()
+        if self.maxsize > 0 and self.pending + len(jobs) > self.maxsize:
+            self.rejected += len(jobs)
+            return False
+        now = time.perf_counter()
+        for job in jobs:
+            user = job["user_id"]
+            box = self._mailboxes.get(user)
+            if box is None:
+                box = self._mailboxes[user] = deque()
+                ready.put_nowait(user)  # el usuario entra una sola vez a la cola de listos
+            box.append((now, job))
+        self.pending += len(jobs)
+        self.enqueued += len(jobs)
+        self.max_depth = max(self.max_depth, self.pending)
+        return True
+
+    async def _worker(self, n: int) -> None:
+        ready = self._ready
+        while True:
+            user = await ready.get()
+            box = self._mailboxes[user]
+            queued_at, job = box.popleft()
+            self.pending -= 1
+            t0 = time.perf_counter()
+            self._wait_total += t0 - queued_at
+            self.inflight += 1
             try:
-                result = handle_message(user_id, text)
+                await self.process(job)
+                self.processed += 1
             except Exception as e:
-                log.exception("Error en handle_message: %s", e)
-                wa.send_text_try_arg_variants(user_id, "Tuvimos un problema interno, ¿podés repetir tu consulta?")
-                continue
+                self.failed += 1
+                log.exception("Worker %s: error procesando mensaje de %s: %s", n, user, e)
+            finally:
+                self.inflight -= 1
+                self._proc_total += time.perf_counter() - t0
+                if box:
+                    ready.put_nowait(user)  # le quedan mensajes: al final de la fila
+                else:
+                    del self._mailboxes[user]
+                ready.task_done()
+
+    async def join(self) -> None:
+        if self._ready is not None:
+            await self._ready.join()
+
+    async def drain(self, timeout: float = WA_DRAIN_TIMEOUT) -> int:
+        """
+        Apagado: no acepta más, espera hasta `timeout` s a que se procese lo
+        encolado y cancela los workers. Devuelve cuántos mensajes se perdieron
+        (en espera + a medio procesar).
+        """
+        self.closing = True
+        if self._ready is None or self._loop is not asyncio.get_running_loop():
+            return 0
+        try:
+            async with asyncio.timeout(timeout):
+                await self._ready.join()
+        except TimeoutError:
+            pass
+        dropped = self.pending + self.inflight
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.dropped += dropped
+        if dropped:
+            log.warning("[SHUTDOWN] cola sin vaciar en %.0fs: se pierden %s mensajes", timeout, dropped)
+        else:
+            log.info("[SHUTDOWN] cola vacía (%s procesados)", self.processed)
+        return dropped
+
+    def stats(self) -> Dict[str, Any]:
+        done = self.processed + self.failed
+        return {
+            "workers": self.workers, "maxsize": self.maxsize,
+            "depth": self.pending, "max_depth": self.max_depth, "users_waiting": len(self._mailboxes),
+            "inflight": self.inflight, "enqueued": self.enqueued, "processed": self.processed,
+            "failed": self.failed, "rejected": self.rejected, "dropped": self.dropped,
+            "avg_wait_ms": round(self._wait_total / done * 1000, 1) if done else 0.0,
+            "avg_process_ms": round(self._proc_total / done * 1000, 1) if done else 0.0,
+        }
+
+class SeenMessages:
+    """
+    Ids de mensaje ya aceptados en la ventana `window` (s): cuando un turno lento
+    hace que Meta reenvíe, el duplicado se descarta antes de llegar al handler.
+    En memoria es un LRU acotado; con `path` el registro va a SQLite (WAL) y lo
+    comparten todos los workers (el alta es un único upsert atómico).
+    """
+    def __init__(self, window: float = WA_DEDUP_WINDOW, maxsize: int = WA_DEDUP_MAX,
+                 path: Optional[str] = WA_DEDUP_PATH, clock: Callable[[], float] = time.time):
+        self.window = window
+        self.maxsize = maxsize
+        self._clock = clock
+        self._ids: "OrderedDict[str, float]" = OrderedDict()  # id → visto (orden de llegada)
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.accepted = self.suppressed = 0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY, ts REAL)")
+
+    def add(self, msg_id: Optional[str]) -> bool:
+        """True si el id es nuevo (y queda registrado); False si es un reenvío."""
+        if not msg_id or self.window <= 0:
+            return True
+        now = self._clock()
+        with self._lock:
+            if self._db is not None:
+                # inserta, o pisa sólo si lo anterior ya venció; rowcount 0 ⇒ duplicado
+                new = self._db.execute(
+                    "INSERT INTO seen (id, ts) VALUES (?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET ts = excluded.ts WHERE seen.ts <= ?",
+                    (msg_id, now, now - self.window)).rowcount == 1
+                if new and (self.accepted + 1) % 1000 == 0:
+                    self._db.execute("DELETE FROM seen WHERE ts <= ?", (now - self.window,))
+            else:
+                while self._ids and next(iter(self._ids.values())) <= now - self.window:
+                    self._ids.popitem(last=False)
+                new = msg_id not in self._ids
+                if new:
+                    self._ids[msg_id] = now
+                    while len(self._ids) > self.maxsize:
+                        self._ids.popitem(last=False)
+            if new:
+                self.accepted += 1
+            else:
+                self.suppressed += 1
+            return new
+
+    async def aadd(self, msg_id: Optional[str]) -> bool:
+        """`add` desde el loop: con SQLite el upsert corre en un hilo."""
+        if self._db is None:
+            return self.add(msg_id)
+        return await asyncio.to_thread(self.add, msg_id)
+
+    async def aforget(self, ids: Iterable[Optional[str]]) -> None:
+        ids = list(ids)
+        if self._db is None:
+            return self.forget(ids)
+        await asyncio.to_thread(self.forget, ids)
+
+    def __len__(self) -> int:
+        if self._db is None:
+            return len(self._ids)
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM seen WHERE ts > ?",
+                                    (self._clock() - self.window,)).fetchone()[0]
+
+    def forget(self, ids: Iterable[Optional[str]]) -> None:
+        """Des-registra (p.ej. si no entraron en la cola: el reintento de Meta debe pasar)."""
+        with self._lock:
+            for msg_id in ids:
+                if not msg_id:
+                    continue
+                self._ids.pop(msg_id, None)
+                if self._db is not None:
+                    self._db.execute("DELETE FROM seen WHERE id = ?", (msg_id,))
+                self.accepted -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "sqlite" if self._db is not None else "memory", "window_s": self.window,
+                "size": len(self), "accepted": self.accepted, "suppressed": self.suppressed}
+
+SEEN = SeenMessages()
+
+async def _send(user_id: str, text: str) -> Tuple[bool, dict, List[str]]:
+    # requests es bloqueante: el POST a Graph va a un hilo, no frena el loop
+    return await asyncio.to_thread(wa.send_text_try_arg_variants, user_id, text)
+
+async def process_message(job: Dict[str, Any]) -> None:
+    user_id, text = job["user_id"], job["text"]
+    log.info("Mensaje de %s (%s): %s", job.get("profile_name"), user_id, text)
+
+    # RESET DEMO
+    if text and text.strip().lower() == "reset":
+        try:
+            done = reset_session(user_id)
+        except Exception:
+            done = False
+        await _send(user_id, "Listo, reiniciamos la conversación. Arrancamos de cero. Contame qué necesitás.")
+        log.info("Reset solicitado por %s → %s", user_id, "OK" if done else "sin handler")
+        return
+
+    # Llamar al orquestador (tu lógica); puede ser sync o async
+    try:
+        if inspect.iscoroutinefunction(handle_message):
+            result = await handle_message(user_id, text)
+        else:
+            result = await asyncio.to_thread(handle_message, user_id, text)
+            if inspect.isawaitable(result):
+                result = await result
+    except Exception as e:
+        log.exception("Error en handle_message: %s", e)
+        await _send(user_id, "Tuvimos un problema interno, ¿podés repetir tu consulta?")
+        return
+
+    # Normalizar y responder (probando variantes AR)
+    for i, chunk in enumerate(normalize_replies(result)):
+        if i and WA_SEND_DELAY > 0:
+            await asyncio.sleep(WA_SEND_DELAY)
+        ok, data, tried = await _send(user_id, chunk)
+        if not ok:
+            log.error("No se pudo enviar respuesta a %s. Probadas: %s. Última resp: %s",
+                      user_id, tried, data)
+
+QUEUE = MessageQueue(process_message)
+
+# POST webhook: alias en ambos paths
+@app.post("/webhook")
+@app.post("/whatsapp/webhook")
+async def webhook_post(request: Request):
+    try:
+        body = await request.json()
+    except Exception:
+        body = {}
+    log.debug("Webhook body: %s", json.dumps(body, ensure_ascii=False))
 
-            # Normalizar y responder (probando variantes AR)
-            for chunk in normalize_replies(result):
-                ok, data, tried = wa.send_text_try_arg_variants(user_id, chunk)
-                if not ok:
-                    log.error("No se pudo enviar respuesta a %s. Probadas: %s. Última resp: %s",
-                              user_id, tried, data)
-                time.sleep(0.25)
-    return JSONResponse({"status": "ok"})
+    failed = extract_failed_statuses(body)
+    if failed:  # puede tocar SQLite: en un hilo
+        await asyncio.to_thread(wa.delivery_failed, failed)
+
+    received = extract_messages(body)
+    jobs = [j for j in received if await SEEN.aadd(j.get("id"))]  # reenvíos de Meta: fuera
+    if len(jobs) < len(received):
+        log.info("Descarto %s mensajes ya recibidos", len(received) - len(jobs))
+    if jobs and not QUEUE.offer(jobs):
+        await SEEN.aforget(j.get("id") for j in jobs)
+        log.warning("Cola llena (%s en espera): rechazo %s mensajes", QUEUE.stats()["depth"], len(jobs))
+        return JSONResponse({"status": "busy"}, status_code=503)
+    return JSONResponse({"status": "ok", "queued": len(jobs), "duplicates": len(received) - len(jobs)})
+
+@app.get("/metrics")
+def metrics():
+    return JSONResponse({"queue": QUEUE.stats(), "dedup": SEEN.stats(), "sends": wa.stats()})
 
 
 # Helpers